@@ -3,12 +3,75 @@ SUMMARY:
 - Combines data from AWS RDS with features engineered downstream to generate full training dataset for modeling
 - Transforms data for modeling
 - Performs additional data cleaning
-- Stores training data as materialized view
+- Stores training data in client_health_full_training_data, a table with one partition per start_date month
+- Feature tables are loaded by feature_engineering/warehouse_loader.py with one row per key, so they are joined as is
+- Prebuilt report usage is joined once, from all_dna_prebuilt_report_usage_pivot (one column pair per report, created
+  by warehouse_loader.py from PREBUILT_REPORTS, or below if the loader hasn't run yet)
+
+REFRESH:
+- Triggers on the input tables record the start_date months whose inputs changed in
+  client_health_training_stale_months; a TRUNCATE of an input marks every month stale
+- The triggers go with their table: after dropping and recreating an input table (or any other DDL that loses its
+  triggers) re-run this script.  The refresh checks for them and stops with the missing ones otherwise
+- CALL refresh_client_health_full_training_data(); recomputes just those months' partitions, one month per
+  transaction, with DELETE / INSERT rather than TRUNCATE, so models can keep reading the table during a refresh
+- First install, or after changing the columns of client_health_full_training_data_v (drop the table first):
+  CALL refresh_client_health_full_training_data(full_refresh => TRUE);
+
+ONE-OFF MIGRATION:
+- Warehouses that still have the materialized view this table replaced can drop it once it's unused:
+  DROP MATERIALIZED VIEW IF EXISTS client_health_full_training_data_mv;
 */
 
 
-DROP MATERIALIZED VIEW IF EXISTS client_health_full_training_data_mv;
-CREATE MATERIALIZED VIEW client_health_full_training_data_mv AS
+-- warehouse_loader.py (re)creates the report pivot whenever it loads the reports; on a warehouse it hasn't loaded
+-- yet the pivot is created here, with the same columns (PREBUILT_REPORTS, in order), so the view below can be built
+DO
+$$
+	BEGIN
+		IF TO_REGCLASS('all_dna_prebuilt_report_usage_pivot') IS NULL THEN
+			CREATE VIEW all_dna_prebuilt_report_usage_pivot AS
+			SELECT
+				sf_an,
+				client,
+				month_start,
+				MAX(times_accessed) FILTER (WHERE title = 'Assessment Matrix Report') AS matrix_times_accessed,
+				MAX(count_of_distinct_users) FILTER (WHERE title = 'Assessment Matrix Report') AS matrix_distinct_users,
+				MAX(times_accessed) FILTER (WHERE title = 'Assessment Response Frequency') AS rsp_freq_times_accessed,
+				MAX(count_of_distinct_users) FILTER (WHERE title = 'Assessment Response Frequency') AS rsp_freq_distinct_users,
+				MAX(times_accessed) FILTER (WHERE title = 'Skills Assessment Parent Letter') AS skills_letter_times_accessed,
+				MAX(count_of_distinct_users) FILTER (WHERE title = 'Skills Assessment Parent Letter') AS skills_letter_distinct_users,
+				MAX(times_accessed) FILTER (WHERE title = 'Site Assessment Overview') AS site_asmt_ovr_times_accessed,
+				MAX(count_of_distinct_users) FILTER (WHERE title = 'Site Assessment Overview') AS site_asmt_ovr_distinct_users,
+				MAX(times_accessed) FILTER (WHERE title = 'Teacher Assessment Overview') AS teacher_asmt_ovr_times_accessed,
+				MAX(count_of_distinct_users) FILTER (WHERE title = 'Teacher Assessment Overview') AS teacher_asmt_ovr_distinct_users,
+				MAX(times_accessed) FILTER (WHERE title = 'Assessment Student Overview') AS asmt_stu_ovr_times_accessed,
+				MAX(count_of_distinct_users) FILTER (WHERE title = 'Assessment Student Overview') AS asmt_stu_ovr_distinct_users,
+				MAX(times_accessed) FILTER (WHERE title = 'Assessment Site Peer Comparison') AS site_peer_comp_times_accessed,
+				MAX(count_of_distinct_users) FILTER (WHERE title = 'Assessment Site Peer Comparison') AS site_peer_comp_distinct_users,
+				MAX(times_accessed) FILTER (WHERE title = 'Assessment Teacher Peer Comparison') AS teacher_peer_comp_times_accessed,
+				MAX(count_of_distinct_users) FILTER (WHERE title = 'Assessment Teacher Peer Comparison') AS teacher_peer_comp_distinct_users,
+				MAX(times_accessed) FILTER (WHERE title = 'Multiple Assessment Summary Report') AS mltp_asmt_smry_times_accessed,
+				MAX(count_of_distinct_users) FILTER (WHERE title = 'Multiple Assessment Summary Report') AS mltp_asmt_smry_distinct_users
+			FROM all_dna_prebuilt_report_usage
+			WHERE title IN (
+				'Assessment Matrix Report',
+				'Assessment Response Frequency',
+				'Skills Assessment Parent Letter',
+				'Site Assessment Overview',
+				'Teacher Assessment Overview',
+				'Assessment Student Overview',
+				'Assessment Site Peer Comparison',
+				'Assessment Teacher Peer Comparison',
+				'Multiple Assessment Summary Report'
+			)
+			GROUP BY sf_an, client, month_start;
+		END IF;
+	END
+$$;
+
+DROP VIEW IF EXISTS client_health_full_training_data_v;
+CREATE VIEW client_health_full_training_data_v AS
 (
 
 SELECT
@@ -83,90 +146,189 @@ SELECT
     -------------------------
 	ca.cumulative_common_assessment_count_per_ay,
 	sys_admin.sa_tenure_in_days,
-	matrix.times_accessed AS matrix_times_accessed,
-	matrix.count_of_distinct_users AS matrix_distinct_users,
-	site_asmt_ovr.times_accessed AS site_asmt_ovr_times_accessed,
-	site_asmt_ovr.count_of_distinct_users AS site_asmt_ovr_distinct_users,
-	site_peer_comp.times_accessed AS site_peer_comp_times_accessed,
-	site_peer_comp.count_of_distinct_users AS site_peer_comp_distinct_users,
-	mltp_asmt_smry.times_accessed AS mltp_asmt_smry_times_accessed,
-	mltp_asmt_smry.count_of_distinct_users AS mltp_asmt_smry_distinct_users,
-	rsp_freq.times_accessed AS rsp_freq_times_accessed,
-	rsp_freq.count_of_distinct_users AS rsp_freq_distinct_users,
-	skills_letter.times_accessed AS skills_letter_times_accessed,
-	skills_letter.count_of_distinct_users AS skills_letter_distinct_users
+	reports.matrix_times_accessed,
+	reports.matrix_distinct_users,
+	reports.site_asmt_ovr_times_accessed,
+	reports.site_asmt_ovr_distinct_users,
+	reports.site_peer_comp_times_accessed,
+	reports.site_peer_comp_distinct_users,
+	reports.mltp_asmt_smry_times_accessed,
+	reports.mltp_asmt_smry_distinct_users,
+	reports.rsp_freq_times_accessed,
+	reports.rsp_freq_distinct_users,
+	reports.skills_letter_times_accessed,
+	reports.skills_letter_distinct_users
 
 FROM aws_talend_training_data aws
-LEFT JOIN (
-	SELECT DISTINCT ON (sf_an, client, month_start) *
-	FROM dna_common_assessments
-) ca
+LEFT JOIN dna_common_assessments ca
 		  ON ca.sf_an = aws.sf_an
 			  AND ca.client = aws.atd_database
 			  AND ca.month_start::date = aws.start_date
-LEFT JOIN (
-	SELECT DISTINCT ON (sf_an, client, month_start) *
-	FROM all_dna_system_admin_tenure
-) sys_admin
+LEFT JOIN all_dna_system_admin_tenure sys_admin
 		  ON sys_admin.sf_an = aws.sf_an
 			  AND sys_admin.client = aws.atd_database
 			  AND sys_admin.month_start::date = aws.start_date
-LEFT JOIN (
-	SELECT DISTINCT ON (sf_an, client, month_start) *
-	FROM all_dna_prebuilt_report_usage
-	WHERE title = 'Assessment Matrix Report'
-	ORDER BY month_start
-) matrix
-		  ON matrix.sf_an = aws.sf_an
-			  AND matrix.client = aws.atd_database
-			  AND matrix.month_start = aws.start_date
-LEFT JOIN (
-	SELECT DISTINCT ON (sf_an, client, month_start) *
-	FROM all_dna_prebuilt_report_usage
-	WHERE title = 'Site Assessment Overview'
-	ORDER BY month_start
-) site_asmt_ovr
-		  ON site_asmt_ovr.sf_an = aws.sf_an
-			  AND site_asmt_ovr.client = aws.atd_database
-			  AND site_asmt_ovr.month_start = aws.start_date
-LEFT JOIN (
-	SELECT DISTINCT ON (sf_an, client, month_start) *
-	FROM all_dna_prebuilt_report_usage
-	WHERE title = 'Assessment Site Peer Comparison'
-	ORDER BY month_start
-) site_peer_comp
-		  ON site_peer_comp.sf_an = aws.sf_an
-			  AND site_peer_comp.client = aws.atd_database
-			  AND site_peer_comp.month_start = aws.start_date
-LEFT JOIN (
-	SELECT DISTINCT ON (sf_an, client, month_start) *
-	FROM all_dna_prebuilt_report_usage
-	WHERE title = 'Multiple Assessment Summary Report'
-	ORDER BY month_start
-) mltp_asmt_smry
-		  ON mltp_asmt_smry.sf_an = aws.sf_an
-			  AND mltp_asmt_smry.client = aws.atd_database
-			  AND mltp_asmt_smry.month_start = aws.start_date
-LEFT JOIN (
-	SELECT DISTINCT ON (sf_an, client, month_start) *
-	FROM all_dna_prebuilt_report_usage
-	WHERE title = 'Assessment Response Frequency'
-	ORDER BY month_start
-) rsp_freq
-		  ON rsp_freq.sf_an = aws.sf_an
-			  AND rsp_freq.client = aws.atd_database
-			  AND rsp_freq.month_start = aws.start_date
-LEFT JOIN (
-	SELECT DISTINCT ON (sf_an, client, month_start) *
-	FROM all_dna_prebuilt_report_usage
-	WHERE title = 'Skills Assessment Parent Letter'
-	ORDER BY month_start
-) skills_letter
-		  ON skills_letter.sf_an = aws.sf_an
-			  AND skills_letter.client = aws.atd_database
-			  AND skills_letter.month_start = aws.start_date
+LEFT JOIN all_dna_prebuilt_report_usage_pivot reports
+		  ON reports.sf_an = aws.sf_an
+			  AND reports.client = aws.atd_database
+			  AND reports.month_start = aws.start_date
 
 WHERE aws.atd_database NOT ILIKE '%candidate%'
 
 	)
-;
\ No newline at end of file
+;
+
+
+CREATE TABLE IF NOT EXISTS client_health_full_training_data
+	(LIKE client_health_full_training_data_v)
+	PARTITION BY RANGE (start_date);
+
+CREATE INDEX IF NOT EXISTS client_health_full_training_data_client
+	ON client_health_full_training_data (sf_an, atd_database, start_date);
+
+CREATE TABLE IF NOT EXISTS client_health_training_stale_months (
+	start_date date PRIMARY KEY
+);
+
+
+-- the tables the view reads, with their month column; each gets the triggers below
+CREATE OR REPLACE FUNCTION training_data_inputs(OUT table_name text, OUT month_column text) RETURNS SETOF record
+	LANGUAGE sql IMMUTABLE AS
+$$
+	VALUES
+		('aws_talend_training_data', 'start_date'),
+		('dna_common_assessments', 'month_start'),
+		('all_dna_system_admin_tenure', 'month_start'),
+		('all_dna_prebuilt_report_usage', 'month_start')
+$$;
+
+
+CREATE OR REPLACE FUNCTION mark_training_months_stale() RETURNS trigger
+	LANGUAGE plpgsql AS
+$$
+BEGIN
+	-- TG_ARGV[0] is the month column of the input table; changed_rows its transition table
+	EXECUTE FORMAT(
+		'INSERT INTO client_health_training_stale_months (start_date)
+		 SELECT DISTINCT DATE_TRUNC(''month'', %I)::date FROM changed_rows WHERE %I IS NOT NULL
+		 ON CONFLICT DO NOTHING',
+		TG_ARGV[0], TG_ARGV[0]
+	);
+	RETURN NULL;
+END
+$$;
+
+CREATE OR REPLACE FUNCTION mark_all_training_months_stale() RETURNS trigger
+	LANGUAGE plpgsql AS
+$$
+BEGIN
+	-- a TRUNCATE has no transition table, so every month built so far or still to build is stale
+	INSERT INTO client_health_training_stale_months (start_date)
+	SELECT start_date FROM client_health_full_training_data
+	UNION
+	SELECT DATE_TRUNC('month', start_date)::date FROM aws_talend_training_data WHERE start_date IS NOT NULL
+	ON CONFLICT DO NOTHING;
+	RETURN NULL;
+END
+$$;
+
+DO
+$$
+	DECLARE
+		input record;
+		event record;
+	BEGIN
+		FOR input IN SELECT * FROM training_data_inputs()
+		LOOP
+			-- mark_training_months_stale() reads one transition table, so updates get a trigger for their
+			-- old rows and one for their new rows (in case the month itself changed)
+			FOR event IN
+				SELECT *
+				FROM (VALUES
+					('inserted', 'INSERT', 'NEW'),
+					('updated_to', 'UPDATE', 'NEW'),
+					('updated_from', 'UPDATE', 'OLD'),
+					('deleted', 'DELETE', 'OLD')
+				) AS events (suffix, operation, transition)
+			LOOP
+				EXECUTE FORMAT('DROP TRIGGER IF EXISTS %I ON %I', 'training_months_' || event.suffix, input.table_name);
+				EXECUTE FORMAT(
+					'CREATE TRIGGER %I AFTER %s ON %I REFERENCING %s TABLE AS changed_rows
+					 FOR EACH STATEMENT EXECUTE FUNCTION mark_training_months_stale(%L)',
+					'training_months_' || event.suffix, event.operation, input.table_name, event.transition,
+					input.month_column
+				);
+			END LOOP;
+			EXECUTE FORMAT('DROP TRIGGER IF EXISTS training_months_truncated ON %I', input.table_name);
+			EXECUTE FORMAT(
+				'CREATE TRIGGER training_months_truncated AFTER TRUNCATE ON %I
+				 FOR EACH STATEMENT EXECUTE FUNCTION mark_all_training_months_stale()',
+				input.table_name
+			);
+		END LOOP;
+	END
+$$;
+
+
+CREATE OR REPLACE PROCEDURE refresh_client_health_full_training_data(full_refresh boolean DEFAULT FALSE)
+	LANGUAGE plpgsql AS
+$$
+DECLARE
+	stale_month date;
+	partition_name text;
+	missing_triggers text;
+BEGIN
+	-- without its triggers an input's changes would never be refreshed (see REFRESH above)
+	SELECT STRING_AGG(inputs.table_name || '.training_months_' || suffix, ', ')
+	INTO missing_triggers
+	FROM training_data_inputs() AS inputs
+	CROSS JOIN UNNEST(ARRAY['inserted', 'updated_to', 'updated_from', 'deleted', 'truncated']) AS suffix
+	WHERE NOT EXISTS (
+		SELECT
+		FROM pg_trigger
+		WHERE tgrelid = TO_REGCLASS(inputs.table_name) AND tgname = 'training_months_' || suffix
+	);
+	IF missing_triggers IS NOT NULL THEN
+		RAISE EXCEPTION 'triggers missing: %; re-run client_health_full_training_data.sql', missing_triggers;
+	END IF;
+
+	IF full_refresh THEN
+		INSERT INTO client_health_training_stale_months (start_date)
+		SELECT DISTINCT DATE_TRUNC('month', start_date)::date
+		FROM aws_talend_training_data
+		ON CONFLICT DO NOTHING;
+		COMMIT;
+	END IF;
+
+	LOOP
+		SELECT start_date INTO stale_month
+		FROM client_health_training_stale_months
+		ORDER BY start_date
+		LIMIT 1;
+		EXIT WHEN NOT FOUND;
+
+		-- a new partition locks the whole table, so it is committed on its own before the month is computed
+		partition_name := 'client_health_full_training_data_' || TO_CHAR(stale_month, 'YYYY_MM');
+		IF TO_REGCLASS(partition_name) IS NULL THEN
+			EXECUTE FORMAT(
+				'CREATE TABLE %I PARTITION OF client_health_full_training_data FOR VALUES FROM (%L) TO (%L)',
+				partition_name, stale_month, (stale_month + INTERVAL '1 month')::date
+			);
+			COMMIT;
+		END IF;
+
+		-- readers see the month's previous rows until its new rows are committed
+		DELETE FROM client_health_training_stale_months WHERE start_date = stale_month;
+		DELETE FROM client_health_full_training_data
+		WHERE start_date >= stale_month AND start_date < stale_month + INTERVAL '1 month';
+		-- start_date is the first of the month (the feature joins rely on it); an equality also reaches the
+		-- feature tables and the report pivot through the joins, so only their rows for the month are read
+		INSERT INTO client_health_full_training_data
+		SELECT *
+		FROM client_health_full_training_data_v
+		WHERE start_date = stale_month;
+		RAISE NOTICE 'refreshed %', stale_month;
+		COMMIT;
+	END LOOP;
+END
+$$;
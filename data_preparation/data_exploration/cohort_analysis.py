@@ -0,0 +1,189 @@
+"""
+Cohort analysis of the dependent variables: for each metric in COHORT_METRICS the client months
+are ranked by the metric (highest first), split into deciles by rank and the mean client health
+of each decile is compared.
+
+cohort_analysis_for_dependent_variables.sql used to do this with one CTE per metric, each
+scanning the rollup again and sorting all of it for its RANK() OVER.  The query now returns the
+client months once, with every metric's inputs; cohort_buckets() ranks all metrics at once (one
+column each of a single frame), and one group by over the stacked buckets gives every cohort's
+range, avg_hs and n.  A new cohort is a new COHORT_METRICS entry (its inputs added to the query if
+they aren't there yet).
+
+As in the query, a bucket is FLOOR(rank / client month count * 10), with tied values sharing
+their lowest rank and missing values ranked first (Postgres sorts NULLs first in descending
+order).  Bucket 9 is the lowest decile, so the output is ordered by bucket descending.
+
+    python cohort_analysis.py    # writes cohort_analysis.csv and cohort_analysis.png
+
+Both are written next to this script, wherever it is run from.  plots/cohort_analysis_grid.png is
+the original, hand-made grid; the plot of this script is written next to its csv instead of over
+it.
+"""
+
+import math
+import os
+import numpy as np
+import pandas as pd
+import pandas.io.sql as sqlio
+import psycopg2
+
+
+SQL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cohort_analysis_for_dependent_variables.sql')
+OUTPUT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cohort_analysis.csv')
+PLOT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cohort_analysis.png')
+BUCKETS = 10
+GREEN_HEALTH = (75, 100)
+
+# cohort -> column, per_user (divided by atd_users_count), decimals of its range and, optionally,
+# rows: a boolean column limiting the cohort to some client months
+COHORT_METRICS = {
+    'IB Asmts Administered Score': {'column': 'asmt_admin_ib_score', 'per_user': False, 'decimals': 3},
+    'IB Asmts Created Score': {'column': 'asmt_created_ib_score', 'per_user': False, 'decimals': 3},
+    'Flex Asmts Administered Score': {'column': 'asmt_admin_flex_score', 'per_user': False, 'decimals': 3},
+    'Flex Asmts Created Score': {'column': 'asmt_created_flex_score', 'per_user': False, 'decimals': 3},
+    'IB Asmts Administered p/ User': {'column': 'asmt_admin_ib', 'per_user': True, 'decimals': 3},
+    'IB Asmts Created p/ User': {'column': 'asmt_created_ib', 'per_user': True, 'decimals': 3},
+    'Flex Asmts Administered p/ User': {'column': 'asmt_admin_flex', 'per_user': True, 'decimals': 3},
+    'Flex Asmts Created p/ User': {'column': 'asmt_created_flex', 'per_user': True, 'decimals': 3},
+    'ZD Tickets p/ User': {'column': 'ticket_count', 'per_user': True, 'decimals': 3},
+    'Student Count': {'column': 'atd_student_count', 'per_user': False, 'decimals': 0},
+    'Custom Reports p/ User': {'column': 'user_created_custom_reports', 'per_user': True, 'decimals': 3},
+    'Summary Asmts p/ User': {
+        'column': 'summary_asmt_created', 'per_user': True, 'decimals': 3, 'rows': 'has_usage_atd_monthly'
+    }
+}
+
+
+def connect_to_db():
+    try:
+        return psycopg2.connect(
+            host = "REMOVE",
+            database = "REMOVE",
+            user = "franck",
+            password = "REMOVE",
+            options = '-c statement_timeout=300000'
+        )
+    except Exception as err:
+        print(f"ERROR: connect_to_db: {err}")
+        return None
+
+
+def get_cohort_rows():
+    db_connection = connect_to_db()
+    if db_connection is None:
+        print(f'ERROR: Unable to establish connection to DB.')
+        return None
+
+    with open(SQL_PATH) as file:
+        cohort_sql = file.read().strip().rstrip(';')
+    print("Getting data...")
+    cohort_rows = sqlio.read_sql_query(cohort_sql, db_connection)
+    db_connection.close()
+    print(f"...query completed ({len(cohort_rows)})")
+    return cohort_rows
+
+
+def metric_values(cohort_rows, metrics = COHORT_METRICS):
+    """One column per cohort: the metric of each client month (NaN outside the cohort's rows)."""
+    values = {}
+    for cohort, metric in metrics.items():
+        value = cohort_rows[metric['column']].astype(float)
+        if metric['per_user']:
+            value = value / cohort_rows['atd_users_count'].astype(float)
+        values[cohort] = value
+    return pd.DataFrame(values, index = cohort_rows.index)
+
+
+def cohort_buckets(cohort_rows, metrics = COHORT_METRICS, buckets = BUCKETS):
+    """
+    cohort, bucket, range, avg_hs, n and total_n of every cohort, as the per-metric CTEs returned
+    them.
+    """
+    values = metric_values(cohort_rows, metrics)
+    in_cohort = pd.DataFrame(
+        {cohort: cohort_rows[metric['rows']].fillna(False).astype(bool) if 'rows' in metric else True
+         for cohort, metric in metrics.items()},
+        index = cohort_rows.index
+    )
+
+    # missing values tie for rank 1, ahead of every value
+    missing = values.isna() & in_cohort
+    ranks = values.where(in_cohort).rank(method = 'min', ascending = False) + missing.sum()
+    ranks = ranks.mask(missing, 1).where(in_cohort)
+    bucket = np.floor(ranks / len(cohort_rows) * buckets)
+
+    stacked = pd.DataFrame({
+        'cohort': np.repeat(np.array(list(metrics), dtype = object)[None, :], len(values), axis = 0).ravel(),
+        'bucket': bucket.to_numpy().ravel(),
+        'rate': values.to_numpy().ravel(),
+        'atd_client_health_score': np.repeat(cohort_rows['atd_client_health_score'].to_numpy(dtype = float), len(metrics))
+    }).dropna(subset = ['bucket'])
+    for cohort, metric in metrics.items():
+        in_this = stacked['cohort'] == cohort
+        stacked.loc[in_this, 'rate'] = stacked.loc[in_this, 'rate'].round(metric['decimals'])
+
+    summary = stacked.groupby(['cohort', 'bucket'], sort = False).agg(
+        low = ('rate', 'min'),
+        high = ('rate', 'max'),
+        avg_hs = ('atd_client_health_score', 'mean'),
+        n = ('rate', 'size')
+    ).reset_index()
+    decimals = summary['cohort'].map({cohort: metric['decimals'] for cohort, metric in metrics.items()})
+    summary['range'] = [
+        None if pd.isna(low) else f'[{low:.{places}f}, {high:.{places}f}]'
+        for low, high, places in zip(summary['low'], summary['high'], decimals)
+    ]
+    summary['total_n'] = summary.groupby('cohort')['n'].transform('sum')
+    summary['bucket'] = summary['bucket'].astype(int)
+
+    summary['cohort'] = pd.Categorical(summary['cohort'], categories = list(metrics), ordered = True)
+    summary = summary.sort_values(['cohort', 'bucket'], ascending = [True, False])
+    summary['cohort'] = summary['cohort'].astype(str)
+    return summary[['cohort', 'bucket', 'range', 'avg_hs', 'n', 'total_n']].reset_index(drop = True)
+
+
+def plot_cohort_grid(summary, path = PLOT_PATH, rows = 3):
+    """One panel per cohort: n per bucket (bars) and its avg_hs (line), lowest decile on the left."""
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    cohorts = list(dict.fromkeys(summary['cohort']))
+    columns = math.ceil(len(cohorts) / rows)
+    fig, axes = plt.subplots(rows, columns, figsize = (4 * columns, 4.5 * rows), squeeze = False)
+    for ax, cohort in zip(axes.ravel(), cohorts):
+        buckets = summary[summary['cohort'] == cohort]
+        positions = np.arange(len(buckets))
+        counts = ax.twinx()
+        counts.bar(positions, buckets['n'], color = '#e6e6e6', width = 0.5)
+        counts.set_ylabel('n (Count of Records in Range)')
+        ax.set_zorder(counts.get_zorder() + 1)
+        ax.patch.set_visible(False)
+        ax.axhspan(*GREEN_HEALTH, color = 'green', alpha = 0.1)
+        ax.text(positions[-1], GREEN_HEALTH[0] + 1, 'Green Health', color = 'green', fontsize = 6, ha = 'right')
+        ax.plot(positions, buckets['avg_hs'], color = '#1e90ff', marker = 'o', markersize = 4)
+        ax.set_ylim(0, 120)
+        ax.set_ylabel('Avg. Health Score', fontsize = 7)
+        ax.set_title(cohort, fontsize = 9)
+        ax.set_xticks(positions)
+        ax.set_xticklabels(
+            [f'{bucket_range}\n(n={n})' for bucket_range, n in zip(buckets['range'], buckets['n'])],
+            rotation = 45, fontsize = 5
+        )
+    for ax in axes.ravel()[len(cohorts):]:
+        ax.set_visible(False)
+
+    fig.suptitle('Cohort Analysis', x = 0.01, ha = 'left', fontsize = 16)
+    fig.tight_layout()
+    fig.savefig(path, dpi = 200)
+    plt.close(fig)
+
+
+if __name__ == '__main__':
+    cohort_rows = get_cohort_rows()
+    if cohort_rows is not None:
+        summary = cohort_buckets(cohort_rows)
+        summary.to_csv(OUTPUT_PATH, index = False)
+        plot_cohort_grid(summary)
+        print("fin.")
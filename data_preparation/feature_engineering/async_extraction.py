@@ -0,0 +1,293 @@
+"""
+Asyncio extraction engine for the per-client feature queries.
+
+Nearly all of the wall-clock time of a fleet run is spent waiting on the network and on the
+client DB servers, not on CPU.  Instead of blocking 16 spawned processes on one psycopg2
+connection each, a single event loop keeps hundreds of asyncpg queries in flight and writes the
+same per-client csv shards as get_data().
+"""
+
+import asyncio
+import os
+import time
+from datetime import datetime
+import asyncpg
+from extraction_common import (
+    FAKE_FLEET_ENV, STATEMENT_TIMEOUT_MS, ExtractionProgress, client_export_sql, connection_settings,
+    open_query_writer
+)
+from incremental_extraction import finish_query
+from extraction_metrics import QueryTimer, total_seconds
+from extraction_retries import (
+    MAX_ATTEMPTS, backoff_seconds, classify_error, failure_record, retry_timeout_ms, should_retry
+)
+from extraction_scheduler import ServerAwareScheduler
+from runtime_history import job_priority
+from client_metadata import AY_START_END_SQL, SF_AN_SQL, metadata_entry, render_client_metadata
+
+
+async def connect_to_db(server_no, client):
+    """Raises the driver's error when the connection fails, for get_data() to classify."""
+    if os.environ.get(FAKE_FLEET_ENV):
+        from fake_fleet import connect_async
+        return await connect_async(server_no, client)
+    db_connection = await asyncpg.connect(
+        **connection_settings(server_no, client),
+        server_settings = {'statement_timeout': str(STATEMENT_TIMEOUT_MS)}
+    )
+    # asyncpg decodes timestamptz to UTC, psycopg2 parses its text in the session's TimeZone; parse
+    # the text here too, so both engines write the same shards (and the same month_start dates)
+    await db_connection.set_type_codec(
+        'timestamptz', schema = 'pg_catalog', encoder = str, decoder = datetime.fromisoformat, format = 'text'
+    )
+    return db_connection
+
+
+async def get_data(work_item):
+    """
+    Async counterpart of get_data(): run every selected feature query for one client over a single
+    connection and write each feature's shard, retrying failures the same way.
+
+    Returns (client, row_counts, failures, timings, metadata), the last four as get_data() returns
+    them.
+    """
+    client = work_item['client']
+    server_no = work_item['server_no']
+
+    row_counts = {}
+    failures = {}
+    timings = []
+    timeouts = {query['feature']: STATEMENT_TIMEOUT_MS for query in work_item['feature_queries']}
+    feature_queries = work_item['feature_queries']
+    metadata = work_item.get('metadata')
+    for attempt in range(MAX_ATTEMPTS):
+        if attempt:
+            await asyncio.sleep(backoff_seconds(attempt))
+
+        connect_started = time.perf_counter()
+        try:
+            db_connection = await connect_to_db(server_no, client)
+        except Exception as err:
+            kind = classify_error(err)
+            print(f'ERROR: Unable to establish connection to DB for {client} ({kind}): {err}')
+            timer = QueryTimer(client, server_no, None, attempt + 1, time.perf_counter() - connect_started)
+            timer.failed(kind)
+            timings.append(timer.record)
+            if should_retry(kind, attempt):
+                continue
+            for query in feature_queries:
+                failures[query['feature']] = failure_record(err, kind, attempt + 1)
+                row_counts[query['feature']] = 0
+            break
+        connect_seconds = time.perf_counter() - connect_started
+        if metadata is None:
+            metadata = await fetch_client_metadata(db_connection, client)
+
+        retry_queries = []
+        session_timeout = STATEMENT_TIMEOUT_MS
+        try:
+            for query in feature_queries:
+                feature = query['feature']
+                # the connect is charged to the first query on the connection
+                timer = QueryTimer(client, server_no, feature, attempt + 1, connect_seconds)
+                connect_seconds = 0.0
+                timings.append(timer.record)
+                try:
+                    if timeouts[feature] != session_timeout:
+                        await db_connection.execute(f"SET statement_timeout = {int(timeouts[feature])}")
+                        session_timeout = timeouts[feature]
+                    client_query = dict(query, sql = render_client_metadata(query['sql'], metadata))
+                    row_count = await run_feature_query(db_connection, client_query, timer)
+                    # shard writing is blocking file io, keep it off the event loop; a failure to
+                    # splice the shard fails the feature like a failed query
+                    await asyncio.to_thread(finish_query, query, row_count)
+                except Exception as err:
+                    kind = classify_error(err)
+                    timer.failed(kind)
+                    if should_retry(kind, attempt):
+                        print(f"retrying {feature} for {client} ({kind})")
+                        timeouts[feature] = retry_timeout_ms(timeouts[feature], kind)
+                        retry_queries.append(query)
+                    else:
+                        failures[feature] = failure_record(err, kind, attempt + 1)
+                    row_count = 0
+                row_counts[feature] = row_count
+        finally:
+            await db_connection.close()
+
+        feature_queries = retry_queries
+        if not feature_queries:
+            break
+
+    return client, row_counts, failures, timings, metadata
+
+
+async def fetch_client_metadata(db_connection, client):
+    """Async counterpart of fetch_client_metadata()."""
+    try:
+        sf_an_rows = await db_connection.fetch(SF_AN_SQL)
+        ay_rows = await db_connection.fetch(AY_START_END_SQL)
+        return metadata_entry(sf_an_rows, ay_rows)
+    except Exception as err:
+        print(f"ERROR: metadata lookup failed for {client}: {err}")
+        return None
+
+
+async def run_feature_query(db_connection, query, timer):
+    fetch_mode = query['options']['fetch_mode']
+    if fetch_mode == 'stream':
+        return await stream_data(db_connection, query, timer)
+    if fetch_mode == 'copy':
+        return await copy_data(db_connection, query, timer)
+    return await fetch_data(db_connection, query, timer)
+
+
+async def fetch_data(db_connection, query, timer):
+    client = query['client']
+
+    try:
+        with timer.phase('execute'):
+            statement = await db_connection.prepare(query['sql'])
+        colnames = [attribute.name for attribute in statement.get_attributes()]
+        type_oids = [attribute.type.oid for attribute in statement.get_attributes()]
+        # the extended protocol executes and transfers in one round trip
+        with timer.phase('fetch'):
+            sql_results = await statement.fetch()
+    except Exception as err:
+        print(f"ERROR ({client}): ", err)
+        raise
+
+    print(f"Got results for {client} ({len(sql_results)})")
+
+    with timer.phase('write'):
+        writer = open_query_writer(query)
+        writer.write_header(colnames, type_oids)
+        await asyncio.to_thread(writer.write_rows, sql_results)
+        await asyncio.to_thread(writer.close)
+    timer.wrote(writer)
+    return writer.row_count
+
+
+async def stream_data(db_connection, query, timer):
+    """Async counterpart of stream_data(): fetch through a server-side cursor in batches."""
+    client = query['client']
+    batch_size = query['options']['batch_size']
+    writer = open_query_writer(query)
+
+    try:
+        async with db_connection.transaction():
+            statement = await db_connection.prepare(query['sql'])
+            attributes = statement.get_attributes()
+            writer.write_header(
+                [attribute.name for attribute in attributes], [attribute.type.oid for attribute in attributes]
+            )
+            with timer.phase('execute'):
+                cursor = await statement.cursor()
+                sql_results = await cursor.fetch(batch_size)
+            while sql_results:
+                with timer.phase('write'):
+                    await asyncio.to_thread(writer.write_rows, sql_results)
+                with timer.phase('fetch'):
+                    sql_results = await cursor.fetch(batch_size)
+    except Exception as err:
+        print(f"ERROR ({client}): ", err)
+        writer.discard()
+        raise
+
+    print(f"Got results for {client} ({writer.row_count})")
+    with timer.phase('write'):
+        await asyncio.to_thread(writer.close)
+    timer.wrote(writer)
+    return writer.row_count
+
+
+async def copy_data(db_connection, query, timer):
+    """Async counterpart of copy_data(): COPY (query) TO STDOUT straight into the shard."""
+    client = query['client']
+    writer = open_query_writer(query)
+    sink = None
+
+    async def write_chunk(chunk):
+        sink.buffer.write(chunk)
+
+    try:
+        colnames = type_oids = None
+        if query['options']['output_format'] == 'parquet':
+            # COPY has no column types; preparing the query gives them without running it
+            with timer.phase('execute'):
+                attributes = (await db_connection.prepare(query['sql'])).get_attributes()
+            colnames = [attribute.name for attribute in attributes]
+            type_oids = [attribute.type.oid for attribute in attributes]
+        sink = writer.csv_sink(colnames, type_oids)
+        with timer.phase('fetch'):
+            status = await db_connection.copy_from_query(
+                client_export_sql(query['sql'], client),
+                output = write_chunk,
+                format = 'csv',
+                header = True
+            )
+    except Exception as err:
+        print(f"ERROR ({client}): ", err)
+        writer.discard()
+        raise
+
+    writer.row_count = int(status.split()[-1])
+    print(f"Got results for {client} ({writer.row_count})")
+    with timer.phase('write'):
+        await asyncio.to_thread(writer.close)
+    timer.wrote(writer)
+    return writer.row_count
+
+
+async def get_all_data(pending_queries, max_in_flight, max_per_server, checkpoint = None, checkpoint_seconds = 60):
+    from multiprocessing_script_to_generate_additional_features import failed_result
+
+    scheduler = ServerAwareScheduler(
+        pending_queries,
+        server_of = lambda query: query['server_no'],
+        max_in_flight = max_in_flight,
+        max_per_server = max_per_server,
+        priority_of = job_priority
+    )
+
+    running = {}
+    progress = ExtractionProgress([query['client'] for query in pending_queries])
+    last_checkpoint = time.time()
+    while not scheduler.is_done():
+        query = scheduler.next_item()
+        while query is not None:
+            running[asyncio.ensure_future(get_data(query))] = query
+            query = scheduler.next_item()
+
+        finished, _ = await asyncio.wait(running, return_when = asyncio.FIRST_COMPLETED)
+        for task in finished:
+            query = running.pop(task)
+            try:
+                client, *result = task.result()
+            except Exception as err:
+                # e.g. closing the connection failed; the other clients carry on
+                client, result = query['client'], failed_result(query, err)
+            scheduler.task_done(query, [total_seconds(record) for record in result[2]])
+            progress.client_done(client, *result)
+
+        if checkpoint and time.time() - last_checkpoint > checkpoint_seconds:
+            # the manifests are small, but writing them is still blocking file io
+            await asyncio.to_thread(checkpoint, progress)
+            last_checkpoint = time.time()
+
+    if checkpoint:
+        checkpoint(progress)
+    return progress
+
+
+def run_async_extraction(pending_queries, max_in_flight = 200, max_per_server = 8, checkpoint = None,
+                         checkpoint_seconds = 60):
+    """
+    Run every work item (one per client, built by main()) from one process.
+
+    max_in_flight caps the number of open client DB connections across the whole fleet and
+    max_per_server the number open against any one server (see ServerAwareScheduler).
+    checkpoint(progress) is called every checkpoint_seconds and once at the end.
+    Returns the run's ExtractionProgress (row counts, failures and timings per client).
+    """
+    return asyncio.run(get_all_data(pending_queries, max_in_flight, max_per_server, checkpoint, checkpoint_seconds))
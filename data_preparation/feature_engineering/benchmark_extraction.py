@@ -0,0 +1,123 @@
+"""
+Benchmark the feature extraction against a local fake fleet (see fake_fleet.py), so changes to
+the engines, fetch modes and output formats can be compared offline and repeatably.
+
+    python benchmark_extraction.py --engine async --fetch-mode stream --servers 8 --clients-per-server 50
+
+runs main() in a scratch directory against servers x clients fake client DBs and prints (and
+writes to benchmark_results.json there) the throughput, the p50 / p99 seconds per client and
+the peak memory of the run.  The pool engine's workers are separate processes, so their peak
+is reported apart (max_child_rss_mb, the largest worker).
+"""
+
+import argparse
+import json
+import os
+import resource
+import tempfile
+import time
+import tracemalloc
+from collections import defaultdict
+from extraction_common import FAKE_FLEET_ENV
+from extraction_metrics import percentile, total_seconds
+from fake_fleet import FLEET_DEFAULTS
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--features', nargs = '+', default = ['reports'])
+    parser.add_argument('--engine', choices = ['pool', 'async'], default = 'pool')
+    parser.add_argument('--fetch-mode', choices = ['fetchall', 'stream', 'copy'], default = 'fetchall')
+    parser.add_argument('--output-format', choices = ['csv', 'parquet'], default = 'csv')
+    parser.add_argument('--batch-size', type = int, default = 10000)
+    parser.add_argument('--max-in-flight', type = int, default = 200)
+    parser.add_argument('--max-per-server', type = int, default = None)
+    parser.add_argument('--chunk-months', type = int, default = None)
+    parser.add_argument('--chunk-above-seconds', type = float, default = 120)
+    for name, default in FLEET_DEFAULTS.items():
+        if name != 'slow_servers':
+            parser.add_argument(f"--{name.replace('_', '-')}", type = type(default), default = default)
+    parser.add_argument('--slow-servers', default = '{}', help = 'JSON object of server_no -> latency multiplier')
+    parser.add_argument('--workdir', help = 'scratch directory (default: a new temp directory)')
+    parser.add_argument('--tracemalloc', action = 'store_true',
+                        help = "also trace the python heap of this process (slows the run down)")
+    return parser.parse_args()
+
+
+def fleet_from_args(args):
+    fleet = {name: getattr(args, name) for name in FLEET_DEFAULTS if name != 'slow_servers'}
+    fleet['slow_servers'] = json.loads(args.slow_servers)
+    return fleet
+
+
+def summarize(progress, fleet, wall_seconds):
+    client_seconds = defaultdict(float)
+    for record in progress.timings:
+        client_seconds[record['client']] += total_seconds(record)
+    seconds = list(client_seconds.values())
+    rows = sum(record['rows'] for record in progress.timings)
+
+    return {
+        'fleet': fleet,
+        'clients': len(progress.results),
+        'failed_clients': len(progress.failures),
+        'rows': rows,
+        'bytes': sum(record['bytes'] for record in progress.timings),
+        'wall_seconds': wall_seconds,
+        'clients_per_second': len(progress.results) / wall_seconds,
+        'rows_per_second': rows / wall_seconds,
+        'p50_client_seconds': percentile(seconds, 0.5),
+        'p99_client_seconds': percentile(seconds, 0.99),
+        # ru_maxrss is in kilobytes on linux
+        'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'max_child_rss_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    }
+
+
+def run_benchmark(args):
+    fleet = fleet_from_args(args)
+    os.environ[FAKE_FLEET_ENV] = json.dumps(fleet)
+    workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix = 'extraction_benchmark_'))
+    os.makedirs(workdir, exist_ok = True)
+    # shards, caches and reports are written relative to the working directory
+    os.chdir(workdir)
+
+    import multiprocessing_script_to_generate_additional_features as extraction
+    extraction.SHARD_ROOT = workdir
+    for feature in args.features:
+        os.makedirs(extraction.query_info[feature]['folder_name'], exist_ok = True)
+
+    if args.tracemalloc:
+        tracemalloc.start()
+    started = time.perf_counter()
+    progress = extraction.main(
+        args.features,
+        engine = args.engine,
+        max_in_flight = args.max_in_flight,
+        max_per_server = args.max_per_server,
+        fetch_mode = args.fetch_mode,
+        batch_size = args.batch_size,
+        output_format = args.output_format,
+        chunk_months = args.chunk_months,
+        chunk_above_seconds = args.chunk_above_seconds
+    )
+    summary = summarize(progress, fleet, time.perf_counter() - started)
+    summary.update({
+        'engine': args.engine,
+        'fetch_mode': args.fetch_mode,
+        'output_format': args.output_format,
+        'chunk_months': args.chunk_months,
+        'features': args.features,
+        'workdir': workdir
+    })
+    if args.tracemalloc:
+        summary['python_peak_mb'] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        tracemalloc.stop()
+
+    with open('benchmark_results.json', 'w') as file:
+        json.dump(summary, file, indent = 1)
+    return summary
+
+
+if __name__ == '__main__':
+    print(json.dumps(run_benchmark(parse_args()), indent = 1))
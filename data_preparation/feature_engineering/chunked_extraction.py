@@ -0,0 +1,85 @@
+"""
+Month-range chunks for the largest clients' feature queries.
+
+A chunked feature query is split into consecutive month ranges (see main(chunk_months = ...)).
+Each chunk is its own work item, run on its own connection alongside the rest of the fleet, and
+writes a part file next to the client's shard.  Once the run is over the parts are stitched in
+month order into the shard (or, for an incremental run, its delta file), so the output is the
+same as from one query.
+
+Every chunk after the first queries its feature's lookback_months ahead of its range and
+filters them out again (see feature_sql()), so rolling and per academic year cumulative columns
+come out the same as in the unchunked query.
+"""
+
+import csv
+import os
+from extraction_common import delta_path, shard_path
+from incremental_extraction import add_months
+
+
+def month_chunks(first_month, last_month, chunk_months):
+    """Consecutive (first, last) month ranges of at most chunk_months covering first_month..last_month."""
+    chunks = []
+    chunk_first = first_month
+    while chunk_first <= last_month:
+        chunk_last = min(add_months(chunk_first, chunk_months - 1), last_month)
+        chunks.append((chunk_first, chunk_last))
+        chunk_first = add_months(chunk_last, 1)
+    return chunks
+
+
+def part_path(folder_name, client, output_format, part):
+    """part is the first month of the chunk."""
+    return f'{shard_path(folder_name, client, output_format)}.part{part.isoformat()[:7]}'
+
+
+def stitch_target(query):
+    options = query['options']
+    if options['incremental']:
+        return delta_path(query['folder_name'], query['client'], options['output_format'])
+    return shard_path(query['folder_name'], query['client'], options['output_format'])
+
+
+def stitch_parts(query, parts):
+    """
+    Concatenate the part files of a chunked feature query (parts: the chunks' first months) into
+    its shard or delta file and remove them.  Returns the number of rows.
+    """
+    output_format = query['options']['output_format']
+    paths = [part_path(query['folder_name'], query['client'], output_format, part) for part in sorted(parts)]
+    target = stitch_target(query)
+    tmp_path = f'{target}.tmp'
+
+    if output_format == 'parquet':
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        from parquet_shards import COMPRESSION
+        table = pa.concat_tables([pq.read_table(path) for path in paths], promote_options = 'permissive')
+        pq.write_table(table, tmp_path, compression = COMPRESSION)
+        row_count = table.num_rows
+    else:
+        row_count = 0
+        with open(tmp_path, 'w') as out_file:
+            wtr = csv.writer(out_file, delimiter = ',', lineterminator = '\n')
+            for index, path in enumerate(paths):
+                with open(path, newline = '') as part_file:
+                    part_rows = csv.reader(part_file)
+                    header = next(part_rows)
+                    if index == 0:
+                        wtr.writerow(header)
+                    for row in part_rows:
+                        wtr.writerow(row)
+                        row_count += 1
+
+    os.replace(tmp_path, target)
+    discard_parts(query, parts)
+    return row_count
+
+
+def discard_parts(query, parts):
+    output_format = query['options']['output_format']
+    for part in parts:
+        path = part_path(query['folder_name'], query['client'], output_format, part)
+        if os.path.exists(path):
+            os.remove(path)
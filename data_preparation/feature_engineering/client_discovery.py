@@ -0,0 +1,85 @@
+"""
+Discovery of the client DBs on each server.
+
+The pg_database listing of every server is fetched concurrently (one thread per server, the time
+is all spent waiting on connections) and cached in _client_dbs_cache.json for ttl_seconds, so a
+rerun queues its first query without touching every server's catalog again.
+
+Which databases are not client DBs (templates, demos, backups, ...) is configured in
+client_db_exclusions.json and compiled into a single regex.  The cache holds the raw listing, so
+an edited rule set applies without refreshing it.
+"""
+
+import json
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+EXCLUSIONS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'client_db_exclusions.json')
+CACHE_PATH = '_client_dbs_cache.json'
+CACHE_TTL_SECONDS = 24 * 60 * 60
+
+
+def load_exclusion_rules(path = EXCLUSIONS_PATH):
+    """
+    Compile the exclusion config into one regex: a database is excluded if its name equals one
+    of the 'exact' names, starts with one of the 'prefixes' or contains one of the 'substrings'.
+    """
+    with open(path) as file:
+        rules = json.load(file)
+
+    alternatives = [f"^{re.escape(name)}$" for name in rules.get('exact', [])]
+    alternatives += [f"^{re.escape(prefix)}" for prefix in rules.get('prefixes', [])]
+    alternatives += [re.escape(substring) for substring in rules.get('substrings', [])]
+    return re.compile('|'.join(alternatives))
+
+
+def client_dbs(list_of_dbs, exclusion_rules):
+    return [db for db in list_of_dbs if not exclusion_rules.search(db)]
+
+
+def load_cache(path = CACHE_PATH):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as file:
+        return json.load(file)
+
+
+def save_cache(cache, path = CACHE_PATH):
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as file:
+        json.dump(cache, file, indent = 1, sort_keys = True)
+    os.replace(tmp_path, path)
+
+
+def discover_dbs(servers, list_dbs, refresh = False, ttl_seconds = CACHE_TTL_SECONDS, max_workers = 16,
+                 cache_path = CACHE_PATH):
+    """
+    Return {server: {database name: size in bytes}} for servers, listing them with list_dbs(server)
+    (e.g. get_list_of_dbs) only for servers with no cached listing younger than ttl_seconds, or for
+    every server with refresh = True.
+
+    A server that could not be listed (list_dbs returned nothing) keeps its previous listing, if
+    it has one, or gets an empty listing; either way it is listed again on the next run.
+    """
+    cache = load_cache(cache_path)
+    now = time.time()
+    stale_servers = [
+        server for server in servers
+        if refresh or server not in cache or now - cache[server]['fetched_at'] > ttl_seconds
+        # listings cached before the sizes were recorded
+        or not isinstance(cache[server]['databases'], dict)
+    ]
+    print(f"listing dbs on {len(stale_servers)} servers ({len(servers) - len(stale_servers)} cached)")
+
+    if stale_servers:
+        with ThreadPoolExecutor(max_workers = max_workers) as executor:
+            listings = executor.map(list_dbs, stale_servers)
+            for server, list_of_dbs in zip(stale_servers, listings):
+                if list_of_dbs:
+                    cache[server] = {'fetched_at': now, 'databases': list_of_dbs}
+        save_cache(cache, cache_path)
+
+    return {server: cache[server]['databases'] if server in cache else {} for server in servers}
@@ -0,0 +1,107 @@
+"""
+Per-client metadata shared by the feature queries: the Salesforce account number (sf_an) and
+the academic year boundaries (ay_start_end).
+
+The query_info queries have {sf_an} and {ay_start_end} placeholders for the bodies of those
+CTEs.  get_data() resolves both once per client connection (instead of once per feature query)
+and renders them into every feature query as literals; the values are cached in
+_client_metadata.json for CACHE_TTL_SECONDS, so later runs skip the config.definitions /
+config.entries and session_dates lookups altogether.  Without a value (the lookup failed) the
+placeholders get the lookups themselves, as the queries had them inline.
+"""
+
+import json
+import os
+import time
+from extraction_common import sql_literal
+
+
+CACHE_PATH = '_client_metadata.json'
+CACHE_TTL_SECONDS = 7 * 24 * 60 * 60
+
+SF_AN_SQL = """
+                SELECT
+                    COALESCE(CASE
+                                 WHEN EXISTS(SELECT definition_id
+                                             FROM config.definitions
+                                             WHERE key ILIKE 'salesforce.account_number')
+                                     THEN (
+                                     SELECT value::text
+                                     FROM config.entries
+                                     WHERE definition_id = (
+                                         SELECT definition_id
+                                         FROM config.definitions
+                                         WHERE key ILIKE 'salesforce.account_number'
+                                     )
+                                 )
+                                 END, 'none'::text) AS sf_an
+"""
+
+AY_START_END_SQL = """
+                SELECT
+                    academic_year,
+                    MIN(start_date) AS start_date,
+                    MAX(end_date) AS end_date
+                FROM session_dates
+                GROUP BY academic_year
+"""
+
+
+def load_metadata_cache(path = CACHE_PATH):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as file:
+        return json.load(file)
+
+
+def save_metadata_cache(cache, path = CACHE_PATH):
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as file:
+        json.dump(cache, file, indent = 1, sort_keys = True)
+    os.replace(tmp_path, path)
+
+
+def cached_metadata(cache, client, refresh = False, ttl_seconds = CACHE_TTL_SECONDS):
+    """The client's cached metadata, or None if there is none (or it is stale, or refresh)."""
+    entry = cache.get(client)
+    if refresh or entry is None or time.time() - entry['fetched_at'] > ttl_seconds:
+        return None
+    return entry
+
+
+def metadata_entry(sf_an_rows, ay_rows):
+    """Cache entry from the rows of SF_AN_SQL and AY_START_END_SQL."""
+    return {
+        'sf_an': sf_an_rows[0][0],
+        'academic_years': [
+            [academic_year, start_date.isoformat(), end_date.isoformat()]
+            for academic_year, start_date, end_date in ay_rows
+            if start_date is not None and end_date is not None
+        ],
+        'fetched_at': time.time()
+    }
+
+
+def sf_an_sql(metadata):
+    if metadata is None:
+        return SF_AN_SQL
+    return f"SELECT {sql_literal(metadata['sf_an'])}::text AS sf_an"
+
+
+def ay_start_end_sql(metadata):
+    if metadata is None:
+        return AY_START_END_SQL
+    if not metadata['academic_years']:
+        return "SELECT NULL::integer AS academic_year, NULL::date AS start_date, NULL::date AS end_date WHERE FALSE"
+
+    values = ', '.join(
+        f"({academic_year if isinstance(academic_year, int) else sql_literal(academic_year)}, "
+        f"'{start_date}'::date, '{end_date}'::date)"
+        for academic_year, start_date, end_date in metadata['academic_years']
+    )
+    return f"SELECT * FROM (VALUES {values}) AS ay (academic_year, start_date, end_date)"
+
+
+def render_client_metadata(sql, metadata):
+    sql = sql.replace('{sf_an}', sf_an_sql(metadata))
+    return sql.replace('{ay_start_end}', ay_start_end_sql(metadata))
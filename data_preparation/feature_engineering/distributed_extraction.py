@@ -0,0 +1,285 @@
+"""
+Coordinator / worker mode of the feature extraction, to spread the fleet over several hosts.
+
+One host can only hold so many client DB connections and shards in flight.  With
+main(engine = 'distributed') the coordinator plans the run as usual (discovery, manifests,
+priorities, chunks), then serves the work items on a task queue at coordinator_address
+(a multiprocessing manager, so nothing beyond the standard library).  Any number of workers
+connect to it, each running get_data() on its own pool of spawned processes, and put their
+results back on a result queue:
+
+    python distributed_extraction.py coordinator --features reports system_admin --listen 0.0.0.0:50000
+    python distributed_extraction.py worker --coordinator extraction-host:50000 --processes 16
+
+Both sides take the manager's authkey from FEATURE_EXTRACTION_AUTHKEY, which must be set.
+Workers write shards relative to their working directory, so they must be started in (a mount
+of) the coordinator's shard directory.
+
+The coordinator keeps the ServerAwareScheduler, so the per-server caps hold across all workers.
+It records every completed client's shard in the manifests every checkpoint_seconds, so a
+coordinator that dies loses no more than that.  Workers send a heartbeat with the tasks they are
+running; the tasks of a worker that has been silent for worker_timeout seconds are queued again
+(a late result for a task that finished elsewhere is ignored, and each copy of a task writes
+its own in-progress file, so two copies running at once never write over each other).  A task that was taken off the
+queue but never shows up in a heartbeat (its worker died in between) is queued again once it
+has gone unclaimed for claim_timeout seconds with the queue empty, and the coordinator warns every worker_timeout seconds
+while no worker is connected.
+"""
+
+import argparse
+import multiprocessing as mp
+import os
+import queue
+import socket
+import threading
+import time
+from multiprocessing.managers import BaseManager
+from extraction_common import ExtractionProgress
+from extraction_metrics import total_seconds
+from extraction_scheduler import ServerAwareScheduler
+from runtime_history import job_priority
+
+
+AUTHKEY_ENV = 'FEATURE_EXTRACTION_AUTHKEY'
+
+
+class ExtractionManager(BaseManager):
+    pass
+
+
+def authkey():
+    # the manager unpickles what it is sent, so it must not be left open with a well known key
+    if not os.environ.get(AUTHKEY_ENV):
+        raise RuntimeError(f'set {AUTHKEY_ENV} to the shared secret of the coordinator and its workers')
+    return os.environ[AUTHKEY_ENV].encode()
+
+
+def serve_queues(address):
+    """Serve a task and a result queue at address from a thread of this process."""
+    tasks = queue.Queue()
+    results = queue.Queue()
+    ExtractionManager.register('tasks', callable = lambda: tasks)
+    ExtractionManager.register('results', callable = lambda: results)
+    server = ExtractionManager(address = address, authkey = authkey()).get_server()
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    return tasks, results
+
+
+def run_coordinator(pending_queries, address, max_in_flight = 200, max_per_server = 8, checkpoint = None,
+                    checkpoint_seconds = 60, worker_timeout = 120, claim_timeout = 60):
+    """
+    Hand the work items (built by main()) to the workers connected at address and collect their
+    results.  checkpoint(progress) is called every checkpoint_seconds and once at the end.
+    Returns the run's ExtractionProgress (row counts, failures and timings per client).
+    """
+    from multiprocessing_script_to_generate_additional_features import failed_result
+
+    tasks, results = serve_queues(address)
+    print(f"serving {len(pending_queries)} work items at {address[0] or '*'}:{address[1]}")
+    scheduler = ServerAwareScheduler(
+        pending_queries,
+        server_of = lambda query: query['server_no'],
+        max_in_flight = max_in_flight,
+        max_per_server = max_per_server,
+        priority_of = job_priority
+    )
+    task_ids = {id(query): task_id for task_id, query in enumerate(pending_queries)}
+    dispatched = {}
+    unclaimed_since = {}
+    workers = {}
+    progress = ExtractionProgress([query['client'] for query in pending_queries])
+    last_checkpoint = time.time()
+    last_worker_seen = last_warning = time.time()
+
+    def queue_task(task_id):
+        unclaimed_since.pop(task_id, None)
+        tasks.put((task_id, dispatched[task_id]))
+
+    def drop_queued_copy(task_id):
+        # a requeued task still waiting on the queue needn't run again once one copy has finished
+        with tasks.mutex:
+            for item in [item for item in tasks.queue if item is not None and item[0] == task_id]:
+                tasks.queue.remove(item)
+
+    def dispatch_ready_queries():
+        query = scheduler.next_item()
+        while query is not None:
+            dispatched[task_ids[id(query)]] = query
+            queue_task(task_ids[id(query)])
+            query = scheduler.next_item()
+
+    dispatch_ready_queries()
+    while not scheduler.is_done():
+        try:
+            message = results.get(timeout = 5)
+        except queue.Empty:
+            message = None
+
+        if message is not None:
+            kind, worker_id, payload = message
+            if kind == 'heartbeat':
+                if worker_id not in workers:
+                    print(f"worker {worker_id} joined")
+                workers[worker_id] = (time.time(), payload)
+            elif payload[0] not in dispatched:
+                # a requeued task that also finished on its first worker; its shard is already in place
+                print(f"ignoring a second result for task {payload[0]} from worker {worker_id}")
+            else:
+                task_id, result = payload
+                query = dispatched.pop(task_id)
+                unclaimed_since.pop(task_id, None)
+                drop_queued_copy(task_id)
+                if isinstance(result, BaseException):
+                    result = failed_result(query, result)
+                scheduler.task_done(query, [total_seconds(record) for record in result[2]])
+                progress.client_done(query['client'], *result)
+
+        for worker_id, (last_seen, running) in list(workers.items()):
+            if time.time() - last_seen > worker_timeout:
+                lost = [task_id for task_id in running if task_id in dispatched]
+                print(f"worker {worker_id} is gone, queueing its {len(lost)} tasks again")
+                for task_id in lost:
+                    queue_task(task_id)
+                del workers[worker_id]
+
+        # with nothing left on the queue, a task that no worker claims was taken by one that died
+        if tasks.empty():
+            claimed = {task_id for _, running in workers.values() for task_id in running}
+            for task_id in [task_id for task_id in dispatched if task_id not in claimed]:
+                if time.time() - unclaimed_since.setdefault(task_id, time.time()) > claim_timeout:
+                    print(f"task {task_id} ({dispatched[task_id]['client']}) was never claimed, queueing it again")
+                    queue_task(task_id)
+            for task_id in claimed:
+                unclaimed_since.pop(task_id, None)
+        else:
+            unclaimed_since.clear()
+
+        if workers:
+            last_worker_seen = time.time()
+        elif time.time() - max(last_worker_seen, last_warning) > worker_timeout:
+            print(f"WARNING: no worker connected for {time.time() - last_worker_seen:.0f}s, "
+                  f"{len(dispatched)} tasks waiting at {address[0] or '*'}:{address[1]}")
+            last_warning = time.time()
+
+        if checkpoint and time.time() - last_checkpoint > checkpoint_seconds:
+            checkpoint(progress)
+            last_checkpoint = time.time()
+        dispatch_ready_queries()
+
+    for _ in workers:
+        tasks.put(None)
+    if checkpoint:
+        checkpoint(progress)
+    return progress
+
+
+def run_worker(address, processes = 16, heartbeat_seconds = 10):
+    """
+    Run the coordinator's tasks on a pool of spawned processes until it sends the stop signal or
+    goes away.
+    """
+    from multiprocessing_script_to_generate_additional_features import get_data
+
+    ExtractionManager.register('tasks')
+    ExtractionManager.register('results')
+    manager = ExtractionManager(address = address, authkey = authkey())
+    manager.connect()
+    tasks = manager.tasks()
+    results = manager.results()
+    worker_id = f'{socket.gethostname()}:{os.getpid()}'
+    print(f"worker {worker_id} connected to {address[0]}:{address[1]}")
+
+    query_pool = mp.get_context("spawn").Pool(processes = processes)
+    slots = threading.Semaphore(processes)
+    running = {}
+    running_lock = threading.Lock()
+
+    def heartbeat():
+        with running_lock:
+            task_ids = list(running)
+        results.put(('heartbeat', worker_id, task_ids))
+
+    def on_finished(task_id):
+        # called on the pool's result handler thread
+        def callback(result):
+            if isinstance(result, BaseException):
+                # driver errors don't necessarily unpickle on the coordinator
+                result = RuntimeError(f'{type(result).__name__}: {result}')
+            results.put(('result', worker_id, (task_id, result)))
+            with running_lock:
+                running.pop(task_id, None)
+            slots.release()
+        return callback
+
+    last_heartbeat = 0
+    try:
+        while True:
+            if time.time() - last_heartbeat > heartbeat_seconds:
+                heartbeat()
+                last_heartbeat = time.time()
+            if not slots.acquire(timeout = 1):
+                continue
+            try:
+                task = tasks.get(timeout = 1)
+            except queue.Empty:
+                slots.release()
+                continue
+            if task is None:
+                break
+            task_id, work_item = task
+            with running_lock:
+                running[task_id] = work_item['client']
+            # claim the task right away, so it is queued again if this host dies
+            heartbeat()
+            last_heartbeat = time.time()
+            finished = on_finished(task_id)
+            query_pool.apply_async(get_data, (work_item,), callback = finished, error_callback = finished)
+    except (EOFError, ConnectionError):
+        print("coordinator went away")
+
+    query_pool.close()
+    query_pool.join()
+
+
+def parse_address(address):
+    host, port = address.rsplit(':', 1)
+    return host, int(port)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    modes = parser.add_subparsers(dest = 'mode', required = True)
+
+    coordinator = modes.add_parser('coordinator')
+    coordinator.add_argument('--listen', default = '0.0.0.0:50000')
+    coordinator.add_argument('--features', nargs = '+')
+    coordinator.add_argument('--max-in-flight', type = int, default = 200)
+    coordinator.add_argument('--max-per-server', type = int, default = None)
+    coordinator.add_argument('--fetch-mode', choices = ['fetchall', 'stream', 'copy'], default = 'fetchall')
+    coordinator.add_argument('--output-format', choices = ['csv', 'parquet'], default = 'csv')
+    coordinator.add_argument('--incremental', action = 'store_true')
+    coordinator.add_argument('--chunk-months', type = int, default = None)
+
+    worker = modes.add_parser('worker')
+    worker.add_argument('--coordinator', required = True, help = 'host:port of the coordinator')
+    worker.add_argument('--processes', type = int, default = 16)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.mode == 'worker':
+        run_worker(parse_address(args.coordinator), processes = args.processes)
+    else:
+        from multiprocessing_script_to_generate_additional_features import main, query_info
+        main(
+            args.features or list(query_info),
+            engine = 'distributed',
+            coordinator_address = parse_address(args.listen),
+            max_in_flight = args.max_in_flight,
+            max_per_server = args.max_per_server,
+            fetch_mode = args.fetch_mode,
+            output_format = args.output_format,
+            incremental = args.incremental,
+            chunk_months = args.chunk_months
+        )
@@ -0,0 +1,212 @@
+"""
+Connection settings and shard-writing helpers shared by the feature extraction engines.
+
+Every engine (multiprocessing pool, asyncio) connects to the client DBs with the same
+credentials and writes the same per-client shards (csv here, parquet in parquet_shards.py), so
+both live here.
+"""
+
+import csv
+import json
+import os
+import uuid
+from collections import Counter
+
+
+DB_USER = "phppgadmin"
+DB_PASSWORD = "_REMOVED_"
+STATEMENT_TIMEOUT_MS = 300000
+# benchmark runs connect to an in-process fake fleet instead (see fake_fleet.py)
+FAKE_FLEET_ENV = 'FEATURE_EXTRACTION_FAKE_FLEET'
+
+
+def server_host(server_no):
+    return f"10.21.0.1{server_no}"
+
+
+def connection_settings(server_no, client):
+    return {
+        'host': server_host(server_no),
+        'database': client,
+        'user': DB_USER,
+        'password': DB_PASSWORD
+    }
+
+
+def sql_literal(value):
+    """Quote a python string as a SQL string literal (standard_conforming_strings is on)."""
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def sql_identifier(name):
+    """Quote a python string as a SQL identifier (e.g. a column name from a shard header)."""
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+def postgres_text(value):
+    """
+    value as Postgres writes it in csv (t/f booleans, {a,b} arrays, json), for the values whose
+    python str() COPY ... FROM wouldn't read back; anything else is returned as is.
+    """
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, list):
+        return '{' + ','.join(array_element(element) for element in value) + '}'
+    if isinstance(value, dict):
+        return json.dumps(value)
+    return value
+
+
+def array_element(value):
+    if value is None:
+        return 'NULL'
+    text = str(postgres_text(value))
+    if isinstance(value, list):
+        return text
+    if text == '' or text.upper() == 'NULL' or any(char in text for char in '{},"\\ \t\n'):
+        return '"' + text.replace('\\', '\\\\').replace('"', '\\"') + '"'
+    return text
+
+
+def client_export_sql(sql, client):
+    """Wrap a feature query so the client column is added server side."""
+    feature_sql = sql.strip().rstrip(';')
+    return f"SELECT {sql_literal(client)} AS client, feature_rows.* FROM ({feature_sql}) feature_rows"
+
+
+def describe_sql(sql):
+    """The feature query without its rows: only planned, for the column names and type oids a COPY doesn't give."""
+    feature_sql = sql.strip().rstrip(';')
+    return f"SELECT * FROM ({feature_sql}) feature_rows LIMIT 0"
+
+
+def copy_export_sql(sql, client):
+    """
+    Wrap a feature query in COPY ... TO STDOUT so the client DB serializes the csv itself.
+
+    Values come out in Postgres' csv text format (e.g. t/f booleans and {a,b} arrays) rather than
+    python's str() of the fetched objects.
+    """
+    return f"COPY ({client_export_sql(sql, client)}) TO STDOUT WITH CSV HEADER"
+
+
+def shard_path(folder_name, client, output_format = 'csv'):
+    return f'{folder_name}/{client}_{folder_name}.{output_format}'
+
+
+def delta_path(folder_name, client, output_format = 'csv'):
+    """Incremental runs write new months here first, then splice them into the shard."""
+    return f'{shard_path(folder_name, client, output_format)}.delta'
+
+
+def in_progress_path(path):
+    """
+    Where a shard (or delta / part file) is written until it is complete.  Unique per writer: a
+    requeued work item can run on two workers at once (see distributed_extraction.py), and each
+    must write its own file, so the last to finish replaces the shard with a complete one.
+    """
+    return f'{path}.{os.getpid()}.{uuid.uuid4().hex[:8]}.inprogress'
+
+
+def open_query_writer(query):
+    """Shard writer for one work item of a run (see main() for the query dict)."""
+    options = query['options']
+    path = None
+    if query.get('part') is not None:
+        # a month-range chunk, stitched into the shard after the run (see chunked_extraction.py)
+        from chunked_extraction import part_path
+        path = part_path(query['folder_name'], query['client'], options['output_format'], query['part'])
+    elif options['incremental']:
+        path = delta_path(query['folder_name'], query['client'], options['output_format'])
+    return open_shard_writer(query['folder_name'], query['client'], options['output_format'], path)
+
+
+def open_shard_writer(folder_name, client, output_format = 'csv', path = None):
+    """path overrides the shard's usual location (e.g. the delta file of an incremental run)."""
+    if output_format == 'parquet':
+        # pyarrow is only needed for parquet output
+        from parquet_shards import ParquetShardWriter
+        return ParquetShardWriter(folder_name, client, path)
+    return ClientShardWriter(folder_name, client, path)
+
+
+class ClientShardWriter:
+    """
+    Writes one client's query results to its csv shard, with the client name as the first column.
+
+    Rows can be written in batches as they are fetched, so a streaming fetch never has to hold a
+    whole result set in memory.  They go to a temp file that only replaces the shard on close(),
+    so a shard is either complete or not there (see run_manifest.py).
+    """
+
+    def __init__(self, folder_name, client, path = None):
+        self.client = client
+        self.path = path or shard_path(folder_name, client)
+        self.tmp_path = in_progress_path(self.path)
+        self.file = open(self.tmp_path, 'w')
+        self.wtr = csv.writer(self.file, delimiter = ',', lineterminator = '\n')
+        self.row_count = 0
+
+    def write_header(self, colnames, type_oids = None):
+        self.wtr.writerow(['client'] + list(colnames))
+
+    def write_rows(self, rows):
+        # in the text format of a COPY export, so the loader can COPY every csv shard as is
+        self.wtr.writerows([self.client] + [postgres_text(value) for value in row] for row in rows)
+        self.row_count += len(rows)
+
+    def csv_sink(self, colnames = None, type_oids = None):
+        """
+        File that a COPY ... TO STDOUT WITH CSV HEADER export (client column included) is written to.
+        The export has its own header, so the column names and types aren't needed.
+        """
+        return self.file
+
+    def close(self):
+        self.file.close()
+        os.replace(self.tmp_path, self.path)
+        return self.row_count
+
+    def discard(self):
+        """Drop a partially written shard so the client is picked up again on the next run."""
+        self.file.close()
+        os.remove(self.tmp_path)
+
+
+class ExtractionProgress:
+    """
+    Row counts, failures, timings, client metadata and remaining clients of a run, updated by an
+    engine as each work item finishes.  A client split into several work items (month-range chunks) is done once
+    all of them are; the row counts of its chunks add up per feature.
+
+    The number of remaining clients is printed on every completion, and their names every
+    list_every completions and once list_below or fewer are left.
+    """
+
+    def __init__(self, clients, list_every = 50, list_below = 10):
+        self.remaining = Counter(clients)
+        self.results = {}
+        self.failures = {}
+        self.timings = []
+        self.metadata = {}
+        self.completed = 0
+        self.list_every = list_every
+        self.list_below = list_below
+
+    def client_done(self, client, row_counts, failures = None, timings = None, metadata = None):
+        client_results = self.results.setdefault(client, {})
+        for feature, row_count in row_counts.items():
+            client_results[feature] = client_results.get(feature, 0) + row_count
+        if failures:
+            self.failures.setdefault(client, {}).update(failures)
+        self.timings.extend(timings or [])
+        if metadata is not None:
+            self.metadata[client] = metadata
+        self.completed += 1
+
+        self.remaining[client] -= 1
+        if self.remaining[client] <= 0:
+            del self.remaining[client]
+        print(f"{len(self.remaining)} remaining...")
+        if self.remaining and (len(self.remaining) <= self.list_below or self.completed % self.list_every == 0):
+            print(sorted(self.remaining))
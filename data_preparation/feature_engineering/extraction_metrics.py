@@ -0,0 +1,171 @@
+"""
+Timings of the feature extraction, per client and feature query, and their export.
+
+Each attempt at a feature query produces one record: the seconds spent connecting (charged to
+the first query run on a connection), executing, fetching and writing the shard, the rows and
+bytes written, and its status ('ok' or the failure kind from extraction_retries.py).  A failed
+connect gets a record of its own, with no feature.  The records travel back with get_data()'s
+results, and at the end of a run main() writes
+
+    _run_report.json            every record, plus per-server latency percentiles and the slowest
+                                clients
+    _extraction_metrics.prom    Prometheus textfile-collector metrics: per-server latency
+                                histograms by phase, rows, bytes and failures
+"""
+
+import json
+import os
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+
+
+PHASES = ('connect', 'execute', 'fetch', 'write')
+HISTOGRAM_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 150, 300, 600)
+METRIC_PREFIX = 'feature_extraction'
+RUN_REPORT_PATH = '_run_report.json'
+PROMETHEUS_PATH = '_extraction_metrics.prom'
+
+
+class QueryTimer:
+    """Accumulates the phase timings of one attempt at one client's feature query."""
+
+    def __init__(self, client, server_no, feature, attempt = 1, connect_seconds = 0.0):
+        self.record = {
+            'client': client,
+            'server_no': server_no,
+            'feature': feature,
+            'attempt': attempt,
+            'status': 'ok',
+            'connect': connect_seconds,
+            'execute': 0.0,
+            'fetch': 0.0,
+            'write': 0.0,
+            'rows': 0,
+            'bytes': 0
+        }
+
+    @contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record[name] += time.perf_counter() - started
+
+    def wrote(self, writer):
+        """Take the row and byte counts of a closed shard writer."""
+        self.record['rows'] = writer.row_count
+        if os.path.exists(writer.path):
+            self.record['bytes'] = os.path.getsize(writer.path)
+
+    def failed(self, kind):
+        self.record['status'] = kind
+
+
+def total_seconds(record):
+    return sum(record[phase] for phase in PHASES)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def write_run_report(records, started, path = RUN_REPORT_PATH, slowest = 25):
+    by_server = defaultdict(list)
+    for record in records:
+        by_server[record['server_no']].append(total_seconds(record))
+
+    client_seconds = defaultdict(float)
+    for record in records:
+        client_seconds[record['client']] += total_seconds(record)
+
+    report = {
+        'started': datetime.fromtimestamp(started).isoformat(timespec = 'seconds'),
+        'finished': datetime.now().isoformat(timespec = 'seconds'),
+        'wall_seconds': time.time() - started,
+        'clients': len(client_seconds),
+        'queries': len(records),
+        'failed_queries': sum(record['status'] != 'ok' for record in records),
+        'rows': sum(record['rows'] for record in records),
+        'bytes': sum(record['bytes'] for record in records),
+        'servers': {
+            server_no: {
+                'queries': len(seconds),
+                'p50_seconds': percentile(seconds, 0.5),
+                'p90_seconds': percentile(seconds, 0.9),
+                'p99_seconds': percentile(seconds, 0.99),
+                'max_seconds': max(seconds),
+                'total_seconds': sum(seconds)
+            }
+            for server_no, seconds in sorted(by_server.items())
+        },
+        'slowest_clients': sorted(client_seconds.items(), key = lambda item: item[1], reverse = True)[:slowest],
+        'records': records
+    }
+
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as file:
+        json.dump(report, file, indent = 1)
+    os.replace(tmp_path, path)
+
+
+def prometheus_labels(**labels):
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels.items()) + '}'
+
+
+def write_prometheus_textfile(records, path = PROMETHEUS_PATH):
+    """Written to a temp file and renamed, as the node exporter's textfile collector expects."""
+    lines = []
+
+    name = f'{METRIC_PREFIX}_phase_seconds'
+    lines.append(f'# HELP {name} Time spent per client feature query, by server and phase.')
+    lines.append(f'# TYPE {name} histogram')
+    series = defaultdict(list)
+    for record in records:
+        for phase in PHASES:
+            series[(record['server_no'], phase)].append(record[phase])
+    for (server_no, phase), seconds in sorted(series.items()):
+        for bucket in HISTOGRAM_BUCKETS:
+            labels = prometheus_labels(server = server_no, phase = phase, le = bucket)
+            lines.append(f'{name}_bucket{labels} {sum(value <= bucket for value in seconds)}')
+        labels = prometheus_labels(server = server_no, phase = phase, le = '+Inf')
+        lines.append(f'{name}_bucket{labels} {len(seconds)}')
+        labels = prometheus_labels(server = server_no, phase = phase)
+        lines.append(f'{name}_sum{labels} {sum(seconds)}')
+        lines.append(f'{name}_count{labels} {len(seconds)}')
+
+    counters = [
+        ('rows_total', 'Rows written, by server and feature.', 'rows'),
+        ('bytes_total', 'Shard bytes written, by server and feature.', 'bytes'),
+    ]
+    for suffix, help_text, field in counters:
+        name = f'{METRIC_PREFIX}_{suffix}'
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} counter')
+        totals = defaultdict(int)
+        # failed connects have no feature (and nothing written)
+        for record in records:
+            if record['feature'] is not None:
+                totals[(record['server_no'], record['feature'])] += record[field]
+        for (server_no, feature), total in sorted(totals.items()):
+            lines.append(f'{name}{prometheus_labels(server = server_no, feature = feature)} {total}')
+
+    name = f'{METRIC_PREFIX}_failures_total'
+    lines.append(f'# HELP {name} Failed query attempts, by server and failure kind.')
+    lines.append(f'# TYPE {name} counter')
+    failures = defaultdict(int)
+    for record in records:
+        if record['status'] != 'ok':
+            failures[(record['server_no'], record['status'])] += 1
+    for (server_no, kind), count in sorted(failures.items()):
+        lines.append(f'{name}{prometheus_labels(server = server_no, kind = kind)} {count}')
+
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as file:
+        file.write('\n'.join(lines) + '\n')
+    os.replace(tmp_path, path)
@@ -0,0 +1,120 @@
+"""
+Failure classification, retries and the failed-client ledger of the feature extraction.
+
+A failed connect or feature query is classified by its SQLSTATE:
+
+    timeout     57014 (query_canceled, i.e. statement_timeout); retried with a doubled timeout
+    transient   connection failures and drops, server shutdowns, out of resources, serialization
+                failures and deadlocks; retried as is
+    permanent   everything else (a missing table or column, a syntax or permission error, ...);
+                not retried
+
+A psycopg2 connect error has no SQLSTATE, so a refused login (bad password, missing role or
+database, no pg_hba.conf entry) is told apart from a network failure by its message.
+
+Retries wait a jittered, exponentially growing delay so the clients of a server that blipped
+don't all come back at the same moment.  Whatever still fails after MAX_ATTEMPTS (and every
+permanent failure) is recorded in _failed_clients.json, which main(failed_only = True) reruns.
+"""
+
+import json
+import os
+import random
+from datetime import datetime
+
+
+MAX_ATTEMPTS = 4
+BACKOFF_BASE_SECONDS = 2
+BACKOFF_CAP_SECONDS = 60
+TIMEOUT_GROWTH = 2
+LEDGER_PATH = '_failed_clients.json'
+
+TIMEOUT = 'timeout'
+TRANSIENT = 'transient'
+PERMANENT = 'permanent'
+
+QUERY_CANCELED = '57014'
+# connection exception, insufficient resources, system error
+TRANSIENT_SQLSTATE_CLASSES = ('08', '53', '58')
+# serialization failure, deadlock, lock not available, admin / crash shutdown, cannot connect now
+TRANSIENT_SQLSTATES = {'40001', '40P01', '55P03', '57P01', '57P02', '57P03'}
+# messages of connect errors without a SQLSTATE that retrying won't fix
+PERMANENT_CONNECT_ERRORS = ('authentication failed', 'does not exist', 'no pg_hba.conf entry')
+
+
+def sqlstate(err):
+    """SQLSTATE of a psycopg2 (pgcode) or asyncpg (sqlstate) error, None for anything else."""
+    return getattr(err, 'pgcode', None) or getattr(err, 'sqlstate', None)
+
+
+def classify_error(err):
+    code = sqlstate(err)
+    if code == QUERY_CANCELED:
+        return TIMEOUT
+    if code is None:
+        # no SQLSTATE: the connection failed or dropped before the server answered
+        driver_error = type(err).__module__.split('.')[0] in ('psycopg2', 'asyncpg')
+        if driver_error and any(message in str(err) for message in PERMANENT_CONNECT_ERRORS):
+            return PERMANENT
+        return TRANSIENT if driver_error or isinstance(err, (OSError, TimeoutError)) else PERMANENT
+    if code[:2] in TRANSIENT_SQLSTATE_CLASSES or code in TRANSIENT_SQLSTATES:
+        return TRANSIENT
+    return PERMANENT
+
+
+def should_retry(kind, attempt):
+    """attempt counts from 0."""
+    return kind != PERMANENT and attempt + 1 < MAX_ATTEMPTS
+
+
+def backoff_seconds(attempt):
+    """Full jitter: uniform between 0 and the exponential delay of the attempt (counting from 1)."""
+    return random.uniform(0, min(BACKOFF_CAP_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+
+def retry_timeout_ms(timeout_ms, kind):
+    return timeout_ms * TIMEOUT_GROWTH if kind == TIMEOUT else timeout_ms
+
+
+def failure_record(err, kind, attempts):
+    return {
+        'kind': kind,
+        'sqlstate': sqlstate(err),
+        'error': str(err).strip(),
+        'attempts': attempts,
+        'failed_at': datetime.now().isoformat(timespec = 'seconds')
+    }
+
+
+def load_ledger(path = LEDGER_PATH):
+    """client -> {feature: failure record}"""
+    if not os.path.exists(path):
+        return {}
+    with open(path) as file:
+        return json.load(file)
+
+
+def save_ledger(ledger, path = LEDGER_PATH):
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as file:
+        json.dump(ledger, file, indent = 1, sort_keys = True)
+    os.replace(tmp_path, path)
+
+
+def update_ledger(ledger, results, failures):
+    """
+    Fold a run into the ledger: the features a client ran without failing are cleared, its new
+    failures recorded.  Clients the run didn't touch keep their entries.
+    """
+    for client, row_counts in results.items():
+        client_failures = failures.get(client, {})
+        entries = {
+            feature: record for feature, record in ledger.get(client, {}).items()
+            if feature not in row_counts or feature in client_failures
+        }
+        entries.update(client_failures)
+        if entries:
+            ledger[client] = entries
+        else:
+            ledger.pop(client, None)
+    return ledger
@@ -0,0 +1,145 @@
+"""
+Server-aware scheduling of the per-client queries across the fleet.
+
+Handing a flat list of clients to the workers lets them all pile onto one server while the rest of
+the fleet sits idle, and that server then starts hitting statement_timeout.  The scheduler keeps a
+queue per server, hands work out round-robin across servers, caps the number of in-flight queries
+per server, and halves a server's cap when its query latency climbs (slowly raising it back once
+the server recovers).
+
+Given a priority_of (e.g. the expected runtime from runtime_history.py), each server's queue is
+ordered longest job first and the next item is the longest waiting one on any server with room,
+so the biggest clients start early instead of trailing at the end of the run.
+
+The scheduler itself does no i/o and is not thread safe; callers that complete work from another
+thread (e.g. pool callbacks) must hold a lock around it.
+"""
+
+from collections import OrderedDict, deque
+
+
+class ServerAwareScheduler:
+
+    def __init__(self, work_items, server_of, max_in_flight, max_per_server = 8, min_per_server = 1,
+                 slowdown_factor = 2.0, slow_query_seconds = 150, smoothing = 0.3, baseline_smoothing = 0.05,
+                 priority_of = None):
+        """
+        work_items: anything; server_of(work_item) must return the item's server number.
+        priority_of: optional; work items with a higher priority_of(work_item) are started first.
+            Without it, servers are served round-robin in discovery order.
+        max_in_flight: cap across all servers (e.g. the number of pool processes).
+        max_per_server / min_per_server: bounds for each server's adaptive in-flight cap.
+        slowdown_factor: back off when a server's recent latency (fast moving average) exceeds this
+            multiple of its long-run latency (slow moving average).
+        slow_query_seconds: back off whenever a single query takes longer than this.
+        """
+        self.server_of = server_of
+        self.max_in_flight = max_in_flight
+        self.max_per_server = max_per_server
+        self.min_per_server = min_per_server
+        self.slowdown_factor = slowdown_factor
+        self.slow_query_seconds = slow_query_seconds
+        self.smoothing = smoothing
+        self.baseline_smoothing = baseline_smoothing
+
+        self.priority_of = priority_of
+        if priority_of is not None:
+            work_items = sorted(work_items, key = priority_of, reverse = True)
+
+        self.queues = OrderedDict()
+        for work_item in work_items:
+            self.queues.setdefault(server_of(work_item), deque()).append(work_item)
+
+        self.servers = list(self.queues)
+        self.limits = {server: max_per_server for server in self.servers}
+        self.in_flight = {server: 0 for server in self.servers}
+        self.latency = {server: None for server in self.servers}
+        self.baseline = {server: None for server in self.servers}
+        self.good_streak = {server: 0 for server in self.servers}
+        # completions to wait for after a back off, so one slow batch only halves the cap once
+        self.cooldown = {server: 0 for server in self.servers}
+        self.next_server = 0
+        self.total_in_flight = 0
+
+    def next_item(self):
+        """Return the next work item to start, or None if every server with work is at its cap."""
+        if self.total_in_flight >= self.max_in_flight:
+            return None
+
+        if self.priority_of is not None:
+            return self.next_longest_item()
+
+        for offset in range(len(self.servers)):
+            index = (self.next_server + offset) % len(self.servers)
+            server = self.servers[index]
+            if self.queues[server] and self.in_flight[server] < self.limits[server]:
+                self.next_server = index + 1
+                self.in_flight[server] += 1
+                self.total_in_flight += 1
+                return self.queues[server].popleft()
+
+        return None
+
+    def next_longest_item(self):
+        ready_servers = [
+            server for server in self.servers
+            if self.queues[server] and self.in_flight[server] < self.limits[server]
+        ]
+        if not ready_servers:
+            return None
+
+        server = max(ready_servers, key = lambda server: self.priority_of(self.queues[server][0]))
+        self.in_flight[server] += 1
+        self.total_in_flight += 1
+        return self.queues[server].popleft()
+
+    def task_done(self, work_item, query_seconds):
+        """
+        Record that work_item finished and adapt its server's cap.  query_seconds are the seconds of
+        each query it ran, retries included but not the waits before them: a work item can hold
+        several feature queries, so its wall time says little about how its server is doing.
+        """
+        server = self.server_of(work_item)
+        self.in_flight[server] -= 1
+        self.total_in_flight -= 1
+        if not query_seconds:
+            # failed before its first query, nothing to learn about the server
+            return
+
+        elapsed = sum(query_seconds) / len(query_seconds)
+        if self.latency[server] is None:
+            self.latency[server] = elapsed
+            self.baseline[server] = elapsed
+        else:
+            self.latency[server] = self.smoothing * elapsed + (1 - self.smoothing) * self.latency[server]
+            self.baseline[server] = (
+                self.baseline_smoothing * elapsed + (1 - self.baseline_smoothing) * self.baseline[server]
+            )
+
+        if self.cooldown[server] > 0:
+            self.cooldown[server] -= 1
+            return
+
+        overloaded = (
+            max(query_seconds) > self.slow_query_seconds
+            or self.latency[server] > self.slowdown_factor * max(self.baseline[server], 0.001)
+        )
+        if overloaded:
+            new_limit = max(self.min_per_server, self.limits[server] // 2)
+            if new_limit < self.limits[server]:
+                print(f"Server {server} slowing down (latency {self.latency[server]:.1f}s), "
+                      f"cap {self.limits[server]} -> {new_limit}")
+            self.limits[server] = new_limit
+            self.good_streak[server] = 0
+            self.cooldown[server] = self.in_flight[server]
+        else:
+            self.good_streak[server] += 1
+            if self.good_streak[server] >= self.limits[server] and self.limits[server] < self.max_per_server:
+                self.limits[server] += 1
+                self.good_streak[server] = 0
+
+    def pending_count(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+    def is_done(self):
+        return self.total_in_flight == 0 and self.pending_count() == 0
@@ -0,0 +1,291 @@
+"""
+An in-process stand-in for the client DB fleet, for benchmarking the extraction offline.
+
+With FEATURE_EXTRACTION_FAKE_FLEET set (to a JSON object of FLEET_DEFAULTS overrides, '{}' for
+the defaults) get_db_connection() and the async connect_to_db() return fake connections from
+here instead of connecting to the servers.  The fake doesn't run the feature SQL: each query
+returns a synthetic month_start / count / rate / label result whose latency follows the fleet
+config.  Its rows depend only on the client and on the months the SQL covers (the month offsets
+feature_sql() fills in and a chunk's month_start filter), so a chunked run, a COPY and a fetch
+return the same rows and runs can be compared.
+
+    servers                 servers 01.. with clients (at most 28, the servers main() lists)
+    clients_per_server      client DBs per server (plus postgres, template1 and a _backup DB
+                            for the exclusion rules to drop)
+    rows                    median rows per client query over HISTORY_MONTHS
+    row_skew                sigma of the log-normal spread of client sizes around the median;
+                            the long tail of large clients (a client's database size and the
+                            rows of its queries scale together)
+    connect_ms              connect latency
+    execute_ms              latency before the first row
+    rows_per_second         transfer rate of the rows
+    slow_servers            {server_no: latency multiplier}
+"""
+
+import asyncio
+import csv
+import itertools
+import json
+import os
+import random
+import re
+import time
+from datetime import date
+from client_metadata import AY_START_END_SQL, SF_AN_SQL
+from extraction_common import FAKE_FLEET_ENV
+
+
+FLEET_DEFAULTS = {
+    'servers': 4,
+    'clients_per_server': 25,
+    'rows': 2000,
+    'row_skew': 1.0,
+    'connect_ms': 20,
+    'execute_ms': 200,
+    'rows_per_second': 200000,
+    'slow_servers': {}
+}
+
+COLUMNS = [('month_start', 1082), ('usage_count', 23), ('usage_rate', 701), ('title', 25)]
+HISTORY_MONTHS = 60
+MONTH_OFFSET_PATTERN = re.compile(r"INTERVAL '(\d+) months'")
+# common_asmts counts its months back with GENERATE_SERIES(last offset, first offset)
+MONTH_SERIES_PATTERN = re.compile(r"GENERATE_SERIES\((\d+), (\d+)\)")
+MONTH_FILTER_PATTERN = re.compile(r"month_start::date (>=|<=) '(\d{4})-(\d{2})-\d{2}'")
+
+
+def fleet_config():
+    return dict(FLEET_DEFAULTS, **json.loads(os.environ.get(FAKE_FLEET_ENV) or '{}'))
+
+
+def fleet_clients(server_no, config):
+    if int(server_no) > config['servers']:
+        return []
+    return [f'fake{server_no}_{index:03d}' for index in range(config['clients_per_server'])]
+
+
+def database_size(client, config):
+    """Roughly in line with the client's result sizes, so size-based estimates have a signal."""
+    return int(config['rows'] * 500 * random.Random(client).lognormvariate(0, config['row_skew']))
+
+
+def query_window(sql):
+    """
+    First and last month (as year * 12 + month - 1) of the months sql reads: the month offsets of
+    its generate_series (the default history if it has none).
+    """
+    current = date.today().year * 12 + date.today().month - 1
+    offsets = [int(offset) for offset in MONTH_OFFSET_PATTERN.findall(sql)]
+    series = MONTH_SERIES_PATTERN.search(sql)
+    if series:
+        offsets = [int(series.group(2)), int(series.group(1))]
+    first = current - (offsets[0] if offsets else HISTORY_MONTHS)
+    last = current - (offsets[1] if len(offsets) > 1 else 0)
+    return first, last
+
+
+def query_months(sql):
+    """
+    First and last month of the rows sql asks for: its query_window() narrowed by a month_start
+    filter.  None for a query that only describes its columns (LIMIT 0).
+    """
+    if sql.strip().endswith('LIMIT 0'):
+        return None
+    first, last = query_window(sql)
+    for operator, year, month in MONTH_FILTER_PATTERN.findall(sql):
+        month = int(year) * 12 + int(month) - 1
+        first, last = (max(first, month), last) if operator == '>=' else (first, min(last, month))
+    return first, last
+
+
+def metadata_rows(sql, client):
+    """Rows of the client metadata lookups (see client_metadata.py), None for any other query."""
+    if sql == SF_AN_SQL:
+        return [(f'{{{client}}}',)]
+    if sql == AY_START_END_SQL:
+        return [(year, date(year - 1, 8, 1), date(year, 7, 31)) for year in range(2020, 2027)]
+    return None
+
+
+class FakeQuery:
+    """The rows and timing of one client's result for one query."""
+
+    def __init__(self, server_no, client, sql, config):
+        slowdown = config['slow_servers'].get(server_no, 1.0)
+        self.client = client
+        months = query_months(sql)
+        # a client's months are equally large, so the months of a chunk add up to the full result
+        monthly_rows = database_size(client, config) / 500 / HISTORY_MONTHS
+        self.month_rows = [] if months is None else [
+            (month, int(monthly_rows * (month + 1)) - int(monthly_rows * month))
+            for month in range(months[0], months[1] + 1)
+        ]
+        self.row_count = sum(count for _, count in self.month_rows)
+        self.execute_seconds = config['execute_ms'] / 1000 * slowdown
+        self.row_seconds = slowdown / config['rows_per_second']
+        self.pending = self.all_rows()
+
+    def all_rows(self):
+        for month, count in self.month_rows:
+            month_start = date(month // 12, month % 12 + 1, 1)
+            for row in range(count):
+                yield month_start, (month + row) % 97, (month + row) / 7, f'report {row % 13}'
+
+    def rows(self, count):
+        """The next count rows, as a cursor would hand them over."""
+        return list(itertools.islice(self.pending, count))
+
+
+class FakeCursor:
+
+    def __init__(self, connection, name = None):
+        self.connection = connection
+        self.name = name
+        self.itersize = 2000
+        self.description = None
+        self.rowcount = -1
+        self.query = None
+        self.metadata_rows = None
+
+    def execute(self, sql):
+        if sql.lstrip().upper().startswith('SET'):
+            return
+        if self.connection.client == 'postgres':
+            self.query = None
+            return
+        self.metadata_rows = metadata_rows(sql, self.connection.client)
+        if self.metadata_rows is not None:
+            return
+        self.query = FakeQuery(self.connection.server_no, self.connection.client, sql, self.connection.config)
+        self.description = [(name, oid) for name, oid in COLUMNS]
+        time.sleep(self.query.execute_seconds)
+
+    def fetchall(self):
+        if self.metadata_rows is not None:
+            return self.metadata_rows
+        if self.query is None:
+            # the pg_database listing of get_list_of_dbs()
+            dbs = ['postgres', 'template1', f'fake{self.connection.server_no}_backup']
+            dbs += fleet_clients(self.connection.server_no, self.connection.config)
+            return [(db, database_size(db, self.connection.config)) for db in dbs]
+        return self.fetchmany(self.query.row_count)
+
+    def fetchmany(self, size):
+        rows = self.query.rows(size)
+        time.sleep(len(rows) * self.query.row_seconds)
+        return rows
+
+    def copy_expert(self, sql, file):
+        self.execute(sql)
+        wtr = csv.writer(file, delimiter = ',', lineterminator = '\n')
+        wtr.writerow(['client'] + [name for name, _ in COLUMNS])
+        rows = self.fetchmany(self.query.row_count)
+        wtr.writerows([self.connection.client] + list(row) for row in rows)
+        self.rowcount = len(rows)
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+
+    def __init__(self, server_no, client, config):
+        self.server_no = server_no
+        self.client = client
+        self.config = config
+
+    def cursor(self, name = None):
+        return FakeCursor(self, name)
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def connect(server_no, client):
+    config = fleet_config()
+    time.sleep(config['connect_ms'] / 1000 * config['slow_servers'].get(server_no, 1.0))
+    return FakeConnection(server_no, client, config)
+
+
+class FakeAttribute:
+
+    class Type:
+        def __init__(self, oid):
+            self.oid = oid
+
+    def __init__(self, name, oid):
+        self.name = name
+        self.type = FakeAttribute.Type(oid)
+
+
+class FakeAsyncCursor:
+
+    def __init__(self, query):
+        self.query = query
+
+    async def fetch(self, size):
+        rows = self.query.rows(size)
+        await asyncio.sleep(len(rows) * self.query.row_seconds)
+        return rows
+
+
+class FakeStatement:
+
+    def __init__(self, query):
+        self.query = query
+
+    def get_attributes(self):
+        return [FakeAttribute(name, oid) for name, oid in COLUMNS]
+
+    async def fetch(self):
+        await asyncio.sleep(self.query.execute_seconds)
+        return await FakeAsyncCursor(self.query).fetch(self.query.row_count)
+
+    async def cursor(self):
+        await asyncio.sleep(self.query.execute_seconds)
+        return FakeAsyncCursor(self.query)
+
+
+class FakeTransaction:
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+
+class FakeAsyncConnection(FakeConnection):
+    """asyncpg counterpart of FakeConnection."""
+
+    async def prepare(self, sql):
+        return FakeStatement(FakeQuery(self.server_no, self.client, sql, self.config))
+
+    def transaction(self):
+        return FakeTransaction()
+
+    async def execute(self, sql):
+        pass
+
+    async def fetch(self, sql):
+        return metadata_rows(sql, self.client)
+
+    async def copy_from_query(self, sql, output, format = 'csv', header = True):
+        query = FakeQuery(self.server_no, self.client, sql, self.config)
+        await asyncio.sleep(query.execute_seconds)
+        await output((','.join(['client'] + [name for name, _ in COLUMNS]) + '\n').encode())
+        rows = await FakeAsyncCursor(query).fetch(query.row_count)
+        await output(''.join(f"{self.client},{','.join(map(str, row))}\n" for row in rows).encode())
+        return f'COPY {len(rows)}'
+
+    async def close(self):
+        pass
+
+
+async def connect_async(server_no, client):
+    config = fleet_config()
+    await asyncio.sleep(config['connect_ms'] / 1000 * config['slow_servers'].get(server_no, 1.0))
+    return FakeAsyncConnection(server_no, client, config)
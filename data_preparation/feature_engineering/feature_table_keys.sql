@@ -0,0 +1,40 @@
+/*
+SUMMARY:
+- One-time migration of the feature tables for warehouse_loader.py
+- Drops the duplicate rows the csv imports left behind (one row is kept per key)
+- Adds the unique indexes the loader's upserts are keyed on (query_info key_columns)
+*/
+
+
+DELETE FROM all_dna_prebuilt_report_usage a
+USING all_dna_prebuilt_report_usage b
+WHERE a.ctid < b.ctid
+	AND a.sf_an = b.sf_an
+	AND a.client = b.client
+	AND a.month_start = b.month_start
+	AND a.title = b.title;
+
+CREATE UNIQUE INDEX IF NOT EXISTS all_dna_prebuilt_report_usage_key
+	ON all_dna_prebuilt_report_usage (sf_an, client, month_start, title);
+
+
+DELETE FROM all_dna_system_admin_tenure a
+USING all_dna_system_admin_tenure b
+WHERE a.ctid < b.ctid
+	AND a.sf_an = b.sf_an
+	AND a.client = b.client
+	AND a.month_start = b.month_start;
+
+CREATE UNIQUE INDEX IF NOT EXISTS all_dna_system_admin_tenure_key
+	ON all_dna_system_admin_tenure (sf_an, client, month_start);
+
+
+DELETE FROM dna_common_assessments a
+USING dna_common_assessments b
+WHERE a.ctid < b.ctid
+	AND a.sf_an = b.sf_an
+	AND a.client = b.client
+	AND a.month_start = b.month_start;
+
+CREATE UNIQUE INDEX IF NOT EXISTS dna_common_assessments_key
+	ON dna_common_assessments (sf_an, client, month_start);
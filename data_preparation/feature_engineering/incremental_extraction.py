@@ -0,0 +1,100 @@
+"""
+Watermark bookkeeping for incremental (month-by-month) feature extraction.
+
+Each feature folder keeps _watermarks.json: client -> the last complete month (first of the month,
+ISO date) that is already in the client's shard.  An incremental run only asks each client DB for
+the months after its watermark and splices them into the stored shard, so a monthly refresh costs
+one month of work per client instead of the full 5 year history.
+
+The current month is never extracted in incremental mode, since its numbers are still moving.
+"""
+
+import csv
+import json
+import os
+from datetime import date
+from extraction_common import delta_path, shard_path
+
+
+def watermarks_path(folder_name):
+    return f'{folder_name}/_watermarks.json'
+
+
+def load_watermarks(folder_name):
+    if not os.path.exists(watermarks_path(folder_name)):
+        return {}
+    with open(watermarks_path(folder_name)) as file:
+        return {client: date.fromisoformat(month) for client, month in json.load(file).items()}
+
+
+def save_watermarks(folder_name, watermarks):
+    tmp_path = f'{watermarks_path(folder_name)}.tmp'
+    with open(tmp_path, 'w') as file:
+        json.dump({client: month.isoformat() for client, month in sorted(watermarks.items())}, file, indent = 1)
+    os.replace(tmp_path, watermarks_path(folder_name))
+
+
+def add_months(month, months):
+    month_index = month.year * 12 + month.month - 1 + months
+    return date(month_index // 12, month_index % 12 + 1, 1)
+
+
+def last_complete_month(today = None):
+    today = today or date.today()
+    return add_months(date(today.year, today.month, 1), -1)
+
+
+def months_before_current(month, today = None):
+    today = today or date.today()
+    return (today.year - month.year) * 12 + today.month - month.month
+
+
+def merge_delta_into_shard(folder_name, client, output_format = 'csv', replace_from = None):
+    """
+    Replace every row of the client's shard with month_start >= replace_from by the rows of its
+    delta file.  With replace_from None (no watermark yet) the delta becomes the whole shard.
+    """
+    shard = shard_path(folder_name, client, output_format)
+    delta = delta_path(folder_name, client, output_format)
+
+    if replace_from is None or not os.path.exists(shard):
+        os.replace(delta, shard)
+        return
+
+    if output_format == 'parquet':
+        from parquet_shards import merge_parquet_delta
+        merge_parquet_delta(shard, delta, replace_from)
+        return
+
+    replace_from = replace_from.isoformat()
+    tmp_path = f'{shard}.tmp'
+    with open(shard, newline = '') as shard_file, open(delta, newline = '') as delta_file, \
+            open(tmp_path, 'w') as out_file:
+        wtr = csv.writer(out_file, delimiter = ',', lineterminator = '\n')
+        shard_rows = csv.reader(shard_file)
+        header = next(shard_rows)
+        month_start_index = header.index('month_start')
+        wtr.writerow(header)
+        # month_start is a date or a timestamp depending on the feature; its first 10 characters
+        # are the ISO date either way
+        wtr.writerows(row for row in shard_rows if row[month_start_index][:10] < replace_from)
+
+        delta_rows = csv.reader(delta_file)
+        next(delta_rows)
+        wtr.writerows(delta_rows)
+
+    os.replace(tmp_path, shard)
+    os.remove(delta)
+
+
+def finish_query(query, row_count):
+    """Splice an incremental run's new months into the shard once the client's query returned rows."""
+    options = query['options']
+    if not options['incremental'] or query.get('part') is not None:
+        # chunks are finished once they are stitched together (see chunked_extraction.py)
+        return
+
+    if row_count:
+        merge_delta_into_shard(query['folder_name'], query['client'], options['output_format'], query['replace_from'])
+    elif os.path.exists(delta_path(query['folder_name'], query['client'], options['output_format'])):
+        os.remove(delta_path(query['folder_name'], query['client'], options['output_format']))
@@ -4,45 +4,80 @@ Script uses python multiprocessing to efficiently pull newly engineered features
 
 New features are engineered usign complex SQL.
 SQL queries for all new features are stored in the query_info dictionary.
+
+main() runs the queries either on a pool of spawned processes (engine = 'pool'), from a single
+asyncio event loop (engine = 'async', see async_extraction.py) or on pools on several worker
+hosts (engine = 'distributed', see distributed_extraction.py).
 """
 
-import csv
 import multiprocessing as mp
+from datetime import date
+import os
+import queue
 import time
 import psycopg2
 import glob
 import pandas as pd
+from extraction_common import (
+    FAKE_FLEET_ENV, STATEMENT_TIMEOUT_MS, ExtractionProgress, connection_settings, copy_export_sql,
+    describe_sql, open_query_writer, shard_path, sql_literal
+)
+from incremental_extraction import (
+    finish_query, last_complete_month, load_watermarks, months_before_current, add_months, save_watermarks
+)
+from extraction_scheduler import ServerAwareScheduler
+from client_discovery import client_dbs, discover_dbs, load_exclusion_rules
+from extraction_metrics import QueryTimer, total_seconds, write_prometheus_textfile, write_run_report
+from runtime_history import (
+    expected_seconds, job_priority, load_runtime_history, save_runtime_history, seconds_per_byte,
+    update_runtime_history
+)
+from run_manifest import complete_clients, load_manifest, query_hash, save_manifest, shard_entry
+from chunked_extraction import discard_parts, month_chunks, stitch_parts
+from client_metadata import (
+    AY_START_END_SQL, SF_AN_SQL, cached_metadata, load_metadata_cache, metadata_entry, render_client_metadata,
+    save_metadata_cache
+)
+from extraction_retries import (
+    MAX_ATTEMPTS, backoff_seconds, classify_error, failure_record, load_ledger, retry_timeout_ms, save_ledger,
+    should_retry, update_ledger
+)
+
+
+SHARD_ROOT = '/Users/franck/Library/Mobile Documents/com~apple~CloudDocs/MSDS/UW MSDS/DS785 Capstone Project/client_health_sql/new_features_client_health'
 
 
 def connect_to_db(server_no, client):
-    try:
-        return psycopg2.connect(
-            host = f"10.21.0.1{server_no}",
-            database = client,
-            user = "phppgadmin",
-            password = "_REMOVED_",
-            options = '-c statement_timeout=300000'
-        )
-    except:
-        return None
+    """Raises the driver's error when the connection fails, for get_data() to classify."""
+    return psycopg2.connect(
+        **connection_settings(server_no, client),
+        options = f'-c statement_timeout={STATEMENT_TIMEOUT_MS}'
+    )
 
 
 def get_db_connection(server_no, client = 'postgres'):
+    if os.environ.get(FAKE_FLEET_ENV):
+        from fake_fleet import connect
+        return connect(server_no, client)
     db_connection = connect_to_db(server_no, client)
     return db_connection
 
 
 def get_list_of_dbs(server_no):
     print(f"get_list_of_dbs for server {server_no}.......")
-    db_connection = get_db_connection(server_no)
-    # print(f"dbconnection: {db_connection}")
-
-    if db_connection is None:
+    try:
+        db_connection = get_db_connection(server_no)
+    except psycopg2.Error as err:
+        print(f"ERROR: get_list_of_dbs ({server_no}): {err}")
         return []
+    # print(f"dbconnection: {db_connection}")
 
     cursor = db_connection.cursor()
+    # sizes are only readable for databases we may connect to
     sql = f"""
-        SELECT d.datname
+        SELECT
+            d.datname,
+            CASE WHEN HAS_DATABASE_PRIVILEGE(d.datname, 'CONNECT') THEN PG_DATABASE_SIZE(d.datname) END
         FROM pg_catalog.pg_database d
         """
 
@@ -57,84 +92,335 @@ def get_list_of_dbs(server_no):
     db_connection.close()
 
     # print(f"get_list_of_dbs - sqlresults: {sql_results}")
-    list_of_dbs = []
-    for row in sql_results:
-        if 'sandbox' in row[0]:
-            continue
-        list_of_dbs.append(row[0])
+    # every database is listed; client_db_exclusions.json decides which are client DBs.  The sizes
+    # (in bytes) estimate the runtime of clients without a runtime history (see runtime_history.py)
+    list_of_dbs = {row[0]: row[1] for row in sql_results}
 
     return list_of_dbs
 
 
-def get_data(client_server_no_tuple):
+def get_data(work_item):
+    """
+    Run every selected feature query for one client over a single connection and write each
+    feature's shard.  work_item is built by main(): client, server_no, options, metadata and
+    feature_queries (one query dict per feature: client, feature, sql, folder_name, replace_from,
+    options).
+
+    The client's sf_an and academic years are rendered into every feature query from metadata, the
+    cached values (see client_metadata.py); without them they are looked up once on the connection.
+
+    Failed connects and queries are retried as extraction_retries.py classifies them, on a new
+    connection, after a jittered backoff; timed out queries get a longer statement_timeout.
+
+    Returns ({feature: row_count}, {feature: failure record}, [timing records], metadata).  A
+    feature that failed for good has a row count of 0.  There is a timing record (see
+    extraction_metrics.py) for every attempt at every feature.  metadata is None if it couldn't be
+    looked up.
+    """
 
-    client = client_server_no_tuple[0]
-    server_no = client_server_no_tuple[1]
-    shared_dict = client_server_no_tuple[2]
-    sql = client_server_no_tuple[3]
-    folder_name = client_server_no_tuple[4]
+    client = work_item['client']
+    server_no = work_item['server_no']
 
     # print(f"DB {client}...............")
 
-    db_connection = get_db_connection(server_no, client = client)
+    row_counts = {}
+    failures = {}
+    timings = []
+    timeouts = {query['feature']: STATEMENT_TIMEOUT_MS for query in work_item['feature_queries']}
+    feature_queries = work_item['feature_queries']
+    metadata = work_item.get('metadata')
+    for attempt in range(MAX_ATTEMPTS):
+        if attempt:
+            time.sleep(backoff_seconds(attempt))
 
-    if db_connection is None:
-        print(f'ERROR: Unable to establish connection to DB for {client}.')
-        return
+        connect_started = time.perf_counter()
+        try:
+            db_connection = get_db_connection(server_no, client = client)
+        except Exception as err:
+            kind = classify_error(err)
+            print(f'ERROR: Unable to establish connection to DB for {client} ({kind}): {err}')
+            timer = QueryTimer(client, server_no, None, attempt + 1, time.perf_counter() - connect_started)
+            timer.failed(kind)
+            timings.append(timer.record)
+            if should_retry(kind, attempt):
+                continue
+            for query in feature_queries:
+                failures[query['feature']] = failure_record(err, kind, attempt + 1)
+                row_counts[query['feature']] = 0
+            break
+        connect_seconds = time.perf_counter() - connect_started
+        if metadata is None:
+            metadata = fetch_client_metadata(db_connection, client)
+
+        retry_queries = []
+        for query in feature_queries:
+            feature = query['feature']
+            # the connect is charged to the first query on the connection
+            timer = QueryTimer(client, server_no, feature, attempt + 1, connect_seconds)
+            connect_seconds = 0.0
+            timings.append(timer.record)
+            try:
+                client_query = dict(query, sql = render_client_metadata(query['sql'], metadata))
+                row_count = run_feature_query(db_connection, client_query, timer, timeouts[feature])
+            except Exception as err:
+                kind = classify_error(err)
+                timer.failed(kind)
+                if should_retry(kind, attempt):
+                    print(f"retrying {feature} for {client} ({kind})")
+                    timeouts[feature] = retry_timeout_ms(timeouts[feature], kind)
+                    retry_queries.append(query)
+                else:
+                    failures[feature] = failure_record(err, kind, attempt + 1)
+                row_count = 0
+            finally:
+                # end the feature's transaction, so a failed query doesn't abort the ones after it
+                end_transaction(db_connection)
+
+            finish_query(query, row_count)
+            row_counts[feature] = row_count
+        db_connection.close()
 
+        feature_queries = retry_queries
+        if not feature_queries:
+            break
+
+    # print(f"...............DB {client}")
+    return row_counts, failures, timings, metadata
+
+
+def fetch_client_metadata(db_connection, client):
+    """
+    The client's sf_an and academic years (see client_metadata.py), or None if the lookup fails; the
+    feature queries then look them up themselves.
+    """
+    try:
+        cursor = db_connection.cursor()
+        cursor.execute(SF_AN_SQL)
+        sf_an_rows = cursor.fetchall()
+        cursor.execute(AY_START_END_SQL)
+        ay_rows = cursor.fetchall()
+        cursor.close()
+        return metadata_entry(sf_an_rows, ay_rows)
+    except Exception as err:
+        print(f"ERROR: metadata lookup failed for {client}: {err}")
+        return None
+    finally:
+        end_transaction(db_connection)
+
+
+def run_feature_query(db_connection, query, timer, statement_timeout_ms = STATEMENT_TIMEOUT_MS):
+    """Run one feature query in its own transaction, with a raised timeout when it is a retry."""
+    if statement_timeout_ms != STATEMENT_TIMEOUT_MS:
+        cursor = db_connection.cursor()
+        cursor.execute(f"SET LOCAL statement_timeout = {int(statement_timeout_ms)}")
+        cursor.close()
+
+    fetch_mode = query['options']['fetch_mode']
+    if fetch_mode == 'stream':
+        return stream_data(db_connection, query, timer)
+    if fetch_mode == 'copy':
+        return copy_data(db_connection, query, timer)
+    return fetch_data(db_connection, query, timer)
+
+
+def end_transaction(db_connection):
+    # a dropped connection has no transaction left to end; its remaining queries fail and are retried
+    try:
+        db_connection.rollback()
+    except psycopg2.Error:
+        pass
+
+
+def fetch_data(db_connection, query, timer):
+    client = query['client']
     cursor = db_connection.cursor()
 
     # sql = "SELECT student_id FROM students LIMIT 1"
     try:
-        cursor.execute(sql)
+        with timer.phase('execute'):
+            cursor.execute(query['sql'])
     except Exception as err:
         print(f"ERROR ({client}): ", err)
-        shared_dict[client] = 0
-        db_connection.close()
-        return
+        raise
 
     try:
-        sql_results = cursor.fetchall()
+        with timer.phase('fetch'):
+            sql_results = cursor.fetchall()
     except Exception as err:
         print(f"ERROR: ({client})", err)
-        shared_dict[client] = 0
-        db_connection.close()
-        return
+        raise
 
     print(f"Got results for {client} ({len(sql_results)})")
 
+    colnames = [desc[0] for desc in cursor.description]
+    type_oids = [desc[1] for desc in cursor.description]
     cursor.close()
-    db_connection.close()
 
-    rowArrays = []
+    with timer.phase('write'):
+        writer = open_query_writer(query)
+        writer.write_header(colnames, type_oids)
+        writer.write_rows(sql_results)
+        writer.close()
+    timer.wrote(writer)
+    return writer.row_count
 
-    for row in sql_results:
-        rowArray = [value for value in row]
-        rowArray.insert(0, client)
-        rowArrays.append(rowArray)
 
-    with open(f'{folder_name}/{client}_{folder_name}.csv', 'a') as file:
-        wtr = csv.writer(file, delimiter = ',', lineterminator = '\n')
-        colnames = [desc[0] for desc in cursor.description]
-        colnames.insert(0, 'client')
-        wtr.writerow(colnames)
-        for row in rowArrays:
-            wtr.writerow(row)
+def stream_data(db_connection, query, timer):
+    """
+    Fetch one client's results through a named (server-side) cursor in batches of batch_size rows,
+    writing each batch to the shard as it arrives, so memory stays flat however large the client.
 
-    shared_dict[client] = len(rowArrays)
-    # print(f"...............DB {client}")
-    return
+    Returns the number of rows written.  If the query fails the partial shard is removed and the
+    error raised.
+    """
+    client = query['client']
+    batch_size = query['options']['batch_size']
+    cursor = db_connection.cursor(name = f"{client}_{query['feature']}")
+    cursor.itersize = batch_size
+    writer = open_query_writer(query)
+
+    try:
+        # the query only runs once the first batch is fetched from the named cursor
+        with timer.phase('execute'):
+            cursor.execute(query['sql'])
+            sql_results = cursor.fetchmany(batch_size)
+        # a named cursor only has a description once the first batch has been fetched
+        writer.write_header([desc[0] for desc in cursor.description], [desc[1] for desc in cursor.description])
+        while sql_results:
+            with timer.phase('write'):
+                writer.write_rows(sql_results)
+            with timer.phase('fetch'):
+                sql_results = cursor.fetchmany(batch_size)
+        cursor.close()
+    except Exception as err:
+        print(f"ERROR ({client}): ", err)
+        writer.discard()
+        raise
 
+    print(f"Got results for {client} ({writer.row_count})")
+    with timer.phase('write'):
+        writer.close()
+    timer.wrote(writer)
+    return writer.row_count
 
-def main(sql, folder_name):
-    mp.set_start_method("spawn")
 
-    directory = f'/Users/franck/Library/Mobile Documents/com~apple~CloudDocs/MSDS/UW MSDS/DS785 Capstone Project/client_health_sql/new_features_client_health/{folder_name}/'
-    extension = 'csv'
-    all_filenames = [i.replace(directory, '') for i in glob.glob(f'{directory}*.csv')]
+def copy_data(db_connection, query, timer):
+    """
+    Export one client's results with COPY (query) TO STDOUT straight into the shard, skipping the
+    per-value python conversion and csv.writer re-serialization of the cursor path.  Execution and
+    transfer can't be told apart here, the whole COPY is timed as fetch.
+
+    Returns the number of rows written.  If the export fails the partial shard is removed and the
+    error raised.
+    """
+    client = query['client']
+    cursor = db_connection.cursor()
+    writer = open_query_writer(query)
+
+    try:
+        colnames = type_oids = None
+        if query['options']['output_format'] == 'parquet':
+            # COPY has no column types; parquet shards take them from the query, as a cursor fetch does
+            with timer.phase('execute'):
+                cursor.execute(describe_sql(query['sql']))
+            colnames = [desc[0] for desc in cursor.description]
+            type_oids = [desc[1] for desc in cursor.description]
+        with timer.phase('fetch'):
+            cursor.copy_expert(copy_export_sql(query['sql'], client), writer.csv_sink(colnames, type_oids))
+        writer.row_count = cursor.rowcount
+        cursor.close()
+    except Exception as err:
+        print(f"ERROR ({client}): ", err)
+        writer.discard()
+        raise
+
+    print(f"Got results for {client} ({writer.row_count})")
+    with timer.phase('write'):
+        writer.close()
+    timer.wrote(writer)
+    return writer.row_count
+
+
+def main(features, engine = 'pool', max_in_flight = 200, max_per_server = None, fetch_mode = 'fetchall',
+         batch_size = 10000, output_format = 'csv', incremental = False, refresh_discovery = False,
+         failed_only = False, chunk_months = None, chunk_above_seconds = 120, refresh_metadata = False,
+         coordinator_address = ('', 50000)):
+    """
+    features is a query_info key or a list of them.  Every selected feature is run for a client in
+    one session on one connection, each into its own folder of shards.
+
+    engine = 'pool' fans the clients out over 16 spawned processes; engine = 'async' keeps up to
+    max_in_flight queries in flight from this process instead.  engine = 'distributed' serves the
+    work items at coordinator_address to worker hosts, up to max_in_flight at a time (see
+    distributed_extraction.py).  Every engine records the shards of finished clients in their
+    manifests as it goes (at least once a minute), so a crashed run resumes where it stopped.
+
+    Every engine caps the queries running against any one server at max_per_server (defaults to 4
+    for the pool and 8 otherwise) and backs off further while a server is slow.
+
+    fetch_mode = 'fetchall' loads each client's full result before writing it; fetch_mode = 'stream'
+    reads it through a server-side cursor batch_size rows at a time, so memory stays flat for the
+    largest clients.  fetch_mode = 'copy' has each client DB stream its csv with COPY ... TO STDOUT
+    instead (values in Postgres' csv text format).
 
-    clients_with_data = [x[:x.index('_')] for x in all_filenames]
-    print(f"clients with data: {len(clients_with_data)}")
+    output_format = 'parquet' writes typed, compressed parquet shards and merges them as one Arrow
+    dataset (see parquet_shards.py) instead of re-reading every csv shard with pandas.
+
+    incremental = True only asks each client for the complete months after its watermark (see
+    incremental_extraction.py) and splices them into its stored shard; clients without a watermark,
+    or whose shard isn't complete, get their full history, up to last month.  Without it, clients that already have a complete
+    shard (see run_manifest.py) are skipped.
+
+    The servers' database listings are fetched concurrently and cached for a day (see
+    client_discovery.py); refresh_discovery = True lists every server again.
+
+    Clients whose connect or query still failed after the retries (see extraction_retries.py) are
+    recorded in _failed_clients.json; failed_only = True runs just those clients and features.
+
+    Every query is timed by phase (see extraction_metrics.py); the run's timings are written to
+    _run_report.json and _extraction_metrics.prom, and kept in _runtime_history.json, from which
+    the clients expected to take longest are started first (see runtime_history.py).
+
+    With chunk_months, the feature queries of clients expected to take longer than
+    chunk_above_seconds are split into chunk_months month ranges that run in parallel, on separate
+    connections, and are stitched back into the client's shard (see chunked_extraction.py).
+
+    Each client's sf_an and academic years are looked up once per connection rather than in every
+    feature query, and cached for a week in _client_metadata.json (see client_metadata.py);
+    refresh_metadata = True looks them up again for every client.
+
+    Returns the run's ExtractionProgress.
+    """
+    if isinstance(features, str):
+        features = [features]
+    options = {
+        'fetch_mode': fetch_mode,
+        'batch_size': batch_size,
+        'output_format': output_format,
+        'incremental': incremental
+    }
+    last_month = last_complete_month()
+    ledger = load_ledger()
+    metadata_cache = load_metadata_cache()
+
+    feature_state = {}
+    for feature in features:
+        folder_name = query_info[feature]['folder_name']
+        directory = f'{SHARD_ROOT}/{folder_name}/'
+        manifest = load_manifest(folder_name)
+        feature_hash = query_hash(query_info[feature])
+
+        # only shards the manifest vouches for count, not any file with the right name
+        clients_with_data = complete_clients(manifest, folder_name, output_format, feature_hash)
+        print(f"{feature} clients with data: {len(clients_with_data)}")
+        feature_state[feature] = {
+            'folder_name': folder_name,
+            'directory': directory,
+            'clients_with_data': clients_with_data,
+            'manifest': manifest,
+            'query_hash': feature_hash,
+            'watermarks': load_watermarks(folder_name) if incremental else {}
+        }
 
     list_of_servers = []
 
@@ -151,10 +437,8 @@ def main(sql, folder_name):
     client_list = []
     pending_queries = []
 
-    manager = mp.Manager()
-    query_pool = mp.Pool(processes = 16)
-    shared_dict = manager.dict()
-
+    dbs_by_server = discover_dbs(list_of_servers, get_list_of_dbs, refresh = refresh_discovery)
+    exclusion_rules = load_exclusion_rules()
 
     for server_index, server in enumerate(list_of_servers):
 
@@ -166,7 +450,7 @@ def main(sql, folder_name):
         print("====================================")
         print(f"Server: {server}")
         print("====================================")
-        list_of_dbs = get_list_of_dbs(server)
+        list_of_dbs = client_dbs(dbs_by_server[server], exclusion_rules)
         print(list_of_dbs)
 
         # my_q = Queue()
@@ -174,84 +458,291 @@ def main(sql, folder_name):
         db_count = 0
         for db in list_of_dbs:
 
-            if db in ['postgres']:
-                continue
-            if 'template' in db:
-                continue
-            if 'portal' in db:
-                continue
-            if 'demo' in db:
-                continue
-            if 'jasper' in db:
-                continue
-            if 'job_queue' in db:
-                continue
-            if 'client' in db:
-                continue
-            if 'sqlboss' in db:
-                continue
-            if 'instance' in db:
-                continue
-            if 'lightster' in db:
-                continue
-            if 'infinitecampus' in db:
-                continue
-            if 'specialist' in db:
-                continue
-            if 'skyward' in db:
-                continue
-            if 'importtest' in db:
-                continue
-            if 'datatraining' in db:
-                continue
-            if 'template' in db:
-                continue
-            if 'postgres' in db:
-                continue
-            if 'csm' in db:
-                continue
-            if 'trainingwheels' in db:
-                continue
-            if '_backup' in db:
-                continue
-            if '_iris' in db:
-                continue
-            if '_ise' in db:
-                continue
-            if '_testing' in db:
-                continue
-            if '_candidate' in db:
-                continue
-            if db[0] == '_':
-                continue
-            if 'mwtest' in db:
-                continue
-            if 'staging' in db:
-                continue
-            if '_old' in db:
+            feature_queries = []
+            for feature in features:
+                if failed_only and feature not in ledger.get(db, {}):
+                    continue
+                feature_query = build_feature_query(db, feature, feature_state[feature], options, last_month)
+                if feature_query is not None:
+                    feature_queries.append(feature_query)
+            if not feature_queries:
                 continue
 
-            if db not in clients_with_data:
-                client_list.append(db)
-                db_count += 1
-                pending_queries.append((db, server, shared_dict, sql, folder_name))
+            client_list.append(db)
+            db_count += 1
+            pending_queries.append({
+                'client': db,
+                'server_no': server,
+                'feature_queries': feature_queries,
+                'options': options,
+                'metadata': cached_metadata(metadata_cache, db, refresh = refresh_metadata)
+            })
 
         print(f"ADDED ALL DBs FOR SERVER {server} ({db_count})")
 
-    result = query_pool.map_async(get_data, pending_queries)
+    # the engines start the longest expected jobs first
+    runtime_history = load_runtime_history()
+    db_sizes = {db: size for listing in dbs_by_server.values() for db, size in listing.items() if size}
+    rates = seconds_per_byte(runtime_history, db_sizes)
+    for work_item in pending_queries:
+        work_item['db_size'] = db_sizes.get(work_item['client'], 0)
+        work_item['expected_seconds'] = expected_seconds(work_item, runtime_history, db_sizes, rates)
+
+    if chunk_months:
+        pending_queries = [
+            chunk for work_item in pending_queries
+            for chunk in split_into_chunks(work_item, chunk_months, chunk_above_seconds, last_month)
+        ]
+        client_list = [work_item['client'] for work_item in pending_queries]
+
+    # chunked clients only have a shard once their parts are stitched, after the run
+    recorded_clients = {
+        query['client'] for work_item in pending_queries for query in work_item['feature_queries']
+        if query.get('part') is not None
+    }
+
+    def checkpoint(progress):
+        # finished shards are recorded as the run goes, so a crash doesn't lose them
+        recorded_clients.update(
+            record_completed_shards(feature_state, progress, output_format, skip_clients = recorded_clients)
+        )
+
+    started = time.time()
+    if engine == 'async':
+        from async_extraction import run_async_extraction
+        progress = run_async_extraction(
+            pending_queries,
+            max_in_flight = max_in_flight,
+            max_per_server = max_per_server or 8,
+            checkpoint = checkpoint
+        )
+    elif engine == 'distributed':
+        from distributed_extraction import run_coordinator
+        progress = run_coordinator(
+            pending_queries,
+            coordinator_address,
+            max_in_flight = max_in_flight,
+            max_per_server = max_per_server or 8,
+            checkpoint = checkpoint
+        )
+    else:
+        progress = run_pool_extraction(
+            pending_queries, client_list, max_per_server = max_per_server or 4, checkpoint = checkpoint
+        )
+    stitch_chunked_queries(pending_queries, progress)
+    results = progress.results
+
+    save_ledger(update_ledger(ledger, results, progress.failures))
+    metadata_cache.update(progress.metadata)
+    save_metadata_cache(metadata_cache)
+    print(f"{len(progress.failures)} clients failed, see _failed_clients.json")
+    write_run_report(progress.timings, started)
+    write_prometheus_textfile(progress.timings)
+    save_runtime_history(update_runtime_history(runtime_history, progress.timings, pending_queries))
+
+    record_completed_shards(feature_state, progress, output_format)
+    for feature in features:
+        state = feature_state[feature]
+        if incremental:
+            # a client whose query failed (or returned nothing) keeps its watermark and is asked again
+            state['watermarks'].update({
+                client: last_month for client, row_counts in results.items() if row_counts.get(feature)
+            })
+            save_watermarks(state['folder_name'], state['watermarks'])
+
+        combine_client_files(state['directory'], state['folder_name'], output_format)
+
+    return progress
+
+
+def record_completed_shards(feature_state, progress, output_format, skip_clients = ()):
+    """
+    Record the shard of every finished client whose feature query didn't fail in its feature's
+    manifest (see run_manifest.py).  Clients with work items still running, or in skip_clients,
+    are left out.  Returns the finished clients it looked at.
+    """
+    finished_clients = {
+        client for client in progress.results if client not in progress.remaining and client not in skip_clients
+    }
+    for feature, state in feature_state.items():
+        for client in finished_clients:
+            row_counts = progress.results[client]
+            completed = feature in row_counts and feature not in progress.failures.get(client, {})
+            if completed and os.path.exists(shard_path(state['folder_name'], client, output_format)):
+                state['manifest'][client] = shard_entry(
+                    state['folder_name'], client, output_format, state['query_hash']
+                )
+        save_manifest(state['folder_name'], state['manifest'])
+    return finished_clients
+
+
+def build_feature_query(client, feature, state, options, last_month):
+    """
+    The part of a client's work item for one feature (see main()), or None if the feature has
+    nothing to do for this client.
+    """
+    replace_from = None
+    if options['incremental']:
+        watermark = state['watermarks'].get(client)
+        if client not in state['clients_with_data']:
+            # the shard the watermark refers to is missing, truncated or from an older query
+            watermark = None
+        if watermark is not None and watermark >= last_month:
+            return None
+        if watermark is not None:
+            replace_from = add_months(watermark, 1)
+        sql = feature_sql(feature, replace_from, last_month)
+    elif client in state['clients_with_data']:
+        return None
+    else:
+        sql = feature_sql(feature)
+
+    return {
+        'client': client,
+        'feature': feature,
+        'sql': sql,
+        'folder_name': state['folder_name'],
+        'replace_from': replace_from,
+        'options': options
+    }
 
-    update_count = 0
-    print(f"dict: {len(shared_dict)}, client_list: {len(client_list)}")
-    while len(shared_dict) < len(client_list):
-        count_remaining = len(client_list) - len(shared_dict)
-        print(f"{count_remaining} remaining...")
-        update_count += 1
-        if update_count % 4 == 0:
-            list_remaining = list(set(client_list) - set(list(shared_dict.keys())))
-            print(list_remaining)
-        time.sleep(15)
 
-    result.get()
+def split_into_chunks(work_item, chunk_months, chunk_above_seconds, last_month):
+    """
+    Split the feature queries of a work item expected to take longer than chunk_above_seconds into
+    one work item per chunk_months month range.  Returns the work items to run in its place.  A
+    work item without an estimate in seconds (see runtime_history.py) isn't split.
+    """
+    if work_item['expected_seconds'] is None or work_item['expected_seconds'] <= chunk_above_seconds:
+        return [work_item]
+
+    current_month = date.today().replace(day = 1)
+    work_items = []
+    unchunked_queries = []
+    for query in work_item['feature_queries']:
+        feature = query['feature']
+        first_month = query['replace_from'] or add_months(current_month, -query_info[feature]['history_months'])
+        final_month = last_month if query['options']['incremental'] else current_month
+        chunks = month_chunks(first_month, final_month, chunk_months)
+        if len(chunks) < 2:
+            unchunked_queries.append(query)
+            continue
+
+        parts = [chunk_first for chunk_first, _ in chunks]
+        for chunk_first, chunk_last in chunks:
+            # the first chunk of a full history starts where the unchunked query does
+            from_month = None if chunk_first == first_month and query['replace_from'] is None else chunk_first
+            chunk_query = dict(
+                query, sql = feature_sql(feature, from_month, chunk_last), part = chunk_first, chunk_parts = parts
+            )
+            work_items.append(dict(
+                work_item,
+                feature_queries = [chunk_query],
+                expected_seconds = work_item['expected_seconds'] / len(chunks)
+            ))
+
+    if unchunked_queries:
+        work_items.append(dict(work_item, feature_queries = unchunked_queries))
+    return work_items
+
+
+def stitch_chunked_queries(work_items, progress):
+    """
+    Stitch the parts of every chunked feature query into its shard, and finish it as an unchunked
+    query would be.  If any chunk failed the parts are dropped and the feature counts as failed.
+    """
+    chunked_queries = {}
+    for work_item in work_items:
+        for query in work_item['feature_queries']:
+            if query.get('part') is not None:
+                chunked_queries.setdefault((query['client'], query['feature']), query)
+
+    for (client, feature), query in chunked_queries.items():
+        if feature in progress.failures.get(client, {}):
+            discard_parts(query, query['chunk_parts'])
+            progress.results[client][feature] = 0
+            continue
+
+        row_count = stitch_parts(query, query['chunk_parts'])
+        finish_query(dict(query, part = None), row_count)
+        progress.results[client][feature] = row_count
+        print(f"stitched {len(query['chunk_parts'])} chunks of {feature} for {client} ({row_count})")
+
+
+def run_pool_extraction(pending_queries, client_list, processes = 16, max_per_server = 4, checkpoint = None,
+                        checkpoint_seconds = 60):
+    """
+    Work is handed to the pool by a ServerAwareScheduler rather than map_async, so no more than
+    max_per_server queries (fewer while a server is slow) run against any one server at a time,
+    longest expected first.
+
+    Each finished client comes back through a queue filled by the pool's callbacks, so the
+    scheduler, the row counts and the progress are updated as each client finishes.
+    checkpoint(progress) is called every checkpoint_seconds and once at the end.
+    Returns the run's ExtractionProgress (row counts, failures and timings per client).
+    """
+    mp.set_start_method("spawn")
+
+    query_pool = mp.Pool(processes = processes)
+    scheduler = ServerAwareScheduler(
+        pending_queries,
+        server_of = lambda query: query['server_no'],
+        max_in_flight = processes,
+        max_per_server = max_per_server,
+        priority_of = job_priority
+    )
+    completions = queue.Queue()
+
+    def on_finished(query):
+        # called on the pool's result handler thread
+        def callback(result):
+            completions.put((query, result))
+        return callback
+
+    def dispatch_ready_queries():
+        query = scheduler.next_item()
+        while query is not None:
+            finished = on_finished(query)
+            query_pool.apply_async(get_data, (query,), callback = finished, error_callback = finished)
+            query = scheduler.next_item()
+
+    progress = ExtractionProgress(client_list)
+    last_checkpoint = time.time()
+    dispatch_ready_queries()
+    while not scheduler.is_done():
+        query, result = completions.get()
+        if isinstance(result, BaseException):
+            result = failed_result(query, result)
+        scheduler.task_done(query, [total_seconds(record) for record in result[2]])
+        progress.client_done(query['client'], *result)
+        if checkpoint and time.time() - last_checkpoint > checkpoint_seconds:
+            checkpoint(progress)
+            last_checkpoint = time.time()
+        dispatch_ready_queries()
+
+    query_pool.close()
+    query_pool.join()
+    if checkpoint:
+        checkpoint(progress)
+
+    return progress
+
+
+def failed_result(work_item, err):
+    """get_data()'s result for a work item on which get_data() itself failed, e.g. writing a shard."""
+    print(f"ERROR ({work_item['client']}): ", err)
+    features = [feature_query['feature'] for feature_query in work_item['feature_queries']]
+    record = failure_record(err, classify_error(err), 1)
+    return {feature: 0 for feature in features}, {feature: record for feature in features}, [], None
+
+
+def combine_client_files(directory, folder_name, output_format = 'csv'):
+    if output_format == 'parquet':
+        from parquet_shards import combine_parquet_shards
+        row_count = combine_parquet_shards(directory, folder_name)
+        print(f"combined {row_count} rows.")
+        print("fin.")
+        return
 
     all_filenames = [i.replace(directory, '') for i in glob.glob(f'{directory}*.csv')]
     # combine all files in the list
@@ -260,11 +751,78 @@ def main(sql, folder_name):
     combined_csv.to_csv(f"{folder_name}/_all_{folder_name}.csv", index = False, encoding = 'utf-8-sig')
     print("fin.")
 
+def feature_sql(feature, first_month = None, last_month = None):
+    """
+    Render a query_info query.  By default it covers the feature's full history_months, through the
+    current month, exactly as before.
+
+    With first_month / last_month (dates, first of the month) only those months are returned.  The
+    queried window is widened by the feature's lookback_months so rolling and cumulative columns
+    (3 month login counts, counts per academic year) still see every month they depend on, but
+    never past history_months: the full query doesn't see those months either, and a chunk that
+    did would count them into its cumulative columns.
+    """
+    info = query_info[feature]
+    first_month_offset = info['history_months']
+    if first_month is not None:
+        first_month_offset = min(months_before_current(first_month) + info['lookback_months'], info['history_months'])
+    last_month_offset = 0 if last_month is None else months_before_current(last_month)
+
+    sql = info['sql'].replace('{first_month_offset}', str(first_month_offset))
+    sql = sql.replace('{last_month_offset}', str(last_month_offset))
+    if 'report_titles' in info:
+        sql = sql.replace('{report_titles}', ', '.join(map(sql_literal, info['report_titles'])))
+    if first_month is None and last_month is None:
+        return sql
+
+    month_filters = []
+    if first_month is not None:
+        month_filters.append(f"month_start::date >= '{first_month.isoformat()}'")
+    if last_month is not None:
+        month_filters.append(f"month_start::date <= '{last_month.isoformat()}'")
+    return f"SELECT * FROM ({sql.strip().rstrip(';')}) feature_rows WHERE {' AND '.join(month_filters)}"
+
+
 # folder_names: dna_prebuilt_report_usage, dna_system_admin_tenure
+#
+# Each query covers the months from {first_month_offset} months before the current month through
+# {last_month_offset} months before it (filled in by feature_sql()).  history_months is the default
+# window; lookback_months is how many earlier months a month's row depends on (3 month rolling
+# logins for system_admin, cumulative counts per academic year for common_asmts).
+#
+# {sf_an} and {ay_start_end} are the bodies of the client's sf_an and ay_start_end CTEs, filled in
+# by get_data() from the client's cached metadata (see client_metadata.py).
+#
+# table is the talend warehouse table the feature's shards are loaded into, keyed by key_columns
+# (see warehouse_loader.py).
+#
+# report_titles are the prebuilt reports whose usage the reports query counts ({report_titles}),
+# each with the column prefix of its *_times_accessed / *_distinct_users columns in the table's
+# pivot, all_dna_prebuilt_report_usage_pivot (one row per sf_an, client, month_start).  A new
+# report is an entry here (at the end), plus its two columns in client_health_full_training_data.sql
+# to use it in the models; that file also creates the pivot with these columns when the loader
+# hasn't run yet, so the entry goes at the end of its pivot as well.
+
+PREBUILT_REPORTS = {
+    'Assessment Matrix Report': 'matrix',
+    'Assessment Response Frequency': 'rsp_freq',
+    'Skills Assessment Parent Letter': 'skills_letter',
+    'Site Assessment Overview': 'site_asmt_ovr',
+    'Teacher Assessment Overview': 'teacher_asmt_ovr',
+    'Assessment Student Overview': 'asmt_stu_ovr',
+    'Assessment Site Peer Comparison': 'site_peer_comp',
+    'Assessment Teacher Peer Comparison': 'teacher_peer_comp',
+    'Multiple Assessment Summary Report': 'mltp_asmt_smry'
+}
 
 query_info = {
     'reports': {
-        'folder_name':'dna_prebuilt_report_usage',
+        'folder_name': 'dna_prebuilt_report_usage',
+        'table': 'all_dna_prebuilt_report_usage',
+        'key_columns': ['sf_an', 'client', 'month_start', 'title'],
+        'report_titles': PREBUILT_REPORTS,
+        'history_months': 60,
+        'lookback_months': 0,
         'sql':"""       
         WITH
             reporting_periods AS (
@@ -272,37 +830,19 @@ query_info = {
                     d::date AS month_start,
                     (d + '1 month'::interval - '1 day'::interval)::date month_end
                 FROM GENERATE_SERIES(
-                        (DATE_TRUNC('month', CURRENT_DATE)::date - INTERVAL '5 years')::date,
-                        (DATE_TRUNC('month', CURRENT_DATE::date) + INTERVAL '1 month' - INTERVAL '1 day')::date,
+                        (DATE_TRUNC('month', CURRENT_DATE)::date - INTERVAL '{first_month_offset} months')::date,
+                        (DATE_TRUNC('month', CURRENT_DATE::date) - INTERVAL '{last_month_offset} months'
+                            + INTERVAL '1 month' - INTERVAL '1 day')::date,
                         '1 month'::interval
                     ) AS d
             ),
             
             ay_start_end AS (
-                SELECT
-                    academic_year,
-                    MIN(start_date) AS start_date,
-                    MAX(end_date) AS end_date
-                FROM session_dates
-                GROUP BY academic_year
+                {ay_start_end}
             ),
         
             sf_an AS (
-                SELECT
-                    COALESCE(CASE
-                                 WHEN EXISTS(SELECT definition_id
-                                             FROM config.definitions
-                                             WHERE key ILIKE 'salesforce.account_number')
-                                     THEN (
-                                     SELECT value::text
-                                     FROM config.entries
-                                     WHERE definition_id = (
-                                         SELECT definition_id
-                                         FROM config.definitions
-                                         WHERE key ILIKE 'salesforce.account_number'
-                                     )
-                                 )
-                                 END, 'none'::text) AS sf_an
+                {sf_an}
             ),
         
             report_usage_by_month AS (
@@ -316,7 +856,7 @@ query_info = {
                 FROM (
                     SELECT *
                     FROM reporting_periods rp
-                    JOIN UNNEST(ARRAY ['Assessment Matrix Report', 'Assessment Response Frequency', 'Skills Assessment Parent Letter', 'Site Assessment Overview', 'Teacher Assessment Overview', 'Assessment Student Overview', 'Assessment Site Peer Comparison', 'Assessment Teacher Peer Comparison', 'Multiple Assessment Summary Report']) AS title ON TRUE
+                    JOIN UNNEST(ARRAY [{report_titles}]) AS title ON TRUE
                 ) AS reporting_periods
         
                 JOIN reports.jasper_prebuilts j ON j.title = reporting_periods.title
@@ -352,24 +892,14 @@ query_info = {
     },
     'system_admin': {
         'folder_name': 'dna_system_admin_tenure',
+        'table': 'all_dna_system_admin_tenure',
+        'key_columns': ['sf_an', 'client', 'month_start'],
+        'history_months': 60,
+        'lookback_months': 2,
         'sql':"""
         WITH
             sf_an AS (
-                SELECT
-                    COALESCE(CASE
-                                 WHEN EXISTS(SELECT definition_id
-                                             FROM config.definitions
-                                             WHERE key ILIKE 'salesforce.account_number')
-                                     THEN (
-                                     SELECT value::text
-                                     FROM config.entries
-                                     WHERE definition_id = (
-                                         SELECT definition_id
-                                         FROM config.definitions
-                                         WHERE key ILIKE 'salesforce.account_number'
-                                     )
-                                 )
-                                 END, 'none'::text) AS sf_an
+                {sf_an}
             ),
         
             reporting_periods AS (
@@ -377,8 +907,9 @@ query_info = {
                     d::date AS month_start,
                     (d + '1 month'::interval - '1 day'::interval)::date month_end
                 FROM GENERATE_SERIES(
-                        (DATE_TRUNC('month', CURRENT_DATE)::date - INTERVAL '5 years')::date,
-                        (DATE_TRUNC('month', CURRENT_DATE::date) + INTERVAL '1 month' - INTERVAL '1 day')::date,
+                        (DATE_TRUNC('month', CURRENT_DATE)::date - INTERVAL '{first_month_offset} months')::date,
+                        (DATE_TRUNC('month', CURRENT_DATE::date) - INTERVAL '{last_month_offset} months'
+                            + INTERVAL '1 month' - INTERVAL '1 day')::date,
                         '1 month'::interval
                     ) AS d
             ),
@@ -504,40 +1035,25 @@ query_info = {
     },
     'common_asmts': {
         'folder_name': 'dna_common_assessments',
+        'table': 'dna_common_assessments',
+        'key_columns': ['sf_an', 'client', 'month_start'],
+        'history_months': 48,
+        'lookback_months': 12,
         'sql': """
         WITH
             sf_an AS (
-                SELECT
-                    COALESCE(CASE
-                                 WHEN EXISTS(SELECT definition_id
-                                             FROM config.definitions
-                                             WHERE key ILIKE 'salesforce.account_number')
-                                     THEN (
-                                     SELECT value::text
-                                     FROM config.entries
-                                     WHERE definition_id = (
-                                         SELECT definition_id
-                                         FROM config.definitions
-                                         WHERE key ILIKE 'salesforce.account_number'
-                                     )
-                                 )
-                                 END, 'none'::text) AS sf_an
+                {sf_an}
             ),
         
             ay_start_end AS (
-                SELECT
-                    academic_year,
-                    MIN(start_date) AS start_date,
-                    MAX(end_date) AS end_date
-                FROM session_dates
-                GROUP BY academic_year
+                {ay_start_end}
             ),
         
             MONTHS AS (
                 SELECT
-                        DATE_TRUNC('month', CURRENT_DATE) - (INTERVAL '1 MONTH' * GENERATE_SERIES(0, 48)) AS month_start,
+                        DATE_TRUNC('month', CURRENT_DATE) - (INTERVAL '1 MONTH' * GENERATE_SERIES({last_month_offset}, {first_month_offset})) AS month_start,
                         DATE_TRUNC('month', CURRENT_DATE) + INTERVAL '1 MONTH' - INTERVAL '1 DAY' -
-                        (INTERVAL '1 MONTH' * GENERATE_SERIES(0, 48)) AS month_end
+                        (INTERVAL '1 MONTH' * GENERATE_SERIES({last_month_offset}, {first_month_offset})) AS month_end
             ),
         
             stu_count_per_assessment_per_site AS (
@@ -609,7 +1125,10 @@ query_info = {
 
 
 # Change 'reports' to 'system_admin' or 'common_asmts' to generate data for different features
+# Pass engine = 'async' to run the whole fleet from one asyncio event loop instead of the process pool
+# Pass incremental = True for the monthly refresh (only the months after each client's watermark)
 if __name__ == '__main__':
-    main(query_info['reports']['sql'], query_info['reports']['folder_name'])
+    # every feature set in one pass over the client DBs; main('reports') runs just the one
+    main(list(query_info))
 
 
@@ -0,0 +1,252 @@
+"""
+Typed, compressed parquet shards for the feature extraction, and a dataset-level merge.
+
+Column types come from the Postgres type oids in the cursor description (for COPY exports, of
+the query described beforehand) rather than from inspecting values, so every client's shard of a feature set has the same schema (even clients
+whose result is empty or all NULL) and the folder can be read back as a single Arrow dataset.
+"""
+
+import os
+from decimal import Decimal
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from extraction_common import in_progress_path, shard_path
+
+
+# Postgres type oid -> arrow type.  Anything not listed is written as its string representation.
+PG_TYPE_OIDS = {
+    16: pa.bool_(),                             # bool
+    20: pa.int64(),                             # int8
+    21: pa.int64(),                             # int2
+    23: pa.int64(),                             # int4
+    700: pa.float64(),                          # float4
+    701: pa.float64(),                          # float8
+    1700: pa.float64(),                         # numeric
+    25: pa.string(),                            # text
+    1042: pa.string(),                          # bpchar
+    1043: pa.string(),                          # varchar
+    1082: pa.date32(),                          # date
+    1114: pa.timestamp('us'),                   # timestamp
+    1184: pa.timestamp('us', tz = 'UTC'),       # timestamptz
+    1000: pa.list_(pa.bool_()),                 # bool[]
+    1007: pa.list_(pa.int64()),                 # int4[]
+    1016: pa.list_(pa.int64()),                 # int8[]
+    1009: pa.list_(pa.string()),                # text[]
+    1015: pa.list_(pa.string()),                # varchar[]
+}
+
+COMPRESSION = 'zstd'
+
+
+def arrow_type(type_oid):
+    return PG_TYPE_OIDS.get(type_oid, pa.string())
+
+
+def to_arrow_value(value, arrow_type):
+    if value is None:
+        return None
+    if isinstance(value, Decimal) and pa.types.is_floating(arrow_type):
+        return float(value)
+    if pa.types.is_string(arrow_type) and not isinstance(value, str):
+        return str(value)
+    return value
+
+
+def shard_schema(colnames, type_oids = None):
+    """Schema of a client shard: the client column, then the query's columns typed by their oids."""
+    type_oids = type_oids or [None] * len(colnames)
+    return pa.schema(
+        [('client', pa.string())] + [(name, arrow_type(oid)) for name, oid in zip(colnames, type_oids)]
+    )
+
+
+def parse_array_literals(column, list_type):
+    """
+    Postgres' text form of one-dimensional arrays ({a,b}, elements double quoted when they need
+    it) to a list column.  Quoted elements containing commas are not supported.
+    """
+    inner = pc.utf8_slice_codeunits(column, 1, -1)
+    elements = pc.if_else(
+        pc.equal(inner, ''), pa.scalar([], pa.list_(pa.string())), pc.split_pattern(inner, ',')
+    )
+    values = pc.replace_substring_regex(elements.values, r'^"(.*)"$', r'\1')
+    values = pc.if_else(pc.equal(elements.values, 'NULL'), pa.scalar(None, pa.string()), values)
+    lists = pa.ListArray.from_arrays(elements.offsets, values, mask = pc.is_null(column))
+    return lists.cast(list_type)
+
+
+def read_copy_csv(path, schema = None):
+    """A COPY ... TO STDOUT WITH CSV HEADER export as a table, of schema if given."""
+    if schema is None:
+        return pa_csv.read_csv(path)
+
+    column_types = {
+        field.name: pa.string() if pa.types.is_list(field.type) else field.type for field in schema
+    }
+    table = pa_csv.read_csv(path, convert_options = pa_csv.ConvertOptions(
+        column_types = column_types,
+        true_values = ['t'],
+        false_values = ['f'],
+        # NULL is an unquoted empty value, an empty string a quoted one
+        strings_can_be_null = True,
+        quoted_strings_can_be_null = False
+    ))
+    columns = [
+        parse_array_literals(table[field.name].combine_chunks(), field.type) if pa.types.is_list(field.type)
+        else table[field.name]
+        for field in schema
+    ]
+    return pa.Table.from_arrays(columns, schema = schema)
+
+
+class ParquetShardWriter:
+    """
+    Drop-in replacement for ClientShardWriter that writes {client}_{folder_name}.parquet.
+
+    Each write_rows() batch becomes a row group, so streaming fetches stay flat in memory.  Like
+    ClientShardWriter, it writes to a temp file that replaces the shard on close().
+    """
+
+    def __init__(self, folder_name, client, path = None):
+        self.client = client
+        self.path = path or shard_path(folder_name, client, 'parquet')
+        self.tmp_path = in_progress_path(self.path)
+        self.schema = None
+        self.parquet_writer = None
+        self.copy_path = None
+        self.copy_file = None
+        self.row_count = 0
+
+    def write_header(self, colnames, type_oids = None):
+        self.schema = shard_schema(colnames, type_oids)
+        self.parquet_writer = pq.ParquetWriter(self.tmp_path, self.schema, compression = COMPRESSION)
+
+    def write_rows(self, rows):
+        columns = [pa.array([self.client] * len(rows), pa.string())]
+        for index, field in enumerate(self.schema):
+            if index == 0:
+                continue
+            values = [to_arrow_value(row[index - 1], field.type) for row in rows]
+            columns.append(pa.array(values, field.type))
+        self.parquet_writer.write_table(pa.Table.from_arrays(columns, schema = self.schema))
+        self.row_count += len(rows)
+
+    def csv_sink(self, colnames = None, type_oids = None):
+        """
+        COPY exports arrive as csv; they are spooled to a temp file and converted on close() by
+        arrow's (multi-threaded, C++) csv reader.  With the query's colnames and type_oids (see
+        describe_sql()) the columns get the same types as from a cursor fetch, arrays included, so
+        every shard of the feature has one schema; without them arrow infers the types per shard.
+        """
+        if colnames is not None:
+            self.schema = shard_schema(colnames, type_oids)
+        self.copy_path = f'{self.tmp_path}.csv'
+        self.copy_file = open(self.copy_path, 'w')
+        return self.copy_file
+
+    def close(self):
+        if self.copy_file is not None:
+            self.copy_file.close()
+            table = read_copy_csv(self.copy_path, self.schema)
+            pq.write_table(table, self.tmp_path, compression = COMPRESSION)
+            os.remove(self.copy_path)
+            os.replace(self.tmp_path, self.path)
+            self.row_count = table.num_rows
+        elif self.parquet_writer is not None:
+            self.parquet_writer.close()
+            os.replace(self.tmp_path, self.path)
+        return self.row_count
+
+    def discard(self):
+        """Drop a partially written shard so the client is picked up again on the next run."""
+        if self.copy_file is not None:
+            self.copy_file.close()
+            os.remove(self.copy_path)
+        if self.parquet_writer is not None:
+            self.parquet_writer.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+
+def csv_schema(schema):
+    """The schema of csv_compatible() batches of schema."""
+    return pa.schema([
+        pa.field(field.name, pa.string()) if pa.types.is_list(field.type) else field for field in schema
+    ])
+
+
+def csv_compatible(batch):
+    """Arrow's csv writer has no list support; write arrays as Postgres array literals ({a,b})."""
+    columns = []
+    for column in batch.columns:
+        if pa.types.is_list(column.type):
+            joined = pc.binary_join(pc.cast(column, pa.list_(pa.string())), ',')
+            column = pc.binary_join_element_wise('{', joined, '}', '')
+        columns.append(column)
+    return pa.RecordBatch.from_arrays(columns, names = batch.schema.names)
+
+
+def merged_schema(schemas):
+    """
+    One schema for the shards of a feature.  Shards written from the query's type oids agree; a
+    column that older shards typed differently (e.g. by csv inference) falls back to string, to
+    which the dataset casts every shard.
+    """
+    types = {}
+    for schema in schemas:
+        for field in schema:
+            if pa.types.is_null(field.type):
+                types.setdefault(field.name, field.type)
+            elif pa.types.is_null(types.get(field.name, pa.null())):
+                types[field.name] = field.type
+            elif types[field.name] != field.type:
+                types[field.name] = pa.string()
+    return pa.schema(list(types.items()))
+
+
+def combine_parquet_shards(directory, folder_name):
+    """
+    Merge every client shard in directory into _all_{folder_name}.parquet (and .csv, for the
+    talend loads) by streaming record batches through an Arrow dataset, instead of parsing every
+    shard into pandas and concatenating them in memory.
+
+    Files starting with '_' (previous merges) are not shards and are skipped.
+    """
+    shard_files = [
+        os.path.join(directory, f) for f in sorted(os.listdir(directory))
+        if f.endswith('.parquet') and not f.startswith('_')
+    ]
+    if not shard_files:
+        return 0
+    schema = merged_schema([pq.read_schema(f) for f in shard_files])
+    dataset = ds.dataset(shard_files, schema = schema, format = 'parquet')
+
+    parquet_out = pq.ParquetWriter(f"{folder_name}/_all_{folder_name}.parquet", schema, compression = COMPRESSION)
+    csv_out = None
+    for batch in dataset.to_batches():
+        parquet_out.write_batch(batch)
+        csv_batch = csv_compatible(batch)
+        if csv_out is None:
+            csv_out = pa_csv.CSVWriter(f"{folder_name}/_all_{folder_name}.csv", csv_batch.schema)
+        csv_out.write_batch(csv_batch)
+
+    parquet_out.close()
+    if csv_out is not None:
+        csv_out.close()
+
+    return dataset.count_rows()
+
+
+def merge_parquet_delta(shard, delta, replace_from):
+    """Parquet counterpart of the csv splice in incremental_extraction.merge_delta_into_shard()."""
+    stored = pq.read_table(shard)
+    keep = pc.less(pc.cast(stored['month_start'], pa.date32()), pa.scalar(replace_from, pa.date32()))
+    merged = pa.concat_tables([stored.filter(keep), pq.read_table(delta)], promote_options = 'permissive')
+
+    tmp_path = f'{shard}.tmp'
+    pq.write_table(merged, tmp_path, compression = COMPRESSION)
+    os.replace(tmp_path, shard)
+    os.remove(delta)
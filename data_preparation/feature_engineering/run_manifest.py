@@ -0,0 +1,101 @@
+"""
+Run manifest of a feature folder: which client shards are complete, and from which query.
+
+Shards are only ever written to a temp file and renamed into place once complete (see
+ClientShardWriter), so a crash can't leave a truncated shard under its real name.  After each run
+main() records every shard it completed in {folder_name}/_manifest.json:
+
+    client -> {sha256, bytes, mtime_ns, rows, query_hash, written_at}
+
+A client is skipped on the next run only if its shard is still the file the manifest describes
+(same size, and same mtime or sha256) and was extracted by the current version of the feature
+query (query_hash).  Shards from before the manifest, or that no longer match it, are extracted
+again.
+"""
+
+import csv
+import hashlib
+import json
+import os
+from datetime import datetime
+from extraction_common import shard_path
+
+
+def manifest_path(folder_name):
+    return f'{folder_name}/_manifest.json'
+
+
+def load_manifest(folder_name):
+    if not os.path.exists(manifest_path(folder_name)):
+        return {}
+    with open(manifest_path(folder_name)) as file:
+        return json.load(file)
+
+
+def save_manifest(folder_name, manifest):
+    tmp_path = f'{manifest_path(folder_name)}.tmp'
+    with open(tmp_path, 'w') as file:
+        json.dump(manifest, file, indent = 1, sort_keys = True)
+    os.replace(tmp_path, manifest_path(folder_name))
+
+
+def query_hash(info):
+    """
+    Hash of a query_info entry: its SQL template, month window and report titles, not the rendered
+    offsets.
+    """
+    definition = [info['sql'], info['history_months'], info['lookback_months']]
+    if 'report_titles' in info:
+        definition.append(list(info['report_titles']))
+    definition = json.dumps(definition)
+    return hashlib.sha256(definition.encode()).hexdigest()[:16]
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def shard_rows(path, output_format):
+    if output_format == 'parquet':
+        import pyarrow.parquet as pq
+        return pq.ParquetFile(path).metadata.num_rows
+    with open(path, newline = '') as file:
+        return max(sum(1 for _ in csv.reader(file)) - 1, 0)
+
+
+def shard_entry(folder_name, client, output_format, current_query_hash):
+    """Manifest entry for a client's completed shard as it is on disk now."""
+    path = shard_path(folder_name, client, output_format)
+    stat = os.stat(path)
+    return {
+        'sha256': file_sha256(path),
+        'bytes': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'rows': shard_rows(path, output_format),
+        'query_hash': current_query_hash,
+        'written_at': datetime.now().isoformat(timespec = 'seconds')
+    }
+
+
+def shard_is_complete(entry, folder_name, client, output_format, current_query_hash):
+    if entry is None or entry['query_hash'] != current_query_hash:
+        return False
+    path = shard_path(folder_name, client, output_format)
+    if not os.path.exists(path):
+        return False
+    stat = os.stat(path)
+    if stat.st_size != entry['bytes']:
+        return False
+    # an untouched shard keeps its mtime; only a touched one is worth hashing
+    return stat.st_mtime_ns == entry['mtime_ns'] or file_sha256(path) == entry['sha256']
+
+
+def complete_clients(manifest, folder_name, output_format, current_query_hash):
+    return {
+        client for client, entry in manifest.items()
+        if shard_is_complete(entry, folder_name, client, output_format, current_query_hash)
+    }
@@ -0,0 +1,119 @@
+"""
+Per-client, per-feature runtimes of past runs, for longest-job-first scheduling.
+
+_runtime_history.json keeps run mode -> client -> {feature: seconds}, a moving average over runs
+of the time a client's feature query took (connect, execute, fetch and write; see
+extraction_metrics.py).  A full query (the whole history) and an incremental one (the months
+after the watermark) take very different times, so each run mode has its own averages and a query
+is estimated from those of its mode.  A client the history has not seen yet is estimated from its
+database size (pg_database_size), at the median seconds per byte of the clients that have been
+seen for the feature and mode.  Without a rate there is no estimate in seconds; job_priority()
+then orders those clients by size alone.
+"""
+
+import json
+import os
+from collections import defaultdict
+from extraction_metrics import percentile, total_seconds
+
+
+HISTORY_PATH = '_runtime_history.json'
+# weight of the latest run in the moving average
+SMOOTHING = 0.5
+RUN_MODES = ('full', 'incremental')
+
+
+def run_mode(query):
+    """'incremental' for a feature query (or chunk of one) that starts after the watermark, else 'full'."""
+    return 'full' if query['replace_from'] is None else 'incremental'
+
+
+def load_runtime_history(path = HISTORY_PATH):
+    history = {}
+    if os.path.exists(path):
+        with open(path) as file:
+            history = json.load(file)
+        if not set(history) <= set(RUN_MODES):
+            # a history from before the run modes were kept apart, when most runs were full ones
+            history = {'full': history}
+    return {mode: history.get(mode, {}) for mode in RUN_MODES}
+
+
+def save_runtime_history(history, path = HISTORY_PATH):
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as file:
+        json.dump(history, file, indent = 1, sort_keys = True)
+    os.replace(tmp_path, path)
+
+
+def update_runtime_history(history, timings, work_items):
+    """
+    Fold the successful query timings of a run (ExtractionProgress.timings) into the history of
+    each query's run mode, as given by the run's work_items.  The timings of a feature query's
+    month-range chunks are added up into one runtime of the feature.
+    """
+    modes = {
+        (query['client'], query['feature']): run_mode(query)
+        for work_item in work_items for query in work_item['feature_queries']
+    }
+    run_seconds = defaultdict(float)
+    for record in timings:
+        if record['status'] != 'ok' or record['feature'] is None:
+            continue
+        run_seconds[(record['client'], record['feature'])] += total_seconds(record)
+
+    for (client, feature), seconds in run_seconds.items():
+        if (client, feature) not in modes:
+            continue
+        features = history[modes[(client, feature)]].setdefault(client, {})
+        previous = features.get(feature)
+        if previous is not None:
+            seconds = SMOOTHING * seconds + (1 - SMOOTHING) * previous
+        features[feature] = seconds
+    return history
+
+
+def seconds_per_byte(history, db_sizes):
+    """
+    run mode -> feature -> median seconds per database byte over the clients with both a runtime
+    (of the mode) and a size.
+    """
+    rates = {}
+    for mode in RUN_MODES:
+        ratios = defaultdict(list)
+        for client, features in history[mode].items():
+            if db_sizes.get(client):
+                for feature, seconds in features.items():
+                    ratios[feature].append(seconds / db_sizes[client])
+        rates[mode] = {feature: percentile(values, 0.5) for feature, values in ratios.items()}
+    return rates
+
+
+def expected_seconds(work_item, history, db_sizes, rates):
+    """
+    Expected runtime in seconds of a work item (every feature query of one client, see main()), or
+    None if one of its features has neither a runtime nor a rate (of the query's run mode) to
+    convert the client's database size into one.
+    """
+    client = work_item['client']
+    seconds = 0.0
+    for query in work_item['feature_queries']:
+        feature = query['feature']
+        mode = run_mode(query)
+        if feature in history[mode].get(client, {}):
+            seconds += history[mode][client][feature]
+        elif feature in rates[mode] and db_sizes.get(client):
+            seconds += rates[mode][feature] * db_sizes[client]
+        else:
+            return None
+    return seconds
+
+
+def job_priority(work_item):
+    """
+    Scheduling priority (higher starts first): work items without an estimate come first, largest
+    database first, then the rest by expected_seconds.
+    """
+    if work_item['expected_seconds'] is None:
+        return (1, work_item.get('db_size', 0))
+    return (0, work_item['expected_seconds'])
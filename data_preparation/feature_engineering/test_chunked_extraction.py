@@ -0,0 +1,58 @@
+"""
+A chunked feature query returns what the unchunked one does: each chunk reads no month the full
+query doesn't (so cumulative columns, e.g. common_asmts' counts per academic year, add up the same
+months), and the chunks' months together are the full query's months.
+"""
+
+from datetime import date
+import pytest
+from fake_fleet import FLEET_DEFAULTS, FakeQuery, query_months, query_window
+from incremental_extraction import add_months, last_complete_month
+from multiprocessing_script_to_generate_additional_features import feature_sql, query_info, split_into_chunks
+
+
+def returned_months(sql):
+    first, last = query_months(sql)
+    return set(range(first, last + 1))
+
+
+def chunk_queries(feature, chunk_months, replace_from = None):
+    query = {
+        'feature': feature,
+        'client': 'client',
+        'sql': feature_sql(feature, replace_from, last_complete_month()) if replace_from else feature_sql(feature),
+        'replace_from': replace_from,
+        'options': {'incremental': replace_from is not None}
+    }
+    work_item = {'client': 'client', 'feature_queries': [query], 'expected_seconds': 1000}
+    chunks = split_into_chunks(work_item, chunk_months, 0, last_complete_month())
+    return query, [chunk_query for chunk in chunks for chunk_query in chunk['feature_queries']]
+
+
+@pytest.mark.parametrize('feature', sorted(query_info))
+@pytest.mark.parametrize('chunk_months', [1, 6, 12, 25])
+@pytest.mark.parametrize('incremental', [False, True])
+def test_chunks_stay_inside_the_unchunked_window(feature, chunk_months, incremental):
+    replace_from = None
+    if incremental:
+        replace_from = add_months(date.today().replace(day = 1), 2 - query_info[feature]['history_months'])
+    query, chunks = chunk_queries(feature, chunk_months, replace_from)
+    assert len(chunks) > 1
+
+    full_first, full_last = query_window(feature_sql(feature))
+    months = set()
+    for chunk in chunks:
+        first, last = query_window(chunk['sql'])
+        assert full_first <= first and last <= full_last
+        assert not months & returned_months(chunk['sql'])
+        months |= returned_months(chunk['sql'])
+    assert months == returned_months(query['sql'])
+
+
+@pytest.mark.parametrize('feature', sorted(query_info))
+def test_chunked_fake_fleet_rows_match_unchunked(feature):
+    config = dict(FLEET_DEFAULTS, rows = 600)
+    query, chunks = chunk_queries(feature, 7)
+    full = FakeQuery('01', 'fake01_000', query['sql'], config)
+    chunked = [FakeQuery('01', 'fake01_000', chunk['sql'], config) for chunk in chunks]
+    assert [row for part in chunked for row in part.rows(part.row_count)] == full.rows(full.row_count)
@@ -0,0 +1,189 @@
+"""
+Load the feature shards into the talend warehouse tables behind client_health_full_training_data.
+
+For each feature the shards that changed since they were last loaded (per the feature's run
+manifest, see run_manifest.py) are streamed into a temp staging table with COPY ... FROM STDIN
+and merged into the feature's query_info table in one upsert keyed on its key_columns:
+
+    python warehouse_loader.py --features reports system_admin common_asmts
+
+Duplicate keys are resolved once, in the merge, so a load can be repeated without doubling rows
+and the training data doesn't have to DISTINCT ON them at query time.  The upsert needs a unique
+index on key_columns (see feature_table_keys.sql).  What was loaded is kept in
+{folder_name}/_loaded.json (client -> sha256 of the loaded shard).
+
+A feature with report_titles (the prebuilt reports) also gets {table}_pivot, a view with one
+row per sf_an, client and month_start and a times_accessed / distinct_users column pair per
+report, built in a single pass over the table; the training data joins it once instead of once
+per report.  CREATE OR REPLACE VIEW can only add columns at the end, so new reports go at the
+end of PREBUILT_REPORTS (removing one means dropping the view and the views that use it).
+
+Triggers on the tables mark the months a load changed, for the next
+CALL refresh_client_health_full_training_data(); (see client_health_full_training_data.sql).
+"""
+
+import argparse
+import csv
+import io
+import json
+import os
+import psycopg2
+from extraction_common import shard_path, sql_identifier, sql_literal
+from run_manifest import load_manifest
+
+
+WAREHOUSE = {
+    'host': "localhost",
+    'database': "talend",
+    'user': "franck",
+    'password': "REMOVE"
+}
+
+
+def connect_to_warehouse():
+    return psycopg2.connect(**WAREHOUSE, options = '-c statement_timeout=300000')
+
+
+def loaded_path(folder_name):
+    return f'{folder_name}/_loaded.json'
+
+
+def load_loaded(folder_name):
+    if not os.path.exists(loaded_path(folder_name)):
+        return {}
+    with open(loaded_path(folder_name)) as file:
+        return json.load(file)
+
+
+def save_loaded(folder_name, loaded):
+    tmp_path = f'{loaded_path(folder_name)}.tmp'
+    with open(tmp_path, 'w') as file:
+        json.dump(loaded, file, indent = 1, sort_keys = True)
+    os.replace(tmp_path, loaded_path(folder_name))
+
+
+def shards_to_load(folder_name, output_format = 'csv', reload = False):
+    """Clients whose complete shard (per the manifest) isn't the one last loaded."""
+    loaded = {} if reload else load_loaded(folder_name)
+    return {
+        client: entry['sha256'] for client, entry in load_manifest(folder_name).items()
+        if loaded.get(client) != entry['sha256'] and os.path.exists(shard_path(folder_name, client, output_format))
+    }
+
+
+def copy_shard(cursor, staging_table, path, output_format = 'csv'):
+    """COPY one shard into staging_table.  Returns the shard's columns."""
+    if output_format == 'parquet':
+        import pyarrow as pa
+        import pyarrow.csv as pa_csv
+        import pyarrow.parquet as pq
+        from parquet_shards import csv_compatible, csv_schema
+        table = pq.read_table(path)
+        # arrays (e.g. system_admin's usernames) go in as Postgres array literals
+        batches = [csv_compatible(batch) for batch in table.to_batches()]
+        file = io.BytesIO()
+        pa_csv.write_csv(pa.Table.from_batches(batches, schema = csv_schema(table.schema)), file)
+        file.seek(0)
+        columns = table.column_names
+    else:
+        file = open(path, newline = '')
+        columns = next(csv.reader(file))
+        file.seek(0)
+
+    try:
+        cursor.copy_expert(
+            f"COPY {staging_table} ({', '.join(map(sql_identifier, columns))}) FROM STDIN WITH CSV HEADER", file
+        )
+    finally:
+        file.close()
+    return columns
+
+
+def merge_sql(table, staging_table, columns, key_columns):
+    """Upsert the staging rows into table, one row per key."""
+    column_list = ', '.join(map(sql_identifier, columns))
+    key_list = ', '.join(map(sql_identifier, key_columns))
+    updates = ', '.join(
+        f"{sql_identifier(column)} = EXCLUDED.{sql_identifier(column)}"
+        for column in columns if column not in key_columns
+    )
+    return f"""
+        INSERT INTO {table} ({column_list})
+        SELECT DISTINCT ON ({key_list}) {column_list}
+        FROM {staging_table}
+        ORDER BY {key_list}
+        ON CONFLICT ({key_list}) DO UPDATE SET {updates}
+    """
+
+
+def report_pivot_sql(table, report_titles):
+    """report_titles: {title: column prefix}, see PREBUILT_REPORTS."""
+    columns = ',\n'.join(
+        f"""            MAX(times_accessed) FILTER (WHERE title = {sql_literal(title)}) AS {prefix}_times_accessed,
+            MAX(count_of_distinct_users) FILTER (WHERE title = {sql_literal(title)}) AS {prefix}_distinct_users"""
+        for title, prefix in report_titles.items()
+    )
+    return f"""
+        CREATE OR REPLACE VIEW {table}_pivot AS
+        SELECT
+            sf_an,
+            client,
+            month_start,
+{columns}
+        FROM {table}
+        WHERE title IN ({', '.join(map(sql_literal, report_titles))})
+        GROUP BY sf_an, client, month_start
+    """
+
+
+def load_feature(info, output_format = 'csv', reload = False):
+    """
+    Load the new and changed shards of one query_info entry into its table.  Returns the number of
+    rows upserted.  reload = True loads every complete shard again.
+    """
+    folder_name = info['folder_name']
+    table = info['table']
+    shards = shards_to_load(folder_name, output_format, reload)
+    if not shards:
+        print(f"{table}: nothing to load")
+        return 0
+
+    staging_table = f'{table}_staging'
+    db_connection = connect_to_warehouse()
+    try:
+        cursor = db_connection.cursor()
+        cursor.execute(f"CREATE TEMP TABLE {staging_table} (LIKE {table} INCLUDING DEFAULTS) ON COMMIT DROP")
+        columns = None
+        for client in sorted(shards):
+            path = shard_path(folder_name, client, output_format)
+            shard_columns = copy_shard(cursor, staging_table, path, output_format)
+            columns = columns or shard_columns
+        cursor.execute(merge_sql(table, staging_table, columns, info['key_columns']))
+        row_count = cursor.rowcount
+        if 'report_titles' in info:
+            cursor.execute(report_pivot_sql(table, info['report_titles']))
+        db_connection.commit()
+        cursor.close()
+    finally:
+        db_connection.close()
+
+    loaded = {} if reload else load_loaded(folder_name)
+    loaded.update(shards)
+    save_loaded(folder_name, loaded)
+    print(f"{table}: loaded {len(shards)} shards, upserted {row_count} rows")
+    return row_count
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--features', nargs = '+')
+    parser.add_argument('--output-format', choices = ['csv', 'parquet'], default = 'csv')
+    parser.add_argument('--reload', action = 'store_true', help = 'load every complete shard again')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    from multiprocessing_script_to_generate_additional_features import query_info
+    args = parse_args()
+    for feature in args.features or list(query_info):
+        load_feature(query_info[feature], args.output_format, args.reload)
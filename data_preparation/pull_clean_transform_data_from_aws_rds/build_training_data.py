@@ -0,0 +1,113 @@
+"""
+Pulls the training data from AWS RDS with get_training_data_from_aws_rds.sql and adds the features
+that are computed in python rather than in the query:
+
+- hs_did_change / hs_change_type target labels over the 3 month window (forward_labels.py)
+- hs_*_lag_band lagged client health bands (lag_features.py)
+- subscriber_tenure_days client tenure at the end of the month, 0 while lapsed (client_tenure.py)
+
+The result is written to aws_talend_training_data.csv, the data behind the aws_talend_training_data
+table of the talend warehouse, with the columns of TRAINING_DATA_COLUMNS in that order.  The
+engines can compute more (other label horizons, lag dates and scores); a new column goes into
+TRAINING_DATA_COLUMNS together with the table and client_health_full_training_data.sql.
+"""
+
+import os
+import pandas as pd
+import psycopg2
+import pandas.io.sql as sqlio
+from client_tenure import subscriber_tenure, update_subscriber_runs
+from forward_labels import add_forward_labels
+from lag_features import HS_LAGS, add_lag_features
+
+
+SQL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'get_training_data_from_aws_rds.sql')
+OUTPUT_PATH = 'aws_talend_training_data.csv'
+
+# the columns of aws_talend_training_data, in the table's order
+TRAINING_DATA_COLUMNS = [
+    'start_date',
+    'sf_an',
+    'atd_database',
+    'hs_band',
+    'band_number',
+    'hs_did_change',
+    'hs_change_type',
+    'change_type_order',
+    'atd_client_health_score',
+    'atd_users_login_percent',
+    'atd_students_assessed_percent',
+    'atd_feature_adoption_score',
+    'asmt_admin_flex',
+    'asmt_admin_ib',
+    'user_created_custom_reports',
+    'state',
+    'csm_name',
+    'teachers_login_percent',
+    'asmt_admin_inspect_prebuilt',
+    'summary_asmt_created',
+    'tile_layouts_created_modified',
+    'integration_educlimber',
+    'integration_fast',
+    'integration_google_classroom',
+    'integration_pra',
+    'ticket_count',
+    'arr_dna',
+    'has_ise',
+    'subscriber_tenure_days'
+] + [f'{lag}_lag_band' for lag in HS_LAGS]
+
+
+def connect_to_db():
+    try:
+        return psycopg2.connect(
+            host = "REMOVE",
+            database = "REMOVE",
+            user = "franck",
+            password = "REMOVE",
+            options = '-c statement_timeout=300000'
+        )
+    except Exception as err:
+        print(f"ERROR: connect_to_db: {err}")
+        return None
+
+
+def get_training_data():
+    db_connection = connect_to_db()
+    if db_connection is None:
+        print(f'ERROR: Unable to establish connection to DB.')
+        return None
+
+    with open(SQL_PATH) as file:
+        training_data_sql = file.read().strip().rstrip(';')
+    print("Getting data...")
+    training_data = sqlio.read_sql_query(training_data_sql, db_connection)
+    print(f"...query completed ({len(training_data)})")
+    subscriber_runs = update_subscriber_runs(db_connection)
+    db_connection.close()
+    return training_data, subscriber_runs
+
+
+def add_client_tenure(training_data, subscriber_runs):
+    as_of_dates = pd.to_datetime(training_data['start_date']) + pd.offsets.MonthEnd(0)
+    _, tenure_days = subscriber_tenure(subscriber_runs, training_data['sf_an'], as_of_dates)
+    return training_data.assign(subscriber_tenure_days = tenure_days)
+
+
+def build_training_data(training_data, subscriber_runs):
+    training_data = add_client_tenure(training_data, subscriber_runs)
+    training_data = add_forward_labels(training_data, horizons = {3: ''})
+    training_data = add_lag_features(training_data, columns = {'hs_band': '{lag}_lag_band'})
+    # written as the integer column the query returned (1 / 2, not 1.0 / 2.0)
+    training_data['band_number'] = training_data['band_number'].astype('Int64')
+    training_data = training_data.sort_values(
+        'subscriber_tenure_days', ascending = False, na_position = 'first', kind = 'stable'
+    )
+    return training_data[TRAINING_DATA_COLUMNS]
+
+
+if __name__ == '__main__':
+    pulled = get_training_data()
+    if pulled is not None:
+        build_training_data(*pulled).to_csv(OUTPUT_PATH, index = False)
+        print("fin.")
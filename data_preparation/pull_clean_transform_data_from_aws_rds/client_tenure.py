@@ -0,0 +1,169 @@
+"""
+Client tenure: how long a client has had a continuous DnA subscription at a given point in time.
+
+The recursive client_tenure query joined the subscriptions to every month end, recursed through
+the earlier subscriptions and cross joined the month ends again.  Here each account's
+subscriptions are sorted once and merged into runs: a subscription that starts no more than
+GAP_DAYS after the run's latest end continues the run.  subscriber_tenure() then answers any
+number of (account, as-of date) pairs with one binary search over all the runs: the tenure is the
+days since the start of the run covering that date (a gap of up to GAP_DAYS between two
+subscriptions of a run is covered).  Like the query, which gave every DnA account a tenure at every
+month end, an account gets one at every date: 0 while it has no running subscription (before its
+first one, or lapsed between runs).  Only accounts without any DnA subscription get NaN.
+
+The runs are kept in _subscriber_runs.json.  Merging runs is associative, so a later call of
+update_subscriber_runs() only fetches the subscriptions that started after the last one it saw
+and merges them into the stored runs.  Subscriptions that are shortened or backdated are only
+picked up by a full rebuild, which happens every STATE_TTL_SECONDS (or with refresh = True).
+
+    python client_tenure.py    # writes client_tenure.csv, tenure at every month end of 5 years
+"""
+
+import json
+import os
+import time
+import numpy as np
+import pandas as pd
+import pandas.io.sql as sqlio
+
+
+GAP_DAYS = 90
+STATE_PATH = '_subscriber_runs.json'
+STATE_TTL_SECONDS = 7 * 24 * 60 * 60
+SUBSCRIPTIONS_SQL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dna_subscriptions.sql')
+RUN_COLUMNS = ['account_number', 'account_name', 'start_date', 'end_date']
+
+
+def merge_subscriptions(subscriptions, gap_days = GAP_DAYS):
+    """
+    Continuous subscription runs (RUN_COLUMNS, end_date NaT while still open) of subscriptions,
+    which can be earlier runs as well.
+    """
+    subscriptions = subscriptions[RUN_COLUMNS].assign(
+        start_date = pd.to_datetime(subscriptions['start_date']),
+        end_date = pd.to_datetime(subscriptions['end_date'])
+    ).sort_values(['account_number', 'start_date'], kind = 'stable').reset_index(drop = True)
+
+    # latest end so far in the account (open subscriptions never end) decides where a new run starts
+    ends = subscriptions['end_date'].fillna(pd.Timestamp.max)
+    latest_end = ends.groupby(subscriptions['account_number']).cummax()
+    previous_end = latest_end.groupby(subscriptions['account_number']).shift()
+    new_run = previous_end.isna() | (
+        subscriptions['start_date'] - pd.Timedelta(days = gap_days) > previous_end.fillna(pd.Timestamp.min)
+    )
+    runs = subscriptions.assign(end_date = ends).groupby(new_run.cumsum()).agg(
+        account_number = ('account_number', 'first'),
+        account_name = ('account_name', 'last'),
+        start_date = ('start_date', 'min'),
+        end_date = ('end_date', 'max')
+    )
+    runs['end_date'] = runs['end_date'].where(runs['end_date'] != pd.Timestamp.max)
+    return runs.reset_index(drop = True)
+
+
+def subscriber_tenure(runs, account_numbers, as_of_dates):
+    """
+    earliest_start and subscriber_tenure_days of each pair of account_numbers and as_of_dates:
+    the start of the run covering the date and the days since.  NaT / 0 when the account isn't
+    subscribed at the date, NaT / NaN for an account without runs.
+    """
+    runs = runs.sort_values(['account_number', 'start_date'], kind = 'stable')
+    accounts = pd.Index(runs['account_number'].unique())
+    starts = runs['start_date'].to_numpy().astype('datetime64[D]').astype(np.int64)
+    days = pd.to_datetime(pd.Series(as_of_dates)).to_numpy().astype('datetime64[D]').astype(np.int64)
+
+    # one sorted key across accounts, so a single search finds each date's latest run start
+    first_day = min(starts.min(initial = 0), days.min(initial = 0))
+    stride = max(starts.max(initial = 0), days.max(initial = 0)) - first_day + 1
+    run_keys = accounts.get_indexer(runs['account_number']) * stride + (starts - first_day)
+    account_codes = accounts.get_indexer(pd.Series(account_numbers))
+    run = np.searchsorted(run_keys, account_codes * stride + (days - first_day), side = 'right') - 1
+
+    run_start = starts[np.maximum(run, 0)]
+    run_end = runs['end_date'].to_numpy()[np.maximum(run, 0)]
+    subscribed = (
+        (account_codes >= 0) & (run >= 0) & (run_keys[np.maximum(run, 0)] // stride == account_codes)
+        & (pd.isna(run_end) | (run_end > pd.to_datetime(pd.Series(as_of_dates)).to_numpy()))
+    )
+    earliest_start = np.where(subscribed, run_start, np.iinfo(np.int64).min).astype('datetime64[D]')
+    tenure_days = np.where(subscribed, days - run_start, np.where(account_codes >= 0, 0, np.nan))
+    return earliest_start, tenure_days
+
+
+def load_tenure_state(path = STATE_PATH):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as file:
+        return json.load(file)
+
+
+def save_tenure_state(state, path = STATE_PATH):
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as file:
+        json.dump(state, file, indent = 1, sort_keys = True)
+    os.replace(tmp_path, path)
+
+
+def runs_from_state(state):
+    runs = pd.DataFrame(state.get('runs', []), columns = RUN_COLUMNS)
+    return runs.assign(start_date = pd.to_datetime(runs['start_date']), end_date = pd.to_datetime(runs['end_date']))
+
+
+def state_from_runs(runs, max_start_date, fetched_at):
+    return {
+        'fetched_at': fetched_at,
+        'max_start_date': max_start_date,
+        'runs': [
+            [account_number, account_name, start_date.date().isoformat(),
+             None if pd.isna(end_date) else end_date.date().isoformat()]
+            for account_number, account_name, start_date, end_date in runs[RUN_COLUMNS].itertuples(index = False)
+        ]
+    }
+
+
+def get_subscriptions(db_connection, since = None):
+    """The DnA subscriptions that started after since (an iso date; every subscription if None)."""
+    with open(SUBSCRIPTIONS_SQL_PATH) as file:
+        subscriptions_sql = file.read().strip().rstrip(';')
+    return sqlio.read_sql_query(subscriptions_sql, db_connection, params = {'since': since or '-infinity'})
+
+
+def update_subscriber_runs(db_connection, refresh = False, path = STATE_PATH, ttl_seconds = STATE_TTL_SECONDS):
+    """The stored runs with the subscriptions that started since merged in (all of them rebuilt if stale)."""
+    state = {} if refresh else load_tenure_state(path)
+    if state and time.time() - state['fetched_at'] > ttl_seconds:
+        state = {}
+
+    fetched_at = state.get('fetched_at', time.time())
+    subscriptions = get_subscriptions(db_connection, state.get('max_start_date'))
+    print(f"...{len(subscriptions)} {'new ' if state else ''}DnA subscriptions")
+    runs = merge_subscriptions(pd.concat([runs_from_state(state), subscriptions[RUN_COLUMNS]], ignore_index = True))
+
+    max_start_date = state.get('max_start_date')
+    if len(subscriptions):
+        max_start_date = pd.to_datetime(subscriptions['start_date']).max().date().isoformat()
+    save_tenure_state(state_from_runs(runs, max_start_date, fetched_at), path)
+    return runs
+
+
+def month_ends(years = 5):
+    """Month ends from years before the current month to the end of the current month."""
+    this_month = pd.Timestamp.today().normalize().replace(day = 1)
+    return pd.date_range(this_month - pd.DateOffset(years = years), this_month, freq = 'MS') + pd.offsets.MonthEnd(0)
+
+
+if __name__ == '__main__':
+    from build_training_data import connect_to_db
+    db_connection = connect_to_db()
+    if db_connection is None:
+        print(f'ERROR: Unable to establish connection to DB.')
+    else:
+        runs = update_subscriber_runs(db_connection)
+        db_connection.close()
+        accounts = runs[['account_number', 'account_name']].drop_duplicates('account_number', keep = 'last')
+        client_tenure = accounts.merge(pd.DataFrame({'as_of_date': month_ends()}), how = 'cross')
+        client_tenure['earliest_start'], client_tenure['subscriber_tenure_days'] = subscriber_tenure(
+            runs, client_tenure['account_number'], client_tenure['as_of_date']
+        )
+        client_tenure.to_csv('client_tenure.csv', index = False)
+        print("fin.")
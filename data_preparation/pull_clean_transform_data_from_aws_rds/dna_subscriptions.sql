@@ -0,0 +1,20 @@
+/*
+ SUMMARY:
+ DnA subscriptions (the rate and license products) that started after %(since)s.
+ - client_tenure.py merges them into continuous subscription runs to calculate client tenure.
+ - The query is run with psycopg2 parameters, so literal percent signs are doubled.
+*/
+
+SELECT
+	account_number,
+	account_name,
+	start_date,
+	end_date
+
+FROM sfdc_subscriptions
+WHERE product_group = 'DnA'
+  AND product_name ILIKE '%%DnA%%'
+  AND (product_name ILIKE '%%Rate%%' OR product_name ILIKE '%%License%%')
+  AND start_date > %(since)s
+
+;
@@ -0,0 +1,93 @@
+"""
+Forward-window target labels (hs_did_change, hs_change_type) for any number of horizons in one
+sorted pass.
+
+The client_health_3month_window CTE of get_training_data_from_aws_rds.sql self-joined the rollup
+on atd_database and a 3 month start_date range, which is quadratic per client.  Here the rows are
+sorted by (atd_database, start_date) once; the window of every row and horizon is then a range of
+positions found by binary search, and the lowest / highest band number in it comes from prefix
+counts of each band number, so each horizon is O(n log n) and needs no join.
+
+As in the query, a row's window is the rows of the same atd_database whose start_date is after
+its own and at most horizon months later (start_dates are the first of the month).
+"""
+
+import numpy as np
+import pandas as pd
+
+
+BAND_NUMBERS = {
+    'Red': 1,
+    'Yellow': 1,
+    'Green': 2
+}
+
+# horizon in months -> suffix of its label columns; the 3 month window is the model's target
+LABEL_HORIZONS = {
+    3: '',
+    1: '_1m',
+    2: '_2m',
+    6: '_6m'
+}
+
+CHANGE_TYPE_ORDER = {
+    'Stayed Green': 4,
+    'Red/Yellow to Green': 3,
+    'Green to Red/Yellow': 2,
+    'Stayed Red/Yellow': 1
+}
+
+
+def window_band_range(band_numbers, start, end):
+    """Lowest and highest band number (NaN if there is none) in the positions start..end - 1 of each row."""
+    lowest = np.full(len(band_numbers), np.nan)
+    highest = np.full(len(band_numbers), np.nan)
+    for band_number in sorted(set(BAND_NUMBERS.values()), reverse = True):
+        counts = np.concatenate([[0], np.cumsum(band_numbers == band_number)])
+        in_window = counts[end] > counts[start]
+        lowest[in_window] = band_number
+        highest[in_window & np.isnan(highest)] = band_number
+    return lowest, highest
+
+
+def change_labels(band_numbers, lowest, highest):
+    """hs_did_change and hs_change_type, as the hs_did_change CTE derived them."""
+    green = band_numbers == 2
+    did_change = np.where(green, band_numbers != lowest, band_numbers != highest).astype(object)
+    change_type = np.select(
+        [green & ~did_change.astype(bool), green, ~did_change.astype(bool)],
+        ['Stayed Green', 'Green to Red/Yellow', 'Stayed Red/Yellow'],
+        'Red/Yellow to Green'
+    ).astype(object)
+    no_window = np.isnan(np.where(green, lowest, highest))
+    did_change[no_window] = None
+    change_type[no_window] = None
+    return did_change, change_type
+
+
+def add_forward_labels(frame, horizons = LABEL_HORIZONS, key = 'atd_database', order = 'start_date', band = 'hs_band'):
+    """
+    frame with band_number and, per horizon, interval_min_band_number, interval_max_band_number,
+    hs_did_change, hs_change_type and change_type_order columns (suffixed as in horizons).
+    """
+    ordered = frame.sort_values([key, order], kind = 'stable')
+    band_numbers = ordered[band].map(BAND_NUMBERS).to_numpy(dtype = float)
+    months = pd.to_datetime(ordered[order]).to_numpy().astype('datetime64[M]').astype(np.int64)
+
+    # one sorted key across clients: no window can reach into the next client's months
+    stride = months.max() - months.min() + max(horizons) + 1
+    position_keys = pd.factorize(ordered[key])[0] * stride + (months - months.min())
+    start = np.searchsorted(position_keys, position_keys, side = 'right')
+
+    features = {'band_number': band_numbers}
+    for horizon, suffix in horizons.items():
+        end = np.searchsorted(position_keys, position_keys + horizon, side = 'right')
+        lowest, highest = window_band_range(band_numbers, start, end)
+        did_change, change_type = change_labels(band_numbers, lowest, highest)
+        features[f'interval_min_band_number{suffix}'] = lowest
+        features[f'interval_max_band_number{suffix}'] = highest
+        features[f'hs_did_change{suffix}'] = did_change
+        features[f'hs_change_type{suffix}'] = change_type
+        features[f'change_type_order{suffix}'] = pd.Series(change_type).map(CHANGE_TYPE_ORDER).to_numpy()
+
+    return frame.join(pd.DataFrame(features, index = ordered.index))
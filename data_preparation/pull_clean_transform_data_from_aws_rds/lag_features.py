@@ -0,0 +1,81 @@
+"""
+Lag and rolling-window features of the monthly usage rollup, computed in one sorted pass.
+
+The hs_lag CTE of get_training_data_from_aws_rds.sql used to run 21 window functions, each
+sorting the whole rollup by (sf_an, start_date) again.  add_lag_features() sorts the rows once,
+finds where each sf_an's rows start, and takes every lag and rolling window as an array offset
+within the sf_an, so more lags or columns cost no extra sort.
+
+Like the window functions, lags and windows count rows, not months: June, July, August and
+December are scrubbed from the rollup, so 8 rows back is the same month a year earlier.
+"""
+
+import numpy as np
+import pandas as pd
+
+
+# lag name -> rows back
+HS_LAGS = {
+    'hs_1': 1,
+    'hs_4': 4,
+    'hs_5': 5,
+    'hs_6': 6,
+    'hs_7': 7,
+    'hs_1year': 8
+}
+
+# rollup column -> lag column ({lag} is the lag name)
+HS_LAG_COLUMNS = {
+    'start_date': '{lag}_lag_date',
+    'hs_band': '{lag}_lag_band',
+    'atd_client_health_score': '{lag}_lag'
+}
+
+ROLLING_AGGREGATES = {
+    'sum': np.nansum,
+    'mean': np.nanmean,
+    'min': np.nanmin,
+    'max': np.nanmax
+}
+
+
+def group_starts(keys):
+    """For keys in sorted order, the position of the first row of each row's group."""
+    positions = np.arange(len(keys))
+    new_group = np.ones(len(keys), dtype = bool)
+    new_group[1:] = keys[1:] != keys[:-1]
+    return np.maximum.accumulate(np.where(new_group, positions, 0))
+
+
+def add_lag_features(frame, lags = HS_LAGS, columns = HS_LAG_COLUMNS, rolling = None, key = 'sf_an',
+                     order = 'start_date'):
+    """
+    frame with a lag column per lag and column (NaN / None before a key's first lagged row) and a
+    column per rolling window.
+
+    lags: {lag name: rows back}
+    columns: {column: lag column name pattern}
+    rolling: optional {column name: (column, rows, aggregate)}, an aggregate (sum, mean, min or
+        max) of the numeric column over the row and the rows - 1 before it, within the key
+    """
+    ordered = frame.sort_values([key, order], kind = 'stable')
+    positions = np.arange(len(ordered))
+    starts = group_starts(ordered[key].to_numpy())
+    features = {}
+
+    for lag, rows_back in lags.items():
+        source = positions - rows_back
+        has_lag = source >= starts
+        source = np.where(has_lag, source, 0)
+        for column, pattern in columns.items():
+            values = ordered[column].iloc[source].reset_index(drop = True)
+            features[pattern.format(lag = lag)] = values.where(has_lag).to_numpy()
+
+    for name, (column, rows, aggregate) in (rolling or {}).items():
+        window = positions[:, None] - np.arange(rows)[None, :]
+        in_window = window >= starts[:, None]
+        values = ordered[column].to_numpy(dtype = float)[np.where(in_window, window, 0)]
+        values[~in_window] = np.nan
+        features[name] = ROLLING_AGGREGATES[aggregate](values, axis = 1)
+
+    return frame.join(pd.DataFrame(features, index = ordered.index))
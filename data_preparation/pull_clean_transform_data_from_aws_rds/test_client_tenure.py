@@ -0,0 +1,60 @@
+"""
+merge_subscriptions() and subscriber_tenure() on a few hand-computed subscriptions: a start
+GAP_DAYS after the latest end continues the run, one a day later starts a new one, and tenure is
+0 while lapsed and NaN for an account without subscriptions.
+"""
+
+import numpy as np
+import pandas as pd
+from client_tenure import RUN_COLUMNS, merge_subscriptions, subscriber_tenure
+
+
+SUBSCRIPTIONS = [
+    # 2021-03-31 is exactly 90 days after 2020-12-31: one run
+    ('1', 'One', '2020-01-01', '2020-12-31'),
+    ('1', 'One renamed', '2021-03-31', '2021-06-30'),
+    # 2021-04-01 is 91 days after: a new run, still open
+    ('2', 'Two', '2020-01-01', '2020-12-31'),
+    ('2', 'Two', '2021-04-01', None),
+    # the latest end so far counts, not the previous subscription's: the nested one ends earlier
+    ('3', 'Three', '2020-06-01', '2020-12-31'),
+    ('3', 'Three', '2020-01-01', '2022-12-31'),
+    ('3', 'Three', '2023-02-01', '2023-03-31')
+]
+
+
+def runs():
+    return merge_subscriptions(pd.DataFrame(SUBSCRIPTIONS, columns = RUN_COLUMNS))
+
+
+def test_merge_subscriptions_at_the_gap_boundary():
+    expected = pd.DataFrame([
+        ('1', 'One renamed', '2020-01-01', '2021-06-30'),
+        ('2', 'Two', '2020-01-01', '2020-12-31'),
+        ('2', 'Two', '2021-04-01', None),
+        ('3', 'Three', '2020-01-01', '2023-03-31')
+    ], columns = RUN_COLUMNS)
+    dates = {'start_date': 'datetime64[ns]', 'end_date': 'datetime64[ns]'}
+    pd.testing.assert_frame_equal(runs().astype(dates), expected.astype(dates), check_dtype = False)
+
+
+def test_merging_runs_again_changes_nothing():
+    pd.testing.assert_frame_equal(merge_subscriptions(runs()), runs())
+
+
+def test_subscriber_tenure():
+    as_of = [
+        ('1', '2021-02-15', '2020-01-01', 411),    # in the 90 day gap, covered by the run
+        ('1', '2021-07-31', None, 0),              # lapsed after the run
+        ('1', '2019-12-31', None, 0),              # before the first subscription
+        ('2', '2021-02-15', None, 0),              # in the 91 day gap, between runs
+        ('2', '2021-04-30', '2021-04-01', 29),
+        ('2', '2030-01-31', '2021-04-01', 3227),   # the run is still open
+        ('3', '2023-03-15', '2020-01-01', 1169),
+        ('9', '2021-01-31', None, np.nan)          # no DnA subscription at all
+    ]
+    accounts, dates, starts, days = zip(*as_of)
+    earliest_start, tenure_days = subscriber_tenure(runs(), list(accounts), pd.to_datetime(list(dates)))
+
+    np.testing.assert_array_equal(earliest_start, np.array(pd.to_datetime(list(starts)), dtype = 'datetime64[D]'))
+    np.testing.assert_array_equal(tenure_days, days)
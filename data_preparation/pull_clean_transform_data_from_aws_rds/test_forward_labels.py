@@ -0,0 +1,88 @@
+"""
+add_forward_labels() on a few hand-computed client months: a row's window is the months after
+its own up to the horizon (a month missing from the rollup leaves it out, the month horizon
+months later is in), never reaches into the next client, and is empty (labels NULL) without a
+band in it.
+"""
+
+import numpy as np
+import pandas as pd
+from forward_labels import add_forward_labels
+
+
+HORIZONS = {3: '', 1: '_1m'}
+
+# atd_database, start_date, hs_band; then per horizon hs_did_change, hs_change_type,
+# change_type_order, interval_min_band_number and interval_max_band_number
+MONTHS = [
+    ('A', '2024-01-01', 'Green'),
+    ('A', '2024-02-01', 'Red'),
+    ('A', '2024-04-01', 'Green'),
+    ('A', '2024-07-01', 'Yellow'),
+    ('B', '2024-01-01', 'Red'),
+    ('B', '2024-02-01', None),
+    ('B', '2024-03-01', 'Yellow'),
+    ('C', '2024-01-01', 'Green'),
+    ('C', '2024-03-01', 'Green')
+]
+THREE_MONTHS = [
+    (True, 'Green to Red/Yellow', 2, 1, 2),
+    (True, 'Red/Yellow to Green', 3, 2, 2),
+    # July is exactly 3 months after April
+    (True, 'Green to Red/Yellow', 2, 1, 1),
+    (None, None, np.nan, np.nan, np.nan),
+    # February has no band, so only March counts
+    (False, 'Stayed Red/Yellow', 1, 1, 1),
+    # a row without a band is labelled as the query did: not Green, so compared with the window's highest band
+    (True, 'Red/Yellow to Green', 3, 1, 1),
+    (None, None, np.nan, np.nan, np.nan),
+    (False, 'Stayed Green', 4, 2, 2),
+    (None, None, np.nan, np.nan, np.nan)
+]
+ONE_MONTH = [
+    (True, 'Green to Red/Yellow', 2, 1, 1),
+    # A has no March row
+    (None, None, np.nan, np.nan, np.nan),
+    (None, None, np.nan, np.nan, np.nan),
+    (None, None, np.nan, np.nan, np.nan),
+    # B's February, the only month of the window, has no band
+    (None, None, np.nan, np.nan, np.nan),
+    (True, 'Red/Yellow to Green', 3, 1, 1),
+    (None, None, np.nan, np.nan, np.nan),
+    (None, None, np.nan, np.nan, np.nan),
+    (None, None, np.nan, np.nan, np.nan)
+]
+
+
+def rollup():
+    frame = pd.DataFrame(MONTHS, columns = ['atd_database', 'start_date', 'hs_band'])
+    frame['start_date'] = pd.to_datetime(frame['start_date'])
+    # out of order, as the rollup can arrive
+    return frame.iloc[::-1]
+
+
+def nulls_as_none(values):
+    return [None if pd.isna(value) else value for value in values]
+
+
+def assert_labels(result, suffix, expected):
+    did_change, change_type, order, lowest, highest = zip(*expected)
+    assert nulls_as_none(result[f'hs_did_change{suffix}']) == list(did_change)
+    assert nulls_as_none(result[f'hs_change_type{suffix}']) == list(change_type)
+    np.testing.assert_array_equal(result[f'change_type_order{suffix}'].astype(float), order)
+    np.testing.assert_array_equal(result[f'interval_min_band_number{suffix}'], lowest)
+    np.testing.assert_array_equal(result[f'interval_max_band_number{suffix}'], highest)
+
+
+def test_forward_labels_of_each_horizon():
+    result = add_forward_labels(rollup(), horizons = HORIZONS).sort_index()
+
+    np.testing.assert_array_equal(result['band_number'], [2, 1, 2, 1, 1, np.nan, 1, 2, 2])
+    assert_labels(result, '', THREE_MONTHS)
+    assert_labels(result, '_1m', ONE_MONTH)
+
+
+def test_input_columns_and_rows_are_kept():
+    frame = rollup()
+    result = add_forward_labels(frame, horizons = HORIZONS)
+    pd.testing.assert_frame_equal(result[frame.columns], frame)
@@ -0,0 +1,71 @@
+"""
+add_lag_features() on a few hand-computed client months: lags and windows count rows (a month
+missing from the rollup is skipped, not a gap), stay within the sf_an and carry NULLs through.
+"""
+
+import numpy as np
+import pandas as pd
+from lag_features import add_lag_features
+
+
+LAGS = {'hs_1': 1, 'hs_2': 2}
+ROLLING = {
+    'hs_sum_2': ('atd_client_health_score', 2, 'sum'),
+    'hs_mean_2': ('atd_client_health_score', 2, 'mean')
+}
+
+
+def rollup():
+    # out of order on purpose; A has no March row and no score or band in February
+    return pd.DataFrame({
+        'sf_an': ['A', 'B', 'A', 'B', 'A'],
+        'start_date': pd.to_datetime(['2024-04-01', '2024-01-01', '2024-01-01', '2024-02-01', '2024-02-01']),
+        'hs_band': ['Red', 'Yellow', 'Green', 'Green', None],
+        'atd_client_health_score': [60.0, 50.0, 80.0, 70.0, np.nan]
+    }, index = [10, 11, 12, 13, 14])
+
+
+def expected(values, name):
+    return pd.Series(values, index = [10, 11, 12, 13, 14], name = name)
+
+
+def test_lags_count_rows_within_the_key():
+    result = add_lag_features(rollup(), lags = LAGS)
+
+    # A-04's previous row is February (March is missing); its February has no score or band
+    pd.testing.assert_series_equal(
+        result['hs_1_lag_date'],
+        expected(pd.to_datetime(['2024-02-01', None, None, '2024-01-01', '2024-01-01']), 'hs_1_lag_date')
+    )
+    pd.testing.assert_series_equal(
+        result['hs_1_lag'], expected([np.nan, np.nan, np.nan, 50.0, 80.0], 'hs_1_lag')
+    )
+    pd.testing.assert_series_equal(
+        result['hs_1_lag_band'], expected([None, None, None, 'Yellow', 'Green'], 'hs_1_lag_band'), check_dtype = False
+    )
+
+    # only A has a second row back; B's lag never reaches into A
+    pd.testing.assert_series_equal(
+        result['hs_2_lag_date'],
+        expected(pd.to_datetime(['2024-01-01', None, None, None, None]), 'hs_2_lag_date')
+    )
+    pd.testing.assert_series_equal(
+        result['hs_2_lag'], expected([80.0, np.nan, np.nan, np.nan, np.nan], 'hs_2_lag')
+    )
+    pd.testing.assert_series_equal(
+        result['hs_2_lag_band'], expected(['Green', None, None, None, None], 'hs_2_lag_band'), check_dtype = False
+    )
+
+
+def test_rolling_windows_skip_nulls_and_stop_at_the_key():
+    result = add_lag_features(rollup(), lags = {}, rolling = ROLLING)
+
+    pd.testing.assert_series_equal(result['hs_sum_2'], expected([60.0, 50.0, 80.0, 120.0, 80.0], 'hs_sum_2'))
+    pd.testing.assert_series_equal(result['hs_mean_2'], expected([60.0, 50.0, 80.0, 60.0, 80.0], 'hs_mean_2'))
+
+
+def test_input_columns_and_rows_are_kept():
+    frame = rollup()
+    result = add_lag_features(frame, lags = LAGS)
+    pd.testing.assert_frame_equal(result[frame.columns], frame)
+    assert len(result.columns) == len(frame.columns) + len(LAGS) * 3
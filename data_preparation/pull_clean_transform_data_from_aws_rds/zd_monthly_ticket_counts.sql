@@ -0,0 +1,132 @@
+/*
+SUMMARY:
+- Maintains zd_monthly_ticket_counts, the number of Zendesk tickets created per Salesforce account (sf_an) and month,
+  for the zd_rollup CTEs of get_training_data_from_aws_rds.sql and cohort_analysis_for_dependent_variables.sql
+- Only tickets of orgs with a Salesforce id are counted, as the zd_rollup CTEs did
+- Each ticket is counted once for its sf_an and month.  The former zd_rollup CTEs counted it once per rollup row of
+  the sf_an and month (once per atd_database) and split the count by org name, so ticket_count is lower, and one row,
+  for clients with several databases or orgs (models using it need retraining)
+
+REFRESH:
+- Triggers on zd_tickets add the tickets each statement inserts to their month's count (and take deleted tickets, and
+  the old side of updated ones, off it), so a ticket sync only touches the counts of the tickets it changed
+- TRUNCATE of zd_tickets empties the counts; any change to zd_orgs (an org getting its Salesforce id) recounts them all
+- First install, or after zd_tickets or zd_orgs were dropped and recreated (their triggers go with them), re-run this
+  script and:
+  CALL rebuild_zd_monthly_ticket_counts();
+*/
+
+
+CREATE TABLE IF NOT EXISTS zd_monthly_ticket_counts (
+	sf_an text NOT NULL,
+	month_start date NOT NULL,
+	ticket_count integer NOT NULL,
+	PRIMARY KEY (sf_an, month_start)
+);
+
+
+CREATE OR REPLACE FUNCTION count_zd_monthly_tickets() RETURNS trigger
+	LANGUAGE plpgsql AS
+$$
+BEGIN
+	-- TG_ARGV[0] is 1 for the tickets in changed_tickets that are added and -1 for those that are removed
+	INSERT INTO zd_monthly_ticket_counts (sf_an, month_start, ticket_count)
+	SELECT
+		zo.ie_salesforce_id,
+		DATE_TRUNC('month', t.created_at)::date,
+		TG_ARGV[0]::integer * COUNT(t.ticket_id)
+	FROM changed_tickets t
+	JOIN zd_orgs zo ON t.org_id = zo.org_id
+		AND zo.ie_salesforce_id IS NOT NULL
+		AND zo.ie_salesforce_id != ''
+	WHERE t.created_at IS NOT NULL
+	GROUP BY zo.ie_salesforce_id, DATE_TRUNC('month', t.created_at)::date
+	ON CONFLICT (sf_an, month_start) DO UPDATE
+		SET ticket_count = zd_monthly_ticket_counts.ticket_count + EXCLUDED.ticket_count;
+	RETURN NULL;
+END
+$$;
+
+DO
+$$
+	DECLARE
+		event record;
+	BEGIN
+		-- an update is counted as removing its old rows and adding its new ones (created_at or org_id may change)
+		FOR event IN
+			SELECT *
+			FROM (VALUES
+				('inserted', 'INSERT', 'NEW', 1),
+				('updated_to', 'UPDATE', 'NEW', 1),
+				('updated_from', 'UPDATE', 'OLD', -1),
+				('deleted', 'DELETE', 'OLD', -1)
+			) AS events (suffix, operation, transition, sign)
+		LOOP
+			EXECUTE FORMAT('DROP TRIGGER IF EXISTS %I ON zd_tickets', 'zd_monthly_ticket_counts_' || event.suffix);
+			EXECUTE FORMAT(
+				'CREATE TRIGGER %I AFTER %s ON zd_tickets REFERENCING %s TABLE AS changed_tickets
+				 FOR EACH STATEMENT EXECUTE FUNCTION count_zd_monthly_tickets(%L)',
+				'zd_monthly_ticket_counts_' || event.suffix, event.operation, event.transition, event.sign
+			);
+		END LOOP;
+	END
+$$;
+
+
+CREATE OR REPLACE FUNCTION recount_zd_monthly_tickets() RETURNS void
+	LANGUAGE plpgsql AS
+$$
+BEGIN
+	-- no ticket can be counted twice (or missed) while the counts are rebuilt; readers keep the old counts meanwhile
+	LOCK TABLE zd_tickets IN SHARE MODE;
+	DELETE FROM zd_monthly_ticket_counts;
+	INSERT INTO zd_monthly_ticket_counts (sf_an, month_start, ticket_count)
+	SELECT
+		zo.ie_salesforce_id,
+		DATE_TRUNC('month', t.created_at)::date,
+		COUNT(t.ticket_id)
+	FROM zd_tickets t
+	JOIN zd_orgs zo ON t.org_id = zo.org_id
+		AND zo.ie_salesforce_id IS NOT NULL
+		AND zo.ie_salesforce_id != ''
+	WHERE t.created_at IS NOT NULL
+	GROUP BY zo.ie_salesforce_id, DATE_TRUNC('month', t.created_at)::date;
+END
+$$;
+
+CREATE OR REPLACE PROCEDURE rebuild_zd_monthly_ticket_counts()
+	LANGUAGE plpgsql AS
+$$
+BEGIN
+	PERFORM recount_zd_monthly_tickets();
+	COMMIT;
+END
+$$;
+
+
+CREATE OR REPLACE FUNCTION recount_zd_monthly_tickets_for_orgs() RETURNS trigger
+	LANGUAGE plpgsql AS
+$$
+BEGIN
+	-- which tickets an org's Salesforce id applies to isn't kept anywhere, so all of them are counted again
+	PERFORM recount_zd_monthly_tickets();
+	RETURN NULL;
+END
+$$;
+
+CREATE OR REPLACE FUNCTION clear_zd_monthly_ticket_counts() RETURNS trigger
+	LANGUAGE plpgsql AS
+$$
+BEGIN
+	DELETE FROM zd_monthly_ticket_counts;
+	RETURN NULL;
+END
+$$;
+
+DROP TRIGGER IF EXISTS zd_monthly_ticket_counts_orgs ON zd_orgs;
+CREATE TRIGGER zd_monthly_ticket_counts_orgs AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON zd_orgs
+	FOR EACH STATEMENT EXECUTE FUNCTION recount_zd_monthly_tickets_for_orgs();
+
+DROP TRIGGER IF EXISTS zd_monthly_ticket_counts_truncated ON zd_tickets;
+CREATE TRIGGER zd_monthly_ticket_counts_truncated AFTER TRUNCATE ON zd_tickets
+	FOR EACH STATEMENT EXECUTE FUNCTION clear_zd_monthly_ticket_counts();
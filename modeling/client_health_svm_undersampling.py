@@ -124,7 +124,7 @@ refresh_data = False
 
 if refresh_data:
     db_connection = connect_to_db()
-    training_data_sql = "SELECT * FROM client_health_full_training_data_mv WHERE hs_did_change IS NOT NULL"
+    training_data_sql = "SELECT * FROM client_health_full_training_data WHERE hs_did_change IS NOT NULL"
     print("Getting data...")
     full_data_set = sqlio.read_sql_query(training_data_sql, db_connection)
     db_connection.close()